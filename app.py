@@ -2,9 +2,12 @@ import os
 import logging
 
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
+from nutrients import NutrientVector
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -17,6 +20,16 @@ db = SQLAlchemy(model_class=Base)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
 
+class JSONProvider(DefaultJSONProvider):
+    # Recipes and days carry their nutrition as vectors; responses show them as dicts
+    @staticmethod
+    def default(o):
+        if isinstance(o, NutrientVector):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+app.json = JSONProvider(app)
+
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///meal_planner.db")
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
@@ -28,8 +41,20 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 # Initialize the app with the extension
 db.init_app(app)
 
+# Record request latency and commit time for /metrics
+import metrics
+metrics.init_app(app, db)
+
+# Record where the time of every request goes and sample the stacks of some
+import profiling
+profiling.init_app(app, db)
+
 with app.app_context():
     # Make sure to import the models here or their tables won't be created
     import models  # noqa: F401
 
     db.create_all()
+
+    # Bring existing tables up to date with the models
+    import migrations
+    migrations.upgrade()
@@ -0,0 +1,5 @@
+"""
+Performance benchmarks
+
+Run from the repository root, e.g. python -m benchmarks.persistence
+"""
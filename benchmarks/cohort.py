@@ -0,0 +1,116 @@
+"""
+Cohort Planning Benchmark
+
+Generates plans for a batch of synthetic client profiles against a local fake
+Spoonacular server (see fake_spoonacular.py), first one profile at a time the
+way POST /generate_plan does, then with cohort_planner.plan_cohort for each
+number of worker processes:
+
+    python -m benchmarks.cohort --profiles 500 --workers 1,2,4,8
+
+The recipe cache is cleared before every run, and worker processes are
+started before the run that uses them. Reports plans per second and
+upstream round trips for each run as JSON.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+DIET_TYPES = ('balanced', 'balanced', 'low-carb', 'high-protein', 'low-fat')
+
+
+def synthetic_profiles(count, seed=0):
+    """
+    Build client preference profiles with a realistic spread of calorie targets and diets
+    """
+    rng = random.Random(seed)
+    profiles = []
+    for _ in range(count):
+        vegan = rng.random() < 0.05
+        profiles.append({
+            'calorie_target': rng.choice((1600, 1800, 2000, 2000, 2200, 2400)) + rng.randint(-100, 100),
+            'diet_type': rng.choice(DIET_TYPES),
+            'vegetarian': vegan or rng.random() < 0.15,
+            'vegan': vegan,
+            'gluten_free': rng.random() < 0.1,
+            'dairy_free': rng.random() < 0.1,
+            'allergens': rng.choice(('', '', '', 'peanuts', 'shellfish'))
+        })
+    return profiles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark batch cohort planning against one plan at a time")
+    parser.add_argument('--profiles', type=int, default=200)
+    parser.add_argument('--workers', default=None, help="Comma-separated worker counts (default 1 and every core)")
+    parser.add_argument('--latency', type=float, default=0.02, help="Fake upstream latency in seconds")
+    parser.add_argument('--selection', default='random', help="Meal selection for every profile: random or optimize")
+    parser.add_argument('--skip-sequential', action='store_true', help="Only run the cohort planner")
+    args = parser.parse_args(argv)
+
+    import fake_spoonacular
+    server = fake_spoonacular.start_server(latency=args.latency)
+
+    # Configure the app before it is imported
+    workdir = tempfile.mkdtemp(prefix='meal-planner-cohort-')
+    os.environ['SPOONACULAR_BASE_URL'] = server.base_url
+    os.environ['DATABASE_URL'] = f"sqlite:///{workdir}/bench.db"
+    os.environ['RECIPE_CACHE_PATH'] = f"{workdir}/recipe_cache.db"
+    os.environ['SPOONACULAR_QUOTA_PATH'] = f"{workdir}/quota.db"
+    os.environ.setdefault('SPOONACULAR_RATE_LIMIT', '0')
+    os.environ.setdefault('SPOONACULAR_DAILY_QUOTA', '0')
+
+    import logging
+    logging.disable(logging.ERROR)
+
+    from app import app, db
+    import upstream
+    from recipe_cache import cache
+    from meal_planner import generate_meal_plan, plan_candidate_pools
+    from plan_store import save_meal_plan
+    from cohort_planner import plan_cohort
+
+    profiles = [dict(profile, selection=args.selection) for profile in synthetic_profiles(args.profiles)]
+    worker_counts = [int(n) for n in args.workers.split(',')] if args.workers else sorted({1, os.cpu_count() or 1})
+    results = {'profiles': args.profiles, 'selection': args.selection, 'cpus': os.cpu_count(), 'runs': {}}
+
+    with app.app_context():
+        if not args.skip_sequential:
+            cache.clear()
+            with upstream.track_calls() as calls:
+                start = time.perf_counter()
+                for preferences in profiles:
+                    pools = plan_candidate_pools(preferences)
+                    meal_plan = generate_meal_plan(preferences, pools=pools)
+                    save_meal_plan(meal_plan, preferences=preferences, pools=pools)
+                    db.session.commit()
+                seconds = time.perf_counter() - start
+            results['runs']['sequential'] = {
+                'seconds': round(seconds, 3),
+                'plans_per_second': round(args.profiles / seconds, 1),
+                'upstream_calls': calls.total
+            }
+            print(f"sequential: {results['runs']['sequential']['plans_per_second']} plans/s", file=sys.stderr)
+
+        for workers in worker_counts:
+            # Start the worker processes outside the measurement
+            plan_cohort(profiles[:4], workers=workers)
+            db.session.rollback()
+
+            cache.clear()
+            _, stats = plan_cohort(profiles, workers=workers)
+            db.session.commit()
+            results['runs'][f"cohort_{workers}_workers"] = stats
+            print(f"cohort, {workers} workers: {stats['plans_per_second']} plans/s", file=sys.stderr)
+
+    server.shutdown()
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
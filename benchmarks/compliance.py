@@ -0,0 +1,105 @@
+"""
+Compliance Benchmark
+
+Compares usda_guidelines.check_nutrient_compliance, called once per plan,
+with check_compliance_batch scoring every plan at once, on synthetic weekly
+plans with a mix of calorie targets:
+
+    python -m benchmarks.compliance --plans 10000 --repeat 5
+
+batch_arrays_ms times the scoring alone on nutrition already held as an
+array. Also times get_macronutrient_targets against the calculation it replaces
+and checks that both compliance paths agree on every plan. Results are
+printed as JSON.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+
+def synthetic_plans(count, days=7, seed=0):
+    """
+    Build plans of days with random nutrition totals, and a calorie target for each plan
+    """
+    from usda_guidelines import COMPLIANCE_NUTRIENTS
+
+    rng = random.Random(seed)
+    plans, calorie_targets = [], []
+    for _ in range(count):
+        target = rng.choice((1600, 1800, 2000, 2200, 2400, 2800, rng.randint(1000, 3500)))
+        plans.append([
+            {'nutrition': {
+                name: target * rng.uniform(0.7, 1.3) if name == 'calories' else rng.uniform(10, 350)
+                for name in COMPLIANCE_NUTRIENTS
+            }}
+            for _ in range(days)
+        ])
+        calorie_targets.append(target)
+    return plans, calorie_targets
+
+
+def timed(operation, repeat):
+    """
+    Run an operation `repeat` times and return (median seconds, last result)
+    """
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = operation()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark per-plan and batch USDA compliance checks")
+    parser.add_argument('--plans', type=int, default=10000, help="Number of plans to score")
+    parser.add_argument('--days', type=int, default=7, help="Days per plan")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per measurement; the median is reported")
+    args = parser.parse_args(argv)
+
+    from usda_guidelines import (
+        check_nutrient_compliance, check_compliance_batch, compliance_scores, average_nutrition,
+        get_macronutrient_targets, _calculate_macronutrient_targets
+    )
+
+    plans, calorie_targets = synthetic_plans(args.plans, args.days)
+
+    per_plan_seconds, per_plan = timed(
+        lambda: [check_nutrient_compliance(plan, target) for plan, target in zip(plans, calorie_targets)],
+        args.repeat
+    )
+    batch_seconds, batch = timed(lambda: check_compliance_batch(plans, calorie_targets), args.repeat)
+    # Scores alone, for callers that already hold the nutrition as an array
+    averages = average_nutrition(plans)
+    arrays_seconds, _ = timed(lambda: compliance_scores(averages, calorie_targets), args.repeat)
+
+    calculated_seconds, _ = timed(lambda: [_calculate_macronutrient_targets(t) for t in calorie_targets], args.repeat)
+    table_seconds, _ = timed(lambda: [get_macronutrient_targets(t) for t in calorie_targets], args.repeat)
+
+    results = {
+        'plans': args.plans,
+        'days': args.days,
+        'compliance': {
+            'per_plan_ms': round(per_plan_seconds * 1000, 3),
+            'batch_ms': round(batch_seconds * 1000, 3),
+            'batch_arrays_ms': round(arrays_seconds * 1000, 3),
+            'speedup': round(per_plan_seconds / batch_seconds, 1),
+            'arrays_speedup': round(per_plan_seconds / arrays_seconds, 1),
+            'plans_per_second': round(args.plans / batch_seconds),
+            'mismatches': sum(a != b for a, b in zip(per_plan, batch))
+        },
+        'targets': {
+            'calculated_us': round(calculated_seconds / args.plans * 1e6, 3),
+            'table_us': round(table_seconds / args.plans * 1e6, 3)
+        }
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Profiling Overhead Benchmark
+
+Measures what request profiling (see profiling.py) costs, by timing the
+same requests through the Flask test client at several sample rates:
+- POST /generate_plan, with recipes already cached, so the time is the
+  app's own rather than upstream's
+- GET /api/plan/<id>, a short request dominated by the database
+
+A rate of 0 only records phase times; a rate of 1 also samples the stack of
+every request and writes every profile. Results are printed as JSON.
+
+    python -m benchmarks.profiling --iterations 100 --rates 0,0.01,1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of request profiling")
+    parser.add_argument('--iterations', type=int, default=50, help="Requests per route and sample rate")
+    parser.add_argument('--rates', default='0,0.01,1', help="Comma-separated sample rates")
+    args = parser.parse_args(argv)
+
+    import fake_spoonacular
+    server = fake_spoonacular.start_server(latency=0)
+
+    # Configure the app before it is imported
+    workdir = tempfile.mkdtemp(prefix='meal-planner-profiling-')
+    os.environ['SPOONACULAR_BASE_URL'] = server.base_url
+    os.environ['DATABASE_URL'] = f"sqlite:///{workdir}/bench.db"
+    os.environ['RECIPE_CACHE_PATH'] = f"{workdir}/recipe_cache.db"
+    os.environ['SPOONACULAR_QUOTA_PATH'] = f"{workdir}/quota.db"
+    os.environ['PROFILE_DIR'] = f"{workdir}/profiles"
+    os.environ['ASYNC_PLAN_JOBS'] = '0'
+    os.environ.setdefault('SPOONACULAR_RATE_LIMIT', '0')
+    os.environ.setdefault('SPOONACULAR_DAILY_QUOTA', '0')
+    os.environ.setdefault('SESSION_SECRET', 'benchmark')
+
+    import logging
+    logging.disable(logging.ERROR)
+
+    import main as _  # noqa: F401  (registers the routes)
+    from app import app
+    import profiling
+
+    client = app.test_client()
+    form = {'calorie_target': '2000', 'diet_type': 'balanced'}
+
+    # Fill the recipe cache and make a plan to view
+    location = client.post('/generate_plan', data=form).headers['Location']
+    plan_path = f"/api/plan/{location.rsplit('/', 1)[1]}"
+
+    routes = {
+        'generate_plan': lambda: client.post('/generate_plan', data=form),
+        'plan_json': lambda: client.get(plan_path)
+    }
+
+    results = {'iterations': args.iterations, 'rates': {}}
+    for rate in [float(rate) for rate in args.rates.split(',')]:
+        profiling.SAMPLE_RATE = rate
+        timings = {}
+        for name, request in routes.items():
+            samples = []
+            for _ in range(args.iterations):
+                start = time.perf_counter()
+                request()
+                samples.append(time.perf_counter() - start)
+            samples.sort()
+            timings[name] = {
+                'p50_ms': round(statistics.median(samples) * 1000, 2),
+                'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2)
+            }
+        results['rates'][str(rate)] = timings
+
+    results['profiles_saved'] = len(profiling.saved(profiling.KEEP))
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Similar Recipe Benchmark
+
+Times k-nearest-neighbour queries on similar_recipes.NutritionTree over
+synthetic recipes, with and without diet and meal type filters, and checks
+every answer against a brute-force scan of all recipes:
+
+    python -m benchmarks.similar --recipes 100000 --queries 2000
+
+Results are printed as JSON.
+"""
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import numpy as np
+
+
+def synthetic_recipes(count, seed=0):
+    """
+    Build recipe IDs, nutrition points and tag bits shaped like the fake Spoonacular recipes
+    """
+    from similar_recipes import MEAL_TYPE_BITS
+    from dietary import VEGETARIAN, VEGAN, GLUTEN_FREE, DAIRY_FREE
+
+    rng = np.random.default_rng(seed)
+    calories = rng.uniform(80, 900, count)
+    protein_share, carbs_share = rng.uniform(0.1, 0.35, count), rng.uniform(0.3, 0.65, count)
+    fat_share = np.maximum(0.05, 1 - protein_share - carbs_share)
+    points = np.column_stack((
+        calories, calories * protein_share / 4, calories * carbs_share / 4, calories * fat_share / 9,
+        rng.uniform(0, 12, count)
+    ))
+
+    vegan = rng.random(count) < 0.15
+    tags = np.where(vegan, VEGETARIAN | VEGAN | DAIRY_FREE, 0)
+    tags |= np.where(rng.random(count) < 0.3, VEGETARIAN, 0)
+    tags |= np.where(rng.random(count) < 0.4, GLUTEN_FREE, 0)
+    tags |= np.where(rng.random(count) < 0.4, DAIRY_FREE, 0)
+    meal_bits = np.array(list(MEAL_TYPE_BITS.values()))
+    tags |= meal_bits[rng.integers(0, len(meal_bits), count)]
+
+    ids = rng.permutation(count * 10)[:count] + 1
+    return ids, points, tags
+
+
+def brute_force(tree, point, k, required, exclude):
+    """
+    Return the k nearest recipe IDs by scanning every recipe
+    """
+    keep = ((tree.tags & required) == required) & ~np.isin(tree.ids, list(exclude))
+    distances = ((tree.points[keep] - point) ** 2).sum(axis=1)
+    return [int(recipe_id) for recipe_id in tree.ids[keep][np.argsort(distances, kind='stable')[:k]]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark nearest-neighbour recipe queries")
+    parser.add_argument('--recipes', type=int, default=100000, help="Number of recipes to index")
+    parser.add_argument('--queries', type=int, default=2000, help="Queries per filter")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours per query")
+    parser.add_argument('--verify', type=int, default=200, help="Queries per filter checked against a full scan")
+    args = parser.parse_args(argv)
+
+    from similar_recipes import NutritionTree, MEAL_TYPE_BITS
+    from dietary import VEGAN, GLUTEN_FREE
+
+    ids, points, tags = synthetic_recipes(args.recipes)
+
+    started = time.perf_counter()
+    tree = NutritionTree(ids, points, tags)
+    build_seconds = time.perf_counter() - started
+
+    filters = {
+        'none': 0,
+        'lunch': MEAL_TYPE_BITS['lunch'],
+        'vegan_gluten_free_dinner': VEGAN | GLUTEN_FREE | MEAL_TYPE_BITS['dinner']
+    }
+    rng = np.random.default_rng(1)
+    queries = {}
+    for name, required in filters.items():
+        samples, mismatches = [], 0
+        for n, recipe_id in enumerate(rng.choice(tree.ids, args.queries)):
+            point, _ = tree.point(int(recipe_id))
+            exclude = {int(recipe_id)}
+            start = time.perf_counter()
+            results = tree.query(point, args.k, required, exclude)
+            samples.append(time.perf_counter() - start)
+            if n < args.verify:
+                mismatches += [recipe for recipe, _ in results] != brute_force(tree, point, args.k, required, exclude)
+        samples.sort()
+        queries[name] = {
+            'median_us': round(statistics.median(samples) * 1e6, 1),
+            'p99_us': round(samples[int(len(samples) * 0.99)] * 1e6, 1),
+            'mismatches': mismatches
+        }
+
+    results = {
+        'recipes': args.recipes,
+        'leaves': len(tree.leaf_bounds),
+        'build_ms': round(build_seconds * 1000, 1),
+        'k': args.k,
+        'queries': queries
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
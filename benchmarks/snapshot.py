@@ -0,0 +1,165 @@
+"""
+Recipe Snapshot Benchmark
+
+Writes --recipes synthetic recipes to a recipe snapshot (see
+recipe_snapshot.py) and to an NDJSON file, then forks --workers processes
+for each way of loading them:
+- snapshot: map the snapshot, look up random recipes and scan the calories
+  of every recipe
+- dicts: read the NDJSON file into a dict of recipe dicts, then make the
+  same lookups and scan
+
+Every worker reports its load time, lookup latency and how much its RSS,
+PSS and private memory grew, from /proc/self/smaps_rollup, once every
+worker has finished its reads. Linux only; results are printed as JSON.
+
+    python -m benchmarks.snapshot --recipes 500000 --workers 4 --modes snapshot
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+
+def memory_kb():
+    """
+    Return this process's RSS, PSS and private memory in kB
+    """
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss_kb': fields.get('Rss', 0),
+        'pss_kb': fields.get('Pss', 0),
+        'private_kb': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+
+def write_files(directory, count):
+    """
+    Write count synthetic recipes to an NDJSON file and a snapshot of the same recipes
+    Returns the two paths and the seconds spent writing the snapshot
+    """
+    import fake_spoonacular
+    from meal_planner import parse_recipe
+    from nutrients import json_default
+    from recipe_catalog import read_records
+    from recipe_snapshot import write_snapshot
+
+    meal_types = ('breakfast', 'lunch', 'dinner', 'snack')
+    records_path = os.path.join(directory, 'recipes.ndjson')
+    with open(records_path, 'w') as f:
+        for recipe_id in range(1, count + 1):
+            recipe = parse_recipe(fake_spoonacular.make_recipe(recipe_id))
+            recipe['mealTypes'] = [meal_types[recipe_id % len(meal_types)]]
+            f.write(json.dumps(recipe, default=json_default) + '\n')
+
+    snapshot_path = os.path.join(directory, 'recipes.snapshot')
+    started = time.perf_counter()
+    write_snapshot(snapshot_path, ((record, record.pop('mealTypes'), 0) for record in read_records(records_path)))
+    return records_path, snapshot_path, time.perf_counter() - started
+
+
+def worker(mode, path, lookups, barrier, results):
+    """
+    Load the recipes one way, read them and report the timings and memory growth
+    """
+    from recipe_snapshot import RecipeSnapshot
+    from recipe_catalog import read_records
+
+    before = memory_kb()
+    started = time.perf_counter()
+    if mode == 'snapshot':
+        store = RecipeSnapshot(path)
+        count = len(store)
+    else:
+        store = {record['id']: record for record in read_records(path)}
+        count = len(store)
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(os.getpid())
+    samples = []
+    for _ in range(lookups):
+        recipe_id = rng.randint(1, count)
+        start = time.perf_counter()
+        recipe = store.get_many([recipe_id])[recipe_id] if mode == 'snapshot' else store[recipe_id]
+        samples.append(time.perf_counter() - start)
+        assert recipe['id'] == recipe_id
+
+    started = time.perf_counter()
+    if mode == 'snapshot':
+        mean_calories = float(store.column('calories').mean())
+    else:
+        mean_calories = sum(recipe['nutrition']['calories'] for recipe in store.values()) / count
+    scan_seconds = time.perf_counter() - started
+
+    # Pages every worker has read count as shared only once they all have
+    barrier.wait()
+    after = memory_kb()
+    results.put({
+        'load_ms': round(load_seconds * 1000, 2),
+        'lookup_median_us': round(statistics.median(samples) * 1e6, 1),
+        'scan_ms': round(scan_seconds * 1000, 2),
+        'mean_calories': round(mean_calories, 2),
+        **{f"{name}_growth": after[name] - before[name] for name in after}
+    })
+    barrier.wait()
+
+
+def measure(mode, path, args):
+    """
+    Run the workers of one mode and average what they report
+    """
+    context = multiprocessing.get_context('fork')
+    barrier, results = context.Barrier(args.workers), context.Queue()
+    processes = [
+        context.Process(target=worker, args=(mode, path, args.lookups, barrier, results))
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    return {
+        name: round(statistics.mean(report[name] for report in reports), 2)
+        for name in reports[0]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark recipe snapshots against loading recipe dicts")
+    parser.add_argument('--recipes', type=int, default=100000, help="Synthetic recipes to write")
+    parser.add_argument('--workers', type=int, default=2, help="Processes loading the recipes at once")
+    parser.add_argument('--lookups', type=int, default=2000, help="Random recipe lookups per worker")
+    parser.add_argument('--modes', default='snapshot,dicts', help="Comma-separated modes to run")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='meal-planner-snapshot-')
+    records_path, snapshot_path, write_seconds = write_files(directory, args.recipes)
+    paths = {'snapshot': snapshot_path, 'dicts': records_path}
+
+    results = {
+        'recipes': args.recipes,
+        'workers': args.workers,
+        'snapshot_write_s': round(write_seconds, 2),
+        'snapshot_mb': round(os.path.getsize(snapshot_path) / 1e6, 1),
+        'ndjson_mb': round(os.path.getsize(records_path) / 1e6, 1),
+        'modes': {mode: measure(mode, paths[mode], args) for mode in args.modes.split(',')}
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
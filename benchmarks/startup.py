@@ -0,0 +1,177 @@
+"""
+Startup Benchmark
+
+Starts the app under gunicorn, as deployed, with and without preloading
+(see preload.py) and measures for each:
+- Time from launching gunicorn to its first successful response
+- Latency of the first similar-recipe lookups, which need the recipe indexes
+- Per-worker memory: RSS, PSS (shared pages split between the processes
+  sharing them) and private memory, from /proc/<pid>/smaps_rollup
+
+A fake Spoonacular server stands in for the real one, and a throwaway
+recipe catalog of --recipes synthetic recipes is ingested first so the
+indexes have something to load. Linux only; results are printed as JSON.
+
+    python -m benchmarks.startup --workers 4 --recipes 50000
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def build_catalog(path, count):
+    """
+    Ingest count synthetic recipes into a catalog at path
+    """
+    import fake_spoonacular
+    from recipe_catalog import RecipeCatalog
+
+    meal_types = ('breakfast', 'lunch', 'dinner', 'snack')
+    records = (
+        dict(fake_spoonacular.make_recipe(recipe_id), mealTypes=[meal_types[recipe_id % len(meal_types)]])
+        for recipe_id in range(1, count + 1)
+    )
+    RecipeCatalog(path).ingest(records)
+
+
+def workers_of(pid):
+    """
+    Return the PIDs of a process's children
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_kb(pid):
+    """
+    Return the RSS, PSS and private memory of a process in kB
+    """
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss_kb': fields.get('Rss', 0),
+        'pss_kb': fields.get('Pss', 0),
+        'private_kb': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+
+def measure(mode, args, env, recipe_id):
+    """
+    Start gunicorn in one mode and return its startup timings and memory
+    """
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(env, GUNICORN_PRELOAD='1' if mode == 'preload' else '0')
+    command = [
+        sys.executable, '-m', 'gunicorn', '--bind', f"127.0.0.1:{port}", '--workers', str(args.workers),
+        '--log-level', 'warning', 'main:app'
+    ]
+
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        first_response = None
+        while time.perf_counter() - started < args.timeout:
+            try:
+                if requests.get(f"{base_url}/api/guidelines", timeout=1).status_code == 200:
+                    first_response = time.perf_counter() - started
+                    break
+            except requests.RequestException:
+                time.sleep(0.02)
+        if first_response is None:
+            raise RuntimeError(f"gunicorn ({mode}) did not answer within {args.timeout}s")
+
+        # Lookups spread over the workers; without preloading a worker may still be building its indexes
+        similar_ms = []
+        for _ in range(args.workers * 4):
+            start = time.perf_counter()
+            requests.get(f"{base_url}/api/recipe/{recipe_id}/similar", timeout=args.timeout)
+            similar_ms.append(round((time.perf_counter() - start) * 1000, 2))
+
+        workers = [memory_kb(pid) for pid in workers_of(server.pid)]
+        master = memory_kb(server.pid)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    return {
+        'time_to_first_request_ms': round(first_response * 1000, 1),
+        'first_similar_ms': similar_ms[0],
+        'max_similar_ms': max(similar_ms),
+        'master': master,
+        'workers': len(workers),
+        'worker_rss_kb': round(sum(w['rss_kb'] for w in workers) / max(1, len(workers))),
+        'worker_pss_kb': round(sum(w['pss_kb'] for w in workers) / max(1, len(workers))),
+        'worker_private_kb': round(sum(w['private_kb'] for w in workers) / max(1, len(workers))),
+        'total_pss_kb': master['pss_kb'] + sum(w['pss_kb'] for w in workers)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark gunicorn startup with and without preloading")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers")
+    parser.add_argument('--recipes', type=int, default=50000, help="Synthetic recipes in the catalog")
+    parser.add_argument('--modes', default='preload,no-preload', help="Comma-separated modes to run")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds to wait for gunicorn to answer")
+    args = parser.parse_args(argv)
+
+    import fake_spoonacular
+    server = fake_spoonacular.start_server()
+
+    workdir = tempfile.mkdtemp(prefix='meal-planner-startup-')
+    env = dict(
+        os.environ,
+        SPOONACULAR_BASE_URL=server.base_url,
+        DATABASE_URL=f"sqlite:///{workdir}/startup.db",
+        RECIPE_CACHE_PATH=f"{workdir}/recipe_cache.db",
+        RECIPE_CATALOG_PATH=f"{workdir}/recipe_catalog.db",
+        SPOONACULAR_QUOTA_PATH=f"{workdir}/quota.db",
+        PROMETHEUS_MULTIPROC_DIR=f"{workdir}/metrics",
+        SESSION_SECRET='benchmark'
+    )
+    # Modules imported here read their paths from the environment
+    os.environ.update(env)
+
+    started = time.perf_counter()
+    build_catalog(env['RECIPE_CATALOG_PATH'], args.recipes)
+    ingest_seconds = time.perf_counter() - started
+
+    # Similar recipes are looked up for the first synthetic recipe
+    recipe_id = 1
+
+    results = {
+        'workers': args.workers,
+        'recipes': args.recipes,
+        'ingest_seconds': round(ingest_seconds, 2),
+        'modes': {mode: measure(mode, args, env, recipe_id) for mode in args.modes.split(',')}
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Meal Planner Benchmark Suite
+
+Starts a local fake Spoonacular server (see fake_spoonacular.py) and measures:
+- generate_meal_plan called directly
+- POST /generate_plan, GET /plan/<id> and POST /regenerate_day through the Flask test client
+- GET /api/plan/<id>, and both plan views again as conditional GETs with the ETag of the last response
+
+For each scenario it reports p50/p95/p99 latency, upstream round trips and
+database queries per operation, response status codes and peak Python memory.
+Everything runs against a throwaway database and recipe cache. A scenario with
+any error responses (4xx/5xx) is marked failed and reports no timings, since
+they would time the error path rather than the route.
+
+    python -m benchmarks.suite --iterations 50 --latency 0.05 --output bench.json
+    python -m benchmarks.suite --compare bench.json
+
+--cold clears the recipe cache before every iteration, so each one pays the
+full upstream cost; by default only the first iteration of a run is cold.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+
+PREFERENCES = {
+    'calorie_target': '2000',
+    'diet_type': 'balanced',
+    'allergens': ''
+}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def is_error(status):
+    """
+    Whether an operation's status is an HTTP error rather than 'ok', a success or a redirect
+    """
+    return isinstance(status, int) and status >= 400
+
+
+def summarize(latencies, upstream_calls, db_queries, statuses, peak_memory):
+    errors = sum(1 for status in statuses if is_error(status))
+    if errors:
+        return {
+            'iterations': len(latencies),
+            'failed': True,
+            'errors': errors,
+            'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses), key=str)}
+        }
+    return {
+        'iterations': len(latencies),
+        'failed': False,
+        'errors': 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'upstream_calls_per_op': round(sum(upstream_calls) / len(upstream_calls), 2),
+        'db_queries_per_op': round(sum(db_queries) / len(db_queries), 2),
+        'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses), key=str)},
+        'peak_memory_kb': round(peak_memory / 1024, 1)
+    }
+
+
+class Runner:
+    """
+    Times operations while counting upstream calls and database queries
+    """
+
+    def __init__(self, db, cache, cold):
+        from sqlalchemy import event
+
+        self.cache = cache
+        self.cold = cold
+        self.queries = 0
+        event.listen(db.engine, 'before_cursor_execute', self._count_query)
+
+    def _count_query(self, *args, **kwargs):
+        self.queries += 1
+
+    def run(self, name, iterations, operation):
+        import upstream
+
+        latencies, upstream_calls, db_queries, statuses = [], [], [], []
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+
+        for i in range(iterations):
+            if self.cold or i == 0:
+                self.cache.clear()
+            self.queries = 0
+            with upstream.track_calls() as calls:
+                start = time.perf_counter()
+                status = operation(i)
+                latencies.append(time.perf_counter() - start)
+            upstream_calls.append(calls.total)
+            db_queries.append(self.queries)
+            statuses.append(status)
+
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        result = summarize(latencies, upstream_calls, db_queries, statuses, peak)
+        if result['failed']:
+            print(f"{name}: FAILED, {result['errors']} of {iterations} responses were errors "
+                  f"{result['statuses']}", file=sys.stderr)
+        else:
+            print(f"{name}: p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+                  f"{result['upstream_calls_per_op']} upstream calls/op", file=sys.stderr)
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """
+    Print how every scenario's latency and call counts moved against a baseline run
+    """
+    for name, result in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        if result.get('failed') or before.get('failed'):
+            print(f"{name}: not compared, {'this' if result.get('failed') else 'the baseline'} run failed")
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'upstream_calls_per_op', 'db_queries_per_op'):
+            old, new = before.get(metric), result.get(metric)
+            if old:
+                changes.append(f"{metric} {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+            else:
+                changes.append(f"{metric} {old} -> {new}")
+        print(f"{name}: " + ", ".join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark meal plan generation and the Flask routes")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help="Fake upstream latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0, help="Fraction of fake upstream requests that fail")
+    parser.add_argument('--payload-size', type=int, default=0, help="Extra bytes in every fake recipe")
+    parser.add_argument('--cold', action='store_true', help="Clear the recipe cache before every iteration")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="Compare against the JSON results of an earlier run")
+    args = parser.parse_args(argv)
+
+    import fake_spoonacular
+    server = fake_spoonacular.start_server(
+        latency=args.latency, error_rate=args.error_rate, payload_size=args.payload_size
+    )
+
+    # Configure the app before it is imported
+    workdir = tempfile.mkdtemp(prefix='meal-planner-bench-')
+    os.environ['SPOONACULAR_BASE_URL'] = server.base_url
+    os.environ['DATABASE_URL'] = f"sqlite:///{workdir}/bench.db"
+    os.environ['RECIPE_CACHE_PATH'] = f"{workdir}/recipe_cache.db"
+    os.environ['ASYNC_PLAN_JOBS'] = '0'
+    os.environ['SPOONACULAR_QUOTA_PATH'] = f"{workdir}/quota.db"
+    # Measure the app rather than the limiter unless a limit is asked for
+    os.environ.setdefault('SPOONACULAR_RATE_LIMIT', '0')
+    os.environ.setdefault('SPOONACULAR_DAILY_QUOTA', '0')
+    os.environ.setdefault('SESSION_SECRET', 'benchmark')
+
+    import logging
+    logging.disable(logging.ERROR)
+
+    import main as _  # noqa: F401  (registers the routes)
+    from app import app, db
+    from meal_planner import generate_meal_plan
+    from recipe_cache import cache
+
+    client = app.test_client()
+    plan_ids = []
+
+    def direct(i):
+        generate_meal_plan({'calorie_target': 2000})
+        return 'ok'
+
+    def post_generate(i):
+        response = client.post('/generate_plan', data=PREFERENCES)
+        if response.status_code == 302 and '/plan/' in response.location:
+            plan_ids.append(int(response.location.rsplit('/', 1)[1]))
+        return response.status_code
+
+    def view(i):
+        return client.get(f"/plan/{plan_ids[i % len(plan_ids)]}").status_code
+
+    def view_json(i):
+        return client.get(f"/api/plan/{plan_ids[i % len(plan_ids)]}").status_code
+
+    def conditional(path):
+        etags = {}
+
+        def operation(i):
+            # Keep viewing one plan so every request after the first is conditional
+            url = path.format(plan_ids[0])
+            headers = {'If-None-Match': etags[url]} if url in etags else {}
+            response = client.get(url, headers=headers)
+            if response.headers.get('ETag'):
+                etags[url] = response.headers['ETag']
+            return response.status_code
+        return operation
+
+    def regenerate(i):
+        data = {'plan_id': plan_ids[i % len(plan_ids)], 'day_index': i % 7}
+        return client.post('/regenerate_day', data=data).status_code
+
+    results = {
+        'commit': git_commit(),
+        'config': {
+            'iterations': args.iterations,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'payload_size': args.payload_size,
+            'cold': args.cold
+        },
+        'scenarios': {}
+    }
+
+    with app.app_context():
+        runner = Runner(db, cache, args.cold)
+        scenarios = results['scenarios']
+        scenarios['generate_meal_plan'] = runner.run('generate_meal_plan', args.iterations, direct)
+        scenarios['post_generate_plan'] = runner.run('POST /generate_plan', args.iterations, post_generate)
+        if plan_ids:
+            scenarios['get_plan'] = runner.run('GET /plan/<id>', args.iterations, view)
+            scenarios['get_plan_conditional'] = runner.run(
+                'GET /plan/<id> (If-None-Match)', args.iterations, conditional('/plan/{}')
+            )
+            scenarios['get_plan_json'] = runner.run('GET /api/plan/<id>', args.iterations, view_json)
+            scenarios['get_plan_json_conditional'] = runner.run(
+                'GET /api/plan/<id> (If-None-Match)', args.iterations, conditional('/api/plan/{}')
+            )
+            scenarios['post_regenerate_day'] = runner.run('POST /regenerate_day', args.iterations, regenerate)
+
+    server.shutdown()
+    results['upstream_requests_received'] = server.request_counts
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
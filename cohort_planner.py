@@ -0,0 +1,165 @@
+"""
+Cohort Batch Planning
+
+Generates plans for many clients at once, such as the residents of a care
+home or the staff of a cafeteria, doing the work they share only once:
+- Profiles are grouped by dietary profile and the calorie bands of their meals
+- The candidate pools of every group are built together, so each distinct
+  search runs once and all of their recipes are loaded in one bulk lookup
+- Plans are generated from their group's pools on a pool of worker processes;
+  choosing meals is CPU-bound, so throughput scales with the number of cores
+- All plans are stored in bulk and scored for USDA compliance in one batch
+
+Every web worker starts its own pool on its first cohort request. COHORT_WORKERS
+sets the processes in each pool; by default the host's cores are split between
+the WEB_CONCURRENCY web workers, so a host isn't oversubscribed by one pool
+per web worker with a process per core each. Pools are shut down when their web
+worker exits.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import upstream
+from meal_planner import (
+    build_shared_candidate_pools, candidate_pool_keys, meal_calorie_budgets, generate_meal_plans, PLAN_DEADLINE
+)
+from plan_store import save_meal_plans
+from usda_guidelines import check_compliance_batch
+
+# Web worker processes on the host; gunicorn takes its worker count from the same variable
+WEB_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+
+# Worker processes generating plans in each web process; 1 generates them inline
+WORKERS = int(os.environ.get("COHORT_WORKERS", max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+
+# How worker processes are started; forkserver avoids forking a process that has threads running
+START_METHOD = os.environ.get("COHORT_START_METHOD", "forkserver")
+
+# Profiles per worker task; each task carries a copy of its group's pools
+CHUNK_SIZE = int(os.environ.get("COHORT_CHUNK_SIZE", 25))
+
+_lock = threading.Lock()
+_state = {'pid': None, 'executor': None}
+
+
+def _get_executor():
+    with _lock:
+        # Process pools don't survive a fork, so each web worker starts its own
+        if _state['pid'] != os.getpid():
+            context = multiprocessing.get_context(START_METHOD)
+            if START_METHOD == 'forkserver':
+                # Import the planner once in the server rather than in every worker
+                context.set_forkserver_preload(['meal_planner'])
+            _state['executor'] = ProcessPoolExecutor(max_workers=WORKERS, mp_context=context)
+            _state['pid'] = os.getpid()
+        return _state['executor']
+
+
+def _reset_executor():
+    with _lock:
+        _state['pid'] = None
+        _state['executor'] = None
+
+
+def shutdown():
+    """
+    Stop this process's worker pool, if it has started one
+    """
+    with _lock:
+        executor = _state['executor'] if _state['pid'] == os.getpid() else None
+        _state['pid'] = None
+        _state['executor'] = None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown)
+
+
+def _generate(tasks, profiles, days, workers):
+    """
+    Generate the plans of every (profile indexes, pools) task, in task order
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        return [generate_meal_plans([profiles[i] for i in indexes], pools, days) for indexes, pools in tasks]
+
+    try:
+        executor = _get_executor()
+        futures = [
+            executor.submit(generate_meal_plans, [profiles[i] for i in indexes], pools, days)
+            for indexes, pools in tasks
+        ]
+        return [future.result() for future in futures]
+    except BrokenProcessPool as e:
+        logging.error(f"Cohort worker pool failed, generating plans inline: {str(e)}")
+        _reset_executor()
+        return [generate_meal_plans([profiles[i] for i in indexes], pools, days) for indexes, pools in tasks]
+
+
+def plan_cohort(profiles, days=7, workers=None):
+    """
+    Generate, store and score a plan for every preference profile
+    Returns (results, stats): one {'plan_id', 'compliance'} per profile in
+    order, and counts and timings for the whole batch
+    The caller is responsible for committing
+    """
+    workers = WORKERS if workers is None else workers
+    started = time.perf_counter()
+
+    # Profiles whose meals would run the same searches share their candidate pools
+    budgets = [meal_calorie_budgets(preferences.get('calorie_target', 2000)) for preferences in profiles]
+    groups = {}
+    for index, (preferences, meal_calories) in enumerate(zip(profiles, budgets)):
+        key = tuple(candidate_pool_keys(preferences, meal_calories).values())
+        groups.setdefault(key, []).append(index)
+    groups = list(groups.values())
+
+    with upstream.deadline(PLAN_DEADLINE), upstream.track_calls() as calls:
+        group_pools = build_shared_candidate_pools([(profiles[indexes[0]], budgets[indexes[0]]) for indexes in groups])
+    pools_built = time.perf_counter()
+
+    tasks = [
+        (indexes[start:start + CHUNK_SIZE], pools)
+        for indexes, pools in zip(groups, group_pools)
+        for start in range(0, len(indexes), CHUNK_SIZE)
+    ]
+    plans = [None] * len(profiles)
+    profile_pools = [None] * len(profiles)
+    for (indexes, pools), generated in zip(tasks, _generate(tasks, profiles, days, workers)):
+        for index, meal_plan in zip(indexes, generated):
+            plans[index] = meal_plan
+            profile_pools[index] = pools
+    generated_at = time.perf_counter()
+
+    plan_ids = save_meal_plans(list(zip(plans, profiles, profile_pools)))
+    stored_at = time.perf_counter()
+    compliance = check_compliance_batch(plans, [preferences.get('calorie_target', 2000) for preferences in profiles])
+    seconds = time.perf_counter() - started
+
+    logging.info(
+        f"Planned {len(profiles)} profiles in {len(groups)} groups with {calls.total} upstream round trips "
+        f"in {seconds:.2f}s"
+    )
+
+    results = [
+        {'plan_id': plan_id, 'compliance': plan_compliance}
+        for plan_id, plan_compliance in zip(plan_ids, compliance)
+    ]
+    stats = {
+        'profiles': len(profiles),
+        'groups': len(groups),
+        'workers': workers,
+        'upstream_calls': calls.total,
+        'pool_seconds': round(pools_built - started, 3),
+        'generate_seconds': round(generated_at - pools_built, 3),
+        'store_seconds': round(stored_at - generated_at, 3),
+        'seconds': round(seconds, 3),
+        'plans_per_second': round(len(profiles) / seconds, 1) if seconds else None
+    }
+    return results, stats
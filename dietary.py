@@ -0,0 +1,254 @@
+"""
+Dietary Profiles
+
+Compiles meal preferences into a DietProfile once and describes recipes
+with the same bits:
+- Diet restrictions, the diet type and every allergen to avoid are bits of
+  a single mask
+- Allergen names are normalized to Spoonacular's intolerance vocabulary
+  ('Peanuts', ' peanut' and 'groundnut' are all 'peanut')
+- A recipe's mask holds what it is known to be (vegetarian, low-carb, free
+  of egg...), so a recipe suits a profile when its mask has every bit of the
+  profile's, one AND over any array of recipe masks
+- Allergens outside the vocabulary are kept by name and passed on to
+  Spoonacular; local recipes are checked for them by ingredient name
+- Equivalent preferences compile to equal profiles, so a profile keys
+  cached searches, coalesced lookups and shared candidate pools
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Diet restriction bits
+VEGETARIAN = 1
+VEGAN = 2
+GLUTEN_FREE = 4
+DAIRY_FREE = 8
+
+# Diet type bits
+LOW_CARB = 16
+HIGH_PROTEIN = 32
+LOW_FAT = 64
+
+DIET_TYPE_FLAGS = {
+    'low-carb': LOW_CARB,
+    'high-protein': HIGH_PROTEIN,
+    'low-fat': LOW_FAT
+}
+
+# Bits of recipes free of each of Spoonacular's intolerances; dairy and
+# gluten share the bits of the matching diet restrictions. Masks are stored
+# in the catalog and cache, so bits must never be renumbered
+EGG_FREE = 1 << 7
+GRAIN_FREE = 1 << 8
+PEANUT_FREE = 1 << 9
+SEAFOOD_FREE = 1 << 10
+SESAME_FREE = 1 << 11
+SHELLFISH_FREE = 1 << 12
+SOY_FREE = 1 << 13
+SULFITE_FREE = 1 << 14
+TREE_NUT_FREE = 1 << 15
+WHEAT_FREE = 1 << 16
+
+ALLERGEN_FLAGS = {
+    'dairy': DAIRY_FREE,
+    'egg': EGG_FREE,
+    'gluten': GLUTEN_FREE,
+    'grain': GRAIN_FREE,
+    'peanut': PEANUT_FREE,
+    'seafood': SEAFOOD_FREE,
+    'sesame': SESAME_FREE,
+    'shellfish': SHELLFISH_FREE,
+    'soy': SOY_FREE,
+    'sulfite': SULFITE_FREE,
+    'tree nut': TREE_NUT_FREE,
+    'wheat': WHEAT_FREE
+}
+
+# Other names people give the allergens, after lowercasing and trimming
+ALLERGEN_ALIASES = {
+    'milk': 'dairy',
+    'lactose': 'dairy',
+    'eggs': 'egg',
+    'peanuts': 'peanut',
+    'groundnut': 'peanut',
+    'groundnuts': 'peanut',
+    'fish': 'seafood',
+    'shrimp': 'shellfish',
+    'prawn': 'shellfish',
+    'prawns': 'shellfish',
+    'crab': 'shellfish',
+    'lobster': 'shellfish',
+    'soya': 'soy',
+    'soybean': 'soy',
+    'soybeans': 'soy',
+    'sulphite': 'sulfite',
+    'sulfites': 'sulfite',
+    'sulphites': 'sulfite',
+    'nuts': 'tree nut',
+    'tree nuts': 'tree nut',
+    'treenut': 'tree nut',
+    'treenuts': 'tree nut',
+    'grains': 'grain'
+}
+
+# Bits a recipe has whenever the Spoonacular field of the same name is true
+RECIPE_FIELD_FLAGS = {
+    'vegetarian': VEGETARIAN | SEAFOOD_FREE | SHELLFISH_FREE,
+    'vegan': VEGETARIAN | VEGAN | DAIRY_FREE | EGG_FREE | SEAFOOD_FREE | SHELLFISH_FREE,
+    'glutenFree': GLUTEN_FREE | WHEAT_FREE,
+    'dairyFree': DAIRY_FREE
+}
+
+# complexSearch parameters for the diet restrictions
+SEARCH_PARAM_FLAGS = {
+    'vegetarian': VEGETARIAN,
+    'vegan': VEGAN,
+    'glutenFree': GLUTEN_FREE,
+    'dairyFree': DAIRY_FREE
+}
+
+# Allergens the diet restriction parameters already exclude
+RESTRICTION_ALLERGENS = ('dairy', 'gluten')
+
+DietProfile = namedtuple('DietProfile', ['mask', 'other_allergens'])
+
+
+def normalize_allergen(name):
+    """
+    Return the vocabulary name of an allergen, or its cleaned-up name if it isn't in the vocabulary
+    """
+    name = re.sub(r'[\s_-]+', ' ', str(name).strip().lower())
+    return ALLERGEN_ALIASES.get(name, name)
+
+
+def normalize_allergens(allergens):
+    """
+    Split a comma-separated allergen string (or list) into sorted, de-duplicated normalized names
+    """
+    if isinstance(allergens, str):
+        allergens = allergens.split(',')
+    return sorted({normalize_allergen(name) for name in allergens or () if str(name).strip()})
+
+
+def format_allergens(allergens):
+    """
+    Return the canonical comma-separated form of an allergen string, as stored with preferences and users
+    """
+    return ','.join(normalize_allergens(allergens))
+
+
+def compile_preferences(preferences):
+    """
+    Return the DietProfile for a preferences dict
+    """
+    return _compile(
+        preferences.get('diet_type', 'balanced'),
+        bool(preferences.get('vegetarian')),
+        bool(preferences.get('vegan')),
+        bool(preferences.get('gluten_free')),
+        bool(preferences.get('dairy_free')),
+        preferences.get('allergens') or ''
+    )
+
+
+@lru_cache(maxsize=1024)
+def _compile(diet_type, vegetarian, vegan, gluten_free, dairy_free, allergens):
+    mask = DIET_TYPE_FLAGS.get(diet_type, 0)
+    if vegetarian:
+        mask |= VEGETARIAN
+    if vegan:
+        mask |= VEGAN
+    if gluten_free:
+        mask |= GLUTEN_FREE
+    if dairy_free:
+        mask |= DAIRY_FREE
+
+    other_allergens = []
+    for allergen in normalize_allergens(allergens):
+        if allergen in ALLERGEN_FLAGS:
+            mask |= ALLERGEN_FLAGS[allergen]
+        else:
+            other_allergens.append(allergen)
+
+    return DietProfile(mask, tuple(other_allergens))
+
+
+def profile_allergens(profile):
+    """
+    Return the normalized names of every allergen a profile avoids
+    """
+    known = [allergen for allergen, flag in ALLERGEN_FLAGS.items() if profile.mask & flag]
+    return sorted(known + list(profile.other_allergens))
+
+
+def search_params(profile):
+    """
+    Return the complexSearch parameters that restrict a search to a profile
+    """
+    params = {param: 'true' for param, flag in SEARCH_PARAM_FLAGS.items() if profile.mask & flag}
+
+    for diet_type, flag in DIET_TYPE_FLAGS.items():
+        if profile.mask & flag:
+            params['diet'] = diet_type
+
+    intolerances = [
+        allergen for allergen in profile_allergens(profile) if allergen not in RESTRICTION_ALLERGENS
+    ]
+    if intolerances:
+        params['intolerances'] = ','.join(intolerances)
+
+    return params
+
+
+def search_mask(params):
+    """
+    Return the bits every result of a complexSearch with the given parameters has
+    """
+    mask = DIET_TYPE_FLAGS.get(params.get('diet'), 0)
+    for param in SEARCH_PARAM_FLAGS:
+        if params.get(param) == 'true':
+            mask |= RECIPE_FIELD_FLAGS[param]
+    for allergen in normalize_allergens(params.get('intolerances')):
+        mask |= ALLERGEN_FLAGS.get(allergen, 0)
+    return mask
+
+
+def contains_allergens(recipe, allergens):
+    """
+    Whether a recipe's title or any of its ingredients names one of the given allergens
+    """
+    names = [recipe.get('title') or ''] + [ingredient.get('name') or '' for ingredient in recipe.get('ingredients') or ()]
+    text = ' '.join(names).lower()
+    return any(re.search(rf"\b{re.escape(allergen)}", text) for allergen in allergens)
+
+
+def recipe_mask(record, nutrition):
+    """
+    Return the bits of a recipe: its Spoonacular diet fields (or a mask it
+    already carries) and the diet types its share of calories from each
+    macronutrient qualifies it for
+    """
+    mask = record.get('diet_mask') or 0
+    for field, flags in RECIPE_FIELD_FLAGS.items():
+        if record.get(field):
+            mask |= flags
+
+    calories = (nutrition or {}).get('calories') or 0
+    if calories > 0:
+        if (nutrition.get('carbs') or 0) * 4 / calories < 0.26:
+            mask |= LOW_CARB
+        if (nutrition.get('protein') or 0) * 4 / calories >= 0.30:
+            mask |= HIGH_PROTEIN
+        if (nutrition.get('fat') or 0) * 9 / calories < 0.30:
+            mask |= LOW_FAT
+
+    return mask
+
+
+def suits(recipe_masks, mask):
+    """
+    Whether recipes with the given masks have every bit of mask; takes a
+    single mask or a numpy array of them
+    """
+    return (recipe_masks & mask) == mask
@@ -0,0 +1,254 @@
+"""
+Fake Spoonacular Server
+
+A small local stand-in for the Spoonacular endpoints used by meal_planner:
+- /recipes/complexSearch
+- /recipes/<id>/information
+- /recipes/informationBulk
+
+Recipes are generated deterministically from their ID, so the same ID always
+has the same title and nutrition. The server counts the requests it receives
+per endpoint, which makes it easy to check how many round trips a plan needs.
+
+Latency, error rate and payload size are configurable, so it can stand in for
+a slow or flaky upstream in benchmarks. With a daily quota it also sends
+Spoonacular's X-API-Quota-* headers and answers 402 once the quota is used up.
+
+Run it standalone and point the app at it:
+
+    python fake_spoonacular.py --port 8081 --latency 0.2 --error-rate 0.05
+    SPOONACULAR_BASE_URL=http://127.0.0.1:8081 gunicorn main:app
+
+or start it in-process with start_server().
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+INFORMATION_PATH = re.compile(r'^/recipes/(\d+)/information$')
+
+DIET_FLAGS = ('vegetarian', 'vegan', 'glutenFree', 'dairyFree')
+
+# Spoonacular point costs: a base cost per request plus a cost per result or extra recipe
+POINT_COSTS = {
+    '/recipes/complexSearch': (1, 0.01),
+    '/recipes/informationBulk': (1, 0.5)
+}
+
+
+def make_recipe(recipe_id, payload_size=0):
+    """
+    Build the Spoonacular information payload for a recipe ID
+    payload_size adds roughly that many bytes of extra summary text
+    """
+    rng = random.Random(recipe_id)
+    calories = rng.uniform(80, 900)
+
+    # Split calories into macros and convert to grams
+    protein_share, carbs_share = rng.uniform(0.1, 0.35), rng.uniform(0.3, 0.65)
+    fat_share = max(0.05, 1 - protein_share - carbs_share)
+
+    vegan = rng.random() < 0.15
+    recipe = {
+        'id': recipe_id,
+        'title': f"Test Recipe {recipe_id}",
+        'image': f"https://img.example.com/{recipe_id}-312x231.jpg",
+        'readyInMinutes': rng.randint(5, 90),
+        'servings': rng.randint(1, 6),
+        'sourceUrl': f"https://recipes.example.com/{recipe_id}",
+        'vegetarian': vegan or rng.random() < 0.3,
+        'vegan': vegan,
+        'glutenFree': rng.random() < 0.4,
+        'dairyFree': vegan or rng.random() < 0.4,
+        'nutrition': {
+            'nutrients': [
+                {'name': 'Calories', 'amount': round(calories, 2), 'unit': 'kcal'},
+                {'name': 'Protein', 'amount': round(calories * protein_share / 4, 2), 'unit': 'g'},
+                {'name': 'Carbohydrates', 'amount': round(calories * carbs_share / 4, 2), 'unit': 'g'},
+                {'name': 'Fat', 'amount': round(calories * fat_share / 9, 2), 'unit': 'g'},
+                {'name': 'Fiber', 'amount': round(rng.uniform(0, 12), 2), 'unit': 'g'},
+                # Derived from the amounts above so the random sequence of existing fields doesn't change
+                {'name': 'Saturated Fat', 'amount': round(calories * fat_share / 9 * 0.35, 2), 'unit': 'g'},
+                {'name': 'Sugar', 'amount': round(calories * carbs_share / 4 * 0.2, 2), 'unit': 'g'},
+                {'name': 'Sodium', 'amount': round(calories * 1.1 + recipe_id % 400, 2), 'unit': 'mg'}
+            ]
+        },
+        'extendedIngredients': [
+            {'name': f"ingredient {n}", 'amount': rng.randint(1, 500), 'unit': 'g'}
+            for n in range(rng.randint(3, 12))
+        ],
+        'analyzedInstructions': [
+            {'steps': [{'number': n + 1, 'step': f"Step {n + 1} of recipe {recipe_id}."} for n in range(rng.randint(2, 8))]}
+        ]
+    }
+    if payload_size:
+        recipe['summary'] = ('Lorem ipsum dolor sit amet. ' * (payload_size // 28 + 1))[:payload_size]
+    return recipe
+
+
+def search(params):
+    """
+    Return the complexSearch results for the given query parameters
+    Results honour the calorie range and diet flags of the query
+    """
+    number = int(params.get('number', 10))
+    min_calories = float(params.get('minCalories', 0))
+    max_calories = float(params.get('maxCalories', 10000))
+    flags = [flag for flag in DIET_FLAGS if params.get(flag) == 'true']
+
+    # Each distinct query walks its own deterministic sequence of IDs
+    query = json.dumps({k: v for k, v in params.items() if k not in ('apiKey', 'number', 'offset')}, sort_keys=True)
+    recipe_id = 100000 + zlib.crc32(query.encode()) % 900000
+
+    results = []
+    for _ in range(number * 500):
+        recipe_id += 1
+        recipe = make_recipe(recipe_id)
+        calories = recipe['nutrition']['nutrients'][0]['amount']
+        if min_calories <= calories <= max_calories and all(recipe[flag] for flag in flags):
+            results.append({'id': recipe_id, 'title': recipe['title'], 'image': recipe['image']})
+            if len(results) == number:
+                break
+
+    return {'results': results, 'offset': 0, 'number': number, 'totalResults': len(results)}
+
+
+class FakeSpoonacularHandler(BaseHTTPRequestHandler):
+    """
+    Request handler serving the fake endpoints
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        server = self.server
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path == '/recipes/complexSearch':
+            server.record('complexSearch')
+        elif url.path == '/recipes/informationBulk':
+            server.record('informationBulk')
+        elif INFORMATION_PATH.match(url.path):
+            server.record('information')
+
+        headers = server.charge(url.path, params)
+        if headers is None:
+            server.record('quota_exceeded')
+            self._send_json({'status': 'failure', 'message': 'Daily points limit reached'}, status=402)
+        elif server.error_rate and random.random() < server.error_rate:
+            server.record('errors')
+            self._send_json({'status': 'failure', 'message': 'Simulated upstream error'}, status=500)
+        elif url.path == '/recipes/complexSearch':
+            self._send_json(search(params), headers=headers)
+        elif url.path == '/recipes/informationBulk':
+            ids = [int(i) for i in params.get('ids', '').split(',') if i.strip().isdigit()]
+            self._send_json([make_recipe(recipe_id, server.payload_size) for recipe_id in ids], headers=headers)
+        elif INFORMATION_PATH.match(url.path):
+            recipe_id = int(INFORMATION_PATH.match(url.path).group(1))
+            self._send_json(make_recipe(recipe_id, server.payload_size), headers=headers)
+        else:
+            self._send_json({'status': 'failure', 'message': 'Not found'}, status=404)
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep test and benchmark output quiet
+        pass
+
+
+class FakeSpoonacularServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server that counts requests per endpoint
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0, error_rate=0, payload_size=0, daily_quota=0):
+        super().__init__(address, FakeSpoonacularHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload_size = payload_size
+        self.daily_quota = daily_quota
+        self.points_used = 0
+        self._lock = threading.Lock()
+        self.request_counts = {}
+
+    def record(self, endpoint):
+        with self._lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def charge(self, path, params):
+        """
+        Charge a request against the daily quota
+        Returns the quota headers to send, {} without a quota, or None if the quota is used up
+        """
+        if not self.daily_quota:
+            return {}
+
+        base, per_item = POINT_COSTS.get(path, (1, 0))
+        if path == '/recipes/informationBulk':
+            cost = base + per_item * max(0, len(params.get('ids', '').split(',')) - 1)
+        else:
+            cost = base + per_item * int(params.get('number', 0))
+
+        with self._lock:
+            if self.points_used >= self.daily_quota:
+                return None
+            self.points_used += cost
+            return {
+                'X-API-Quota-Request': str(cost),
+                'X-API-Quota-Used': str(round(self.points_used, 2)),
+                'X-API-Quota-Left': str(round(max(0, self.daily_quota - self.points_used), 2))
+            }
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts = {}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_server(host='127.0.0.1', port=0, latency=0, error_rate=0, payload_size=0, daily_quota=0):
+    """
+    Start a fake server on a background thread and return it
+    Use server.base_url as SPOONACULAR_BASE_URL and server.shutdown() to stop it
+    """
+    server = FakeSpoonacularServer((host, port), latency, error_rate, payload_size, daily_quota)
+    thread = threading.Thread(target=server.serve_forever, name='fake-spoonacular', daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a fake Spoonacular API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help="Seconds to wait before every response")
+    parser.add_argument('--error-rate', type=float, default=0, help="Fraction of requests answered with a 500")
+    parser.add_argument('--payload-size', type=int, default=0, help="Extra bytes of text in every recipe")
+    parser.add_argument('--daily-quota', type=float, default=0, help="Points per day before answering 402 (0 for none)")
+    args = parser.parse_args()
+
+    server = FakeSpoonacularServer(
+        (args.host, args.port), args.latency, args.error_rate, args.payload_size, args.daily_quota
+    )
+    print(f"Fake Spoonacular API listening on {server.base_url}")
+    server.serve_forever()
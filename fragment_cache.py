@@ -0,0 +1,72 @@
+"""
+Rendered Fragment Cache
+
+Keeps rendered plan pages and plan JSON in memory so repeated views of the
+same plan skip loading its days and rendering them again:
+- Entries are keyed by plan ID and version, so a regenerated day or swapped
+  meal (which bumps the version) is never served from the cache
+- Old versions are never read again and age out with least-recently-used eviction
+- Each worker process has its own cache; a miss costs one render per worker
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# Cache configuration (can be overridden from the environment)
+MAX_ENTRIES = int(os.environ.get("PLAN_FRAGMENT_CACHE_SIZE", 512))
+
+
+class FragmentCache:
+    """
+    Bounded in-memory LRU cache of rendered fragments
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+
+    def get(self, key):
+        """
+        Return the cached fragment for key, or None
+        """
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return fragment
+
+    def set(self, key, fragment):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the entry count and hit/miss counters for this process
+        """
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), max_entries=self.max_entries)
+
+
+# Shared cache used by the plan views
+fragments = FragmentCache()
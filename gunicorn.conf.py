@@ -0,0 +1,76 @@
+"""
+Gunicorn Configuration
+
+Loaded automatically when gunicorn is started from this directory. Sets up the
+shared directory the workers write their Prometheus metrics to, so /metrics
+reports the totals of every worker rather than whichever one was scraped.
+
+The app is preloaded in the master and workers are forked from it, with the
+recipe indexes already built (see preload.py); set GUNICORN_PRELOAD=0 to
+import the app in every worker instead. gunicorn can't reload code changes
+(--reload) in a preloaded app, so development servers run with
+GUNICORN_PRELOAD=0.
+"""
+import os
+import sys
+import glob
+import tempfile
+
+# Must exist before the app is imported, which with preloading happens in the
+# master right after this file is loaded
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'meal-planner-metrics')
+)
+os.makedirs(metrics_dir, exist_ok=True)
+
+# Start from empty metrics rather than the files of a previous run, whether the
+# directory is ours or the operator's. This can't wait for on_starting, which
+# runs after the preloaded app has opened its files; the marker keeps a reload
+# (or a re-exec on USR2) from clearing the files of running workers
+if 'MEAL_PLANNER_METRICS_CLEARED' not in os.environ:
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    os.environ['MEAL_PLANNER_METRICS_CLEARED'] = '1'
+
+# Import the app once in the master rather than in every worker
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import preload
+
+        preload.warm()
+        preload.freeze()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        import preload
+
+        preload.after_fork()
+
+
+def post_worker_init(worker):
+    # Without preloading, each worker builds the indexes before it takes requests
+    if not worker.cfg.preload_app:
+        import preload
+
+        preload.warm()
+
+
+def worker_exit(server, worker):
+    # Stop the worker's cohort planning processes with it; only a worker that
+    # has loaded the app can have started them
+    cohort_planner = sys.modules.get('cohort_planner')
+    if cohort_planner is not None:
+        cohort_planner.shutdown()
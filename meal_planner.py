@@ -1,14 +1,46 @@
 import os
+import time
 import random
 import requests
 import json
 import logging
 from usda_guidelines import get_macronutrient_targets
+from nutrients import NutrientVector
+from dietary import compile_preferences, search_params, recipe_mask
+from plan_optimizer import PlanOptimizer, day_score
+from recipe_cache import cache, MISS
+from recipe_catalog import catalog
+from recipe_snapshot import snapshots
+import upstream
+import metrics
+import profiling
+from quota import limiter
+from singleflight import SingleFlight
 
 # Use a recipe API for getting meal data
 # Using Spoonacular API but you could replace with any recipe API
 API_KEY = os.environ.get("SPOONACULAR_API_KEY", "demo-key")
-API_BASE_URL = "https://api.spoonacular.com"
+API_BASE_URL = os.environ.get("SPOONACULAR_BASE_URL", "https://api.spoonacular.com")
+
+# Maximum number of recipe IDs per informationBulk request
+BULK_BATCH_SIZE = int(os.environ.get("SPOONACULAR_BULK_BATCH_SIZE", 100))
+
+# Where recipes come from: 'upstream' (Spoonacular only), 'local' (the local
+# recipe catalog only) or 'local-first' (the catalog, then Spoonacular on a miss)
+RECIPE_SOURCE = os.environ.get("RECIPE_SOURCE", "upstream")
+
+# Maximum seconds of upstream calls one plan may spend before falling back to local data
+PLAN_DEADLINE = float(os.environ.get("UPSTREAM_PLAN_DEADLINE", 15))
+
+# How each day's meals are chosen from the candidate pools: 'random' or 'optimize'
+# (pick the combination closest to the USDA macronutrient targets)
+PLAN_SELECTION = os.environ.get("PLAN_SELECTION", "random")
+
+# Number of candidate recipes per search; the optimizer does best with larger pools
+SEARCH_RESULTS = int(os.environ.get("SEARCH_RESULTS", 5))
+
+# Search results change more often than recipe details, so cache them for less time
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 24 * 3600))
 
 # Sample recipes for backup/fallback when API is not available
 FALLBACK_RECIPES = {
@@ -142,263 +174,641 @@ FALLBACK_RECIPES = {
     ]
 }
 
-def search_recipes(meal_type, preferences, calories_per_meal):
+# Title of the placeholder served for a recipe that can't be found anywhere
+PLACEHOLDER_TITLE = 'Recipe Not Found'
+
+# Fallback recipe titles by ID, which tell them apart from upstream recipes with the same IDs
+FALLBACK_TITLES = {recipe['id']: recipe['title'] for recipes in FALLBACK_RECIPES.values() for recipe in recipes}
+
+# Spoonacular meal type used to search for each meal in a plan
+MEAL_SEARCH_TYPES = {
+    'breakfast': 'breakfast',
+    'lunch': 'lunch',
+    'dinner': 'dinner',
+    'snacks': 'snack'
+}
+
+# Distribute calories across meals
+MEAL_DISTRIBUTION = {
+    'breakfast': 0.25,  # 25% of daily calories
+    'lunch': 0.30,      # 30% of daily calories
+    'dinner': 0.35,     # 35% of daily calories
+    'snacks': 0.10      # 10% of daily calories
+}
+
+# Per-meal calorie budgets are rounded to bands of this width so that
+# similar calorie targets share the same searches
+CALORIE_BAND_WIDTH = 50
+
+# Concurrent lookups of the same search or recipe share one upstream call
+search_flights = SingleFlight('search')
+recipe_flights = SingleFlight('recipe')
+
+def calorie_band(calories):
     """
-    Search for recipes based on user preferences and meal type
+    Round a per-meal calorie budget to the nearest calorie band
+    """
+    return max(CALORIE_BAND_WIDTH, int(round(calories / CALORIE_BAND_WIDTH)) * CALORIE_BAND_WIDTH)
+
+def meal_calorie_budgets(calorie_target):
     """
+    Split a daily calorie target into each meal's calories
+    """
+    return {meal: int(calorie_target * share) for meal, share in MEAL_DISTRIBUTION.items()}
+
+def candidate_pool_keys(preferences, meal_calories):
+    """
+    Return the search behind each meal's candidate pool, as
+    (meal type, dietary profile, calorie band) keyed by meal
+    Plans with the same keys can share their candidate pools
+    """
+    profile = compile_preferences(preferences)
+    return {
+        meal: (MEAL_SEARCH_TYPES[meal], profile, calorie_band(meal_calories[meal]))
+        for meal in MEAL_SEARCH_TYPES
+    }
+
+def build_candidate_pools(preferences, meal_calories):
+    """
+    Build the candidate recipes for each meal of a plan
+    Each distinct (meal type, dietary profile, calorie band) is searched
+    only once, the searches run in parallel, and the details for every recipe
+    they return are then loaded together in bulk
+    """
+    return build_shared_candidate_pools([(preferences, meal_calories)])[0]
+
+def build_shared_candidate_pools(plans):
+    """
+    Build the candidate pools of many plans at once
+    plans is a list of (preferences, meal_calories); every distinct search
+    among them runs once and all of their recipes are loaded in one bulk
+    lookup. Returns the pools of each plan, in order
+    """
+    plan_keys = [candidate_pool_keys(preferences, meal_calories) for preferences, meal_calories in plans]
+    
+    # Searches depend on the preferences only through their dietary profile, so any plan with the key can run it
+    key_preferences = {}
+    for (preferences, _), pool_keys in zip(plans, plan_keys):
+        for key in pool_keys.values():
+            key_preferences.setdefault(key, preferences)
+    
+    def search(key):
+        try:
+            return _search_recipe_ids(key[0], key_preferences[key], key[2])
+        except Exception as e:
+            logging.error(f"Error searching recipes: {str(e)}")
+            return None
+    
+    unique_keys = list(key_preferences)
+    with metrics.plan_phase('search'):
+        id_lists = upstream.parallel_map(search, unique_keys, pool='search')
+    
+    # Resolve the recipes from all searches together
     try:
-        # Build query parameters
-        params = {
-            "apiKey": API_KEY,
-            "number": 5,  # Number of results to return
-            "type": meal_type,
-            "maxCalories": int(calories_per_meal * 1.1),  # Allow some flexibility
-            "minCalories": int(calories_per_meal * 0.9)
-        }
-        
-        # Add dietary restrictions
-        if preferences.get('vegetarian'):
-            params['vegetarian'] = 'true'
-        if preferences.get('vegan'):
-            params['vegan'] = 'true'
-        if preferences.get('gluten_free'):
-            params['glutenFree'] = 'true'
-        if preferences.get('dairy_free'):
-            params['dairyFree'] = 'true'
-        
-        # Add diet type
-        diet_type = preferences.get('diet_type', 'balanced')
-        if diet_type == 'low-carb':
-            params['diet'] = 'low-carb'
-        elif diet_type == 'high-protein':
-            params['diet'] = 'high-protein'
-        elif diet_type == 'low-fat':
-            params['diet'] = 'low-fat'
-        
-        # Add allergens to exclude
-        if preferences.get('allergens'):
-            allergens = preferences['allergens'].split(',')
-            params['intolerances'] = ','.join([a.strip() for a in allergens])
-        
-        # Make API request
-        response = requests.get(f"{API_BASE_URL}/recipes/complexSearch", params=params)
-        response.raise_for_status()  # Raise exception for non-200 responses
+        with metrics.plan_phase('detail'):
+            recipes = get_recipes_bulk([recipe_id for ids in id_lists if ids for recipe_id in ids])
+    except Exception as e:
+        logging.error(f"Error getting recipe details: {str(e)}")
+        recipes = None
+    
+    pools_by_key = {}
+    for key, ids in zip(unique_keys, id_lists):
+        if ids is None or recipes is None:
+            pools_by_key[key] = _fallback_recipes(key[0])
+        else:
+            pools_by_key[key] = [recipes[recipe_id] for recipe_id in ids]
+    
+    return [{meal: pools_by_key[key] for meal, key in pool_keys.items()} for pool_keys in plan_keys]
+
+class CandidateSampler:
+    """
+    Draws recipes from a candidate pool without replacement, reshuffling
+    the pool once every candidate has been used
+    """
+    
+    def __init__(self, candidates):
+        self.candidates = list(candidates or [])
+        self.remaining = []
+        self.last = None
+    
+    def draw(self):
+        if not self.candidates:
+            return None
         
-        results = response.json()
+        if not self.remaining:
+            self.remaining = random.sample(self.candidates, len(self.candidates))
+            # Don't serve the same recipe on both sides of a reshuffle
+            if len(self.remaining) > 1 and self.remaining[-1] is self.last:
+                self.remaining[0], self.remaining[-1] = self.remaining[-1], self.remaining[0]
         
-        # Get nutritional information for each recipe
-        recipes = []
-        for recipe in results.get('results', []):
-            recipe_with_nutrition = get_recipe_details(recipe['id'])
-            recipes.append(recipe_with_nutrition)
+        self.last = self.remaining.pop()
+        return self.last
+
+def search_recipes(meal_type, preferences, calories_per_meal):
+    """
+    Search for recipes based on user preferences and meal type
+    """
+    try:
+        recipe_ids = _search_recipe_ids(meal_type, preferences, calories_per_meal)
         
-        return recipes
+        # Get nutritional information for every recipe in one bulk lookup
+        recipes = get_recipes_bulk(recipe_ids)
+        return [recipes[recipe_id] for recipe_id in recipe_ids]
     
     except requests.RequestException as e:
         logging.error(f"API request error: {str(e)}")
         # Return fallback recipes if API call fails
-        return FALLBACK_RECIPES[meal_type]
+        return _fallback_recipes(meal_type)
     
     except Exception as e:
         logging.error(f"Error searching recipes: {str(e)}")
-        return FALLBACK_RECIPES[meal_type]
+        return _fallback_recipes(meal_type)
+
+def _use_catalog():
+    """
+    Whether to look in the local catalog: always outside 'upstream' mode,
+    and in 'upstream' mode while the circuit breaker has Spoonacular cut off
+    or only the reserve of the daily quota is left
+    """
+    return RECIPE_SOURCE != 'upstream' or upstream.breaker.is_open() or limiter.is_tight()
+
+def _search_recipe_ids(meal_type, preferences, calories_per_meal):
+    """
+    Return the IDs of the recipes matching a search
+    Raises requests.RequestException if the search fails upstream
+    """
+    if _use_catalog():
+        recipe_ids = catalog.search_ids(meal_type, preferences, calories_per_meal, number=SEARCH_RESULTS)
+        if recipe_ids or RECIPE_SOURCE == 'local':
+            return recipe_ids or []
+    
+    # Build query parameters
+    params = {
+        "number": SEARCH_RESULTS,  # Number of results to return
+        "type": meal_type,
+        "maxCalories": int(calories_per_meal * 1.1),  # Allow some flexibility
+        "minCalories": int(calories_per_meal * 0.9)
+    }
+    
+    # Add dietary restrictions, diet type and allergens, in the same form for equivalent preferences
+    params.update(search_params(compile_preferences(preferences)))
+    
+    # Identical searches return the same recipes, so serve them from the cache
+    cache_key = json.dumps(params, sort_keys=True)
+    search_results = cache.get('search', cache_key)
+    
+    if search_results is MISS:
+        # Concurrent identical searches share one upstream call, in this process and across workers
+        search_results = search_flights.do(
+            cache_key,
+            lambda: _fetch_search(params, cache_key),
+            recheck=lambda: _cached_search(cache_key),
+            timeout=upstream.remaining_budget()
+        )
+    
+    return [recipe['id'] for recipe in search_results]
+
+def _cached_search(cache_key):
+    """
+    Return the cached results of a search, or None if there are none
+    """
+    search_results = cache.get('search', cache_key)
+    return None if search_results is MISS else search_results
+
+def _fetch_search(params, cache_key):
+    """
+    Run a search upstream and cache its results
+    Falls back to an expired copy of the results if the search fails
+    """
+    # An expired copy means this call is only a refresh, which the quota ranks below cache fills
+    stale = cache.get('search', cache_key, allow_expired=True)
+    
+    # Make API request
+    try:
+        results = upstream.get_json(
+            f"{API_BASE_URL}/recipes/complexSearch",
+            params=dict(params, apiKey=API_KEY),
+            endpoint='complexSearch',
+            priority='fill' if stale is MISS else 'refresh'
+        )
+    except requests.RequestException:
+        if stale is MISS:
+            raise
+        return stale
+    
+    search_results = [{'id': recipe['id']} for recipe in results.get('results', [])]
+    cache.set('search', cache_key, search_results, ttl=SEARCH_CACHE_TTL)
+    return search_results
 
 def get_recipe_details(recipe_id):
     """
     Get detailed information for a specific recipe
     """
+    if _use_catalog():
+        local = _stored_recipes([recipe_id])
+        if local:
+            return _with_vector(local[recipe_id])
+    
+    cached = _cached_recipes([recipe_id])
+    if recipe_id in cached:
+        return _with_vector(cached[recipe_id])
+    
+    # Concurrent lookups of the same recipe share one upstream call
+    return _with_vector(recipe_flights.do(
+        recipe_id,
+        lambda: _fetch_recipe_details(recipe_id),
+        recheck=lambda: _cached_recipes([recipe_id]).get(recipe_id),
+        timeout=upstream.remaining_budget()
+    ))
+
+def _fetch_recipe_details(recipe_id):
+    """
+    Fetch one recipe upstream and cache it
+    """
+    stale = cache.get('recipe', recipe_id, allow_expired=True)
     try:
         params = {
             "apiKey": API_KEY,
             "includeNutrition": "true"
         }
         
-        response = requests.get(f"{API_BASE_URL}/recipes/{recipe_id}/information", params=params)
-        response.raise_for_status()
+        recipe = upstream.get_json(
+            f"{API_BASE_URL}/recipes/{recipe_id}/information",
+            params=params,
+            endpoint='information',
+            priority='fill' if stale is MISS else 'refresh'
+        )
         
-        recipe = response.json()
-        
-        # Extract essential nutrition information
-        nutrition = {
-            "calories": 0,
-            "protein": 0,
-            "carbs": 0,
-            "fat": 0,
-            "fiber": 0
-        }
-        
-        if 'nutrition' in recipe and 'nutrients' in recipe['nutrition']:
-            for nutrient in recipe['nutrition']['nutrients']:
-                if nutrient['name'] == 'Calories':
-                    nutrition['calories'] = nutrient['amount']
-                elif nutrient['name'] == 'Protein':
-                    nutrition['protein'] = nutrient['amount']
-                elif nutrient['name'] == 'Carbohydrates':
-                    nutrition['carbs'] = nutrient['amount']
-                elif nutrient['name'] == 'Fat':
-                    nutrition['fat'] = nutrient['amount']
-                elif nutrient['name'] == 'Fiber':
-                    nutrition['fiber'] = nutrient['amount']
-        
-        # Extract ingredients and instructions
-        ingredients = []
-        if 'extendedIngredients' in recipe:
-            for ingredient in recipe['extendedIngredients']:
-                ingredients.append({
-                    'name': ingredient.get('name', ''),
-                    'amount': ingredient.get('amount', 0),
-                    'unit': ingredient.get('unit', '')
-                })
-        
-        instructions = []
-        if 'analyzedInstructions' in recipe and recipe['analyzedInstructions']:
-            for step in recipe['analyzedInstructions'][0]['steps']:
-                instructions.append(step.get('step', ''))
-        
-        # Format recipe data
-        recipe_details = {
-            'id': recipe.get('id'),
-            'title': recipe.get('title'),
-            'image': recipe.get('image'),
-            'readyInMinutes': recipe.get('readyInMinutes'),
-            'servings': recipe.get('servings'),
-            'sourceUrl': recipe.get('sourceUrl'),
-            'nutrition': nutrition,
-            'ingredients': ingredients,
-            'instructions': instructions
-        }
+        recipe_details = parse_recipe(recipe)
+        cache.set('recipe', recipe_id, recipe_details)
         
         return recipe_details
     
+    except requests.HTTPError as e:
+        logging.error(f"Error getting recipe details: {str(e)}")
+        if e.response is not None and e.response.status_code in (400, 404):
+            # Unknown recipe IDs will keep failing, so don't ask again for a while
+            cache.set_negative('recipe', recipe_id)
+            return _fallback_recipe(recipe_id)
+        # Server errors, rate limiting and a used-up quota are temporary; an expired copy beats a placeholder
+        return stale if stale is not MISS else _fallback_recipe(recipe_id)
+    
     except Exception as e:
         logging.error(f"Error getting recipe details: {str(e)}")
+        # An expired copy of the recipe beats a placeholder
+        return stale if stale is not MISS else _fallback_recipe(recipe_id)
+
+def get_recipes_bulk(recipe_ids):
+    """
+    Get detailed information for many recipes at once
+    Catalog and cached recipes are served locally and the rest are fetched with a single
+    informationBulk request per batch. Returns a dict keyed by recipe ID
+    Raises requests.RequestException if a bulk request fails upstream
+    """
+    recipe_ids = list(dict.fromkeys(recipe_ids))
+    
+    # Recipes in the snapshot or the local catalog never need to be fetched
+    recipes = _stored_recipes(recipe_ids) if _use_catalog() else {}
+    recipes.update(_cached_recipes([recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]))
+    missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]
+    
+    if missing:
+        # Recipes already being fetched by a concurrent lookup are shared rather than fetched again
+        recipes.update(recipe_flights.do_many(
+            missing, _fetch_recipes, recheck=_cached_recipes, timeout=upstream.remaining_budget()
+        ))
+    
+    return {recipe_id: _with_vector(recipe) for recipe_id, recipe in recipes.items()}
+
+def get_local_recipes(recipe_ids):
+    """
+    Get the recipes held in the snapshot, the local catalog or the cache, expired or not, without calling upstream
+    Returns a dict keyed by recipe ID; recipes held nowhere are left out
+    """
+    recipe_ids = list(dict.fromkeys(recipe_ids))
+    recipes = _stored_recipes(recipe_ids)
+    missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]
+    if missing:
+        cached = cache.get_many('recipe', missing, allow_expired=True)
+        recipes.update((recipe_id, recipe) for recipe_id, recipe in cached.items() if recipe is not None)
+    
+    return {recipe_id: _with_vector(recipe) for recipe_id, recipe in recipes.items()}
+
+def _stored_recipes(recipe_ids):
+    """
+    Return the recipes among the given IDs held in the snapshot or the local catalog, keyed by recipe ID
+    """
+    recipes = snapshots.get_many(recipe_ids)
+    missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]
+    if missing:
+        recipes.update(catalog.get_many(missing))
+    return recipes
+
+def _with_vector(recipe):
+    """
+    Return a copy of a recipe with its nutrition as a NutrientVector; cached and catalog recipes come back as dicts
+    The recipe itself is left alone, as it may be shared with other requests or be one of FALLBACK_RECIPES
+    """
+    if recipe is None:
+        return None
+    return dict(recipe, nutrition=NutrientVector.of(recipe.get('nutrition')))
+
+def _cached_recipes(recipe_ids):
+    """
+    Return the cached recipes among the given IDs as a dict keyed by recipe ID
+    """
+    recipes = {}
+    for recipe_id, entry in cache.get_many('recipe', recipe_ids).items():
+        # A negative entry means this recipe recently failed upstream
+        recipes[recipe_id] = entry if entry is not None else _fallback_recipe(recipe_id)
+    return recipes
+
+def _fetch_recipes(recipe_ids):
+    """
+    Fetch recipes upstream in informationBulk batches and cache them
+    Returns a dict keyed by recipe ID
+    """
+    recipes = {}
+    
+    # Recipes with an expired copy are only refreshed, which the quota ranks below cache fills
+    stale = cache.get_many('recipe', recipe_ids, allow_expired=True)
+    fill = [recipe_id for recipe_id in recipe_ids if recipe_id not in stale]
+    refresh = [recipe_id for recipe_id in recipe_ids if recipe_id in stale]
+    batches = [(fill[i:i + BULK_BATCH_SIZE], 'fill') for i in range(0, len(fill), BULK_BATCH_SIZE)]
+    batches += [(refresh[i:i + BULK_BATCH_SIZE], 'refresh') for i in range(0, len(refresh), BULK_BATCH_SIZE)]
+    
+    def fetch(batch):
+        recipe_ids, priority = batch
+        try:
+            return _fetch_recipes_bulk(recipe_ids, priority)
+        except requests.RequestException as e:
+            if priority == 'fill':
+                raise
+            logging.error(f"Error refreshing recipe details, serving cached copies: {str(e)}")
+            return None
+    
+    for (batch, _), results in zip(batches, upstream.parallel_map(fetch, batches)):
+        if results is None:
+            recipes.update((recipe_id, stale[recipe_id]) for recipe_id in batch)
+            continue
         
-        # For demo purposes, return a fallback recipe
-        for meal_type in FALLBACK_RECIPES:
-            for recipe in FALLBACK_RECIPES[meal_type]:
-                if recipe['id'] == recipe_id:
-                    return recipe
+        fetched = {}
+        for recipe in results:
+            recipe_details = parse_recipe(recipe)
+            fetched[str(recipe_details['id'])] = recipe_details
         
-        return {
-            'id': recipe_id,
-            'title': 'Recipe Not Found',
-            'image': '',
-            'readyInMinutes': 0,
-            'servings': 0,
-            'nutrition': {"calories": 0, "protein": 0, "carbs": 0, "fat": 0, "fiber": 0},
-            'ingredients': [],
-            'instructions': [],
-            'sourceUrl': '#'
-        }
+        cache.set_many('recipe', fetched)
+        
+        for recipe_id in batch:
+            recipe_details = fetched.get(str(recipe_id))
+            if recipe_details is None:
+                # Unknown recipe IDs are left out of bulk responses
+                cache.set_negative('recipe', recipe_id)
+                recipe_details = _fallback_recipe(recipe_id)
+            recipes[recipe_id] = recipe_details
+    
+    return recipes
+
+def _fetch_recipes_bulk(recipe_ids, priority='fill'):
+    """
+    Fetch one batch of recipes from the informationBulk endpoint
+    """
+    params = {
+        "apiKey": API_KEY,
+        "ids": ','.join(str(recipe_id) for recipe_id in recipe_ids),
+        "includeNutrition": "true"
+    }
+    
+    return upstream.get_json(
+        f"{API_BASE_URL}/recipes/informationBulk", params=params, endpoint='informationBulk', priority=priority
+    )
+
+@profiling.phase('parse')
+def parse_recipe(recipe):
+    """
+    Convert a Spoonacular recipe information response into our recipe format
+    """
+    # Extract every nutrient in the registry
+    nutrition = NutrientVector.from_spoonacular((recipe.get('nutrition') or {}).get('nutrients'))
+    
+    # Extract ingredients and instructions
+    ingredients = []
+    if 'extendedIngredients' in recipe:
+        for ingredient in recipe['extendedIngredients']:
+            ingredients.append({
+                'name': ingredient.get('name', ''),
+                'amount': ingredient.get('amount', 0),
+                'unit': ingredient.get('unit', '')
+            })
+    
+    instructions = []
+    if 'analyzedInstructions' in recipe and recipe['analyzedInstructions']:
+        for step in recipe['analyzedInstructions'][0]['steps']:
+            instructions.append(step.get('step', ''))
+    
+    # Format recipe data
+    return {
+        'id': recipe.get('id'),
+        'title': recipe.get('title'),
+        'image': recipe.get('image'),
+        'readyInMinutes': recipe.get('readyInMinutes'),
+        'servings': recipe.get('servings'),
+        'sourceUrl': recipe.get('sourceUrl'),
+        'diet_mask': recipe_mask(recipe, nutrition),
+        'nutrition': nutrition,
+        'ingredients': ingredients,
+        'instructions': instructions
+    }
+
+def _fallback_recipes(meal_type):
+    """
+    Return the fallback recipes for a meal or search type ('snack' searches use 'snacks')
+    """
+    metrics.FALLBACK_RECIPES.labels('pool').inc()
+    return FALLBACK_RECIPES.get(meal_type) or FALLBACK_RECIPES.get(f"{meal_type}s", [])
+
+def _fallback_recipe(recipe_id):
+    """
+    Return the matching fallback recipe, or a placeholder if there is none
+    """
+    metrics.FALLBACK_RECIPES.labels('recipe').inc()
+    
+    # For demo purposes, return a fallback recipe
+    for meal_type in FALLBACK_RECIPES:
+        for recipe in FALLBACK_RECIPES[meal_type]:
+            if recipe['id'] == recipe_id:
+                return recipe
+    
+    return {
+        'id': recipe_id,
+        'title': PLACEHOLDER_TITLE,
+        'image': '',
+        'readyInMinutes': 0,
+        'servings': 0,
+        'nutrition': NutrientVector(),
+        'ingredients': [],
+        'instructions': [],
+        'sourceUrl': '#'
+    }
 
-def generate_meal_plan(preferences, days=7):
+def is_fallback_recipe(recipe):
+    """
+    Whether a recipe is one of FALLBACK_RECIPES or the placeholder for a missing recipe rather than real recipe data
+    """
+    title = recipe.get('title')
+    return title == PLACEHOLDER_TITLE or FALLBACK_TITLES.get(recipe.get('id')) == title
+
+def _plan_day(breakfast, lunch, dinner, snack, macro_targets):
+    """
+    Build a plan day from its meals, adding up the day's nutrition
+    """
+    # Calculate day's nutrition totals
+    day_nutrition = NutrientVector.total(meal.get('nutrition') for meal in (breakfast, lunch, dinner, snack) if meal)
+    
+    # Include how far the day is from the targets
+    return {
+        'breakfast': breakfast,
+        'lunch': lunch,
+        'dinner': dinner,
+        'snacks': snack,
+        'nutrition': day_nutrition,
+        'score': round(day_score(day_nutrition, macro_targets), 4)
+    }
+
+def plan_candidate_pools(preferences):
+    """
+    Search the candidate recipes every meal of a plan is chosen from
+    Returns a dict of recipe lists keyed by meal
+    """
+    meal_calories = meal_calorie_budgets(preferences.get('calorie_target', 2000))
+    
+    with upstream.deadline(PLAN_DEADLINE), upstream.track_calls() as calls:
+        pools = build_candidate_pools(preferences, meal_calories)
+    logging.info(f"Meal plan candidates needed {calls.total} upstream round trips: {calls.by_endpoint}")
+    return pools
+
+def generate_meal_plan(preferences, days=7, selection=None, pools=None):
     """
     Generate a weekly meal plan based on user preferences
+    selection is 'random' or 'optimize'; it defaults to the preferences'
+    'selection' entry and then to PLAN_SELECTION
+    pools are candidates from plan_candidate_pools(), searched for if not given
     """
+    return list(iter_meal_plan(preferences, days, selection, pools))
+
+def generate_meal_plans(preferences_list, pools, days=7):
+    """
+    Generate a plan for each of several preferences from the same candidate pools
+    Needs no upstream calls or database, so it can run in a worker process
+    """
+    return [generate_meal_plan(preferences, days, pools=pools) for preferences in preferences_list]
+
+def iter_meal_plan(preferences, days=7, selection=None, pools=None):
+    """
+    Generate a meal plan one day at a time, yielding each day as soon as its
+    meals are chosen; takes the same arguments as generate_meal_plan
+    The candidate searches happen before the first day, so it arrives after
+    the same upstream calls as a one-day plan and later days cost no calls
+    """
+    selection = selection or preferences.get('selection') or PLAN_SELECTION
+    macro_targets = get_macronutrient_targets(preferences.get('calorie_target', 2000))
+    days_yielded = 0
+    
     try:
-        calorie_target = preferences.get('calorie_target', 2000)
-        macro_targets = get_macronutrient_targets(calorie_target)
+        # Search once per meal type and draw every day's meals from the same candidates
+        if pools is None:
+            pools = plan_candidate_pools(preferences)
         
-        # Distribute calories across meals
-        meal_distribution = {
-            'breakfast': 0.25,  # 25% of daily calories
-            'lunch': 0.30,      # 30% of daily calories
-            'dinner': 0.35,     # 35% of daily calories
-            'snacks': 0.10      # 10% of daily calories
-        }
-        
-        meal_calories = {
-            'breakfast': int(calorie_target * meal_distribution['breakfast']),
-            'lunch': int(calorie_target * meal_distribution['lunch']),
-            'dinner': int(calorie_target * meal_distribution['dinner']),
-            'snacks': int(calorie_target * meal_distribution['snacks'])
-        }
-        
-        # Generate meal plan for specified number of days
-        meal_plan = []
+        if selection == 'optimize':
+            optimizer = PlanOptimizer(pools, macro_targets, MEAL_DISTRIBUTION)
+        else:
+            samplers = {meal: CandidateSampler(pools[meal]) for meal in pools}
         
+        select_seconds = 0
         for day in range(days):
-            # Get recipes for each meal type
-            breakfast_recipes = search_recipes('breakfast', preferences, meal_calories['breakfast'])
-            lunch_recipes = search_recipes('lunch', preferences, meal_calories['lunch'])
-            dinner_recipes = search_recipes('dinner', preferences, meal_calories['dinner'])
-            snack_recipes = search_recipes('snack', preferences, meal_calories['snacks'])
-            
-            # Select a random recipe for each meal
-            breakfast = random.choice(breakfast_recipes) if breakfast_recipes else None
-            lunch = random.choice(lunch_recipes) if lunch_recipes else None
-            dinner = random.choice(dinner_recipes) if dinner_recipes else None
-            snack = random.choice(snack_recipes) if snack_recipes else None
+            day_started = time.perf_counter()
             
-            # Calculate day's nutrition totals
-            day_nutrition = {
-                'calories': (breakfast.get('nutrition', {}).get('calories', 0) if breakfast else 0) +
-                            (lunch.get('nutrition', {}).get('calories', 0) if lunch else 0) +
-                            (dinner.get('nutrition', {}).get('calories', 0) if dinner else 0) +
-                            (snack.get('nutrition', {}).get('calories', 0) if snack else 0),
-                            
-                'protein': (breakfast.get('nutrition', {}).get('protein', 0) if breakfast else 0) +
-                           (lunch.get('nutrition', {}).get('protein', 0) if lunch else 0) +
-                           (dinner.get('nutrition', {}).get('protein', 0) if dinner else 0) +
-                           (snack.get('nutrition', {}).get('protein', 0) if snack else 0),
-                           
-                'carbs': (breakfast.get('nutrition', {}).get('carbs', 0) if breakfast else 0) +
-                         (lunch.get('nutrition', {}).get('carbs', 0) if lunch else 0) +
-                         (dinner.get('nutrition', {}).get('carbs', 0) if dinner else 0) +
-                         (snack.get('nutrition', {}).get('carbs', 0) if snack else 0),
-                         
-                'fat': (breakfast.get('nutrition', {}).get('fat', 0) if breakfast else 0) +
-                       (lunch.get('nutrition', {}).get('fat', 0) if lunch else 0) +
-                       (dinner.get('nutrition', {}).get('fat', 0) if dinner else 0) +
-                       (snack.get('nutrition', {}).get('fat', 0) if snack else 0),
-                       
-                'fiber': (breakfast.get('nutrition', {}).get('fiber', 0) if breakfast else 0) +
-                         (lunch.get('nutrition', {}).get('fiber', 0) if lunch else 0) +
-                         (dinner.get('nutrition', {}).get('fiber', 0) if dinner else 0) +
-                         (snack.get('nutrition', {}).get('fiber', 0) if snack else 0)
-            }
+            if selection == 'optimize':
+                # Select the combination of meals closest to the day's targets
+                meals, _ = optimizer.next_day()
+                breakfast, lunch, dinner, snack = meals['breakfast'], meals['lunch'], meals['dinner'], meals['snacks']
+            else:
+                # Select a recipe for each meal, avoiding repeats until a pool is used up
+                breakfast = samplers['breakfast'].draw()
+                lunch = samplers['lunch'].draw()
+                dinner = samplers['dinner'].draw()
+                snack = samplers['snacks'].draw()
             
-            # Add day to meal plan
-            meal_plan.append({
-                'breakfast': breakfast,
-                'lunch': lunch,
-                'dinner': dinner,
-                'snacks': snack,
-                'nutrition': day_nutrition
-            })
-        
-        return meal_plan
+            day_plan = _plan_day(breakfast, lunch, dinner, snack, macro_targets)
+            select_seconds += time.perf_counter() - day_started
+            yield day_plan
+            days_yielded += 1
+        metrics.PLAN_PHASE_SECONDS.labels('select').observe(select_seconds)
+        return
     
     except Exception as e:
         logging.error(f"Error generating meal plan: {str(e)}")
+        metrics.FALLBACK_RECIPES.labels('plan').inc()
+    
+    # Generate basic fallback days for the rest of the plan if there's an error
+    for day in range(days_yielded, days):
+        breakfast = random.choice(FALLBACK_RECIPES['breakfast'])
+        lunch = random.choice(FALLBACK_RECIPES['lunch'])
+        dinner = random.choice(FALLBACK_RECIPES['dinner'])
+        snack = random.choice(FALLBACK_RECIPES['snacks'])
         
-        # Generate a basic fallback meal plan if there's an error
-        fallback_plan = []
-        for day in range(days):
-            breakfast = random.choice(FALLBACK_RECIPES['breakfast'])
-            lunch = random.choice(FALLBACK_RECIPES['lunch'])
-            dinner = random.choice(FALLBACK_RECIPES['dinner'])
-            snack = random.choice(FALLBACK_RECIPES['snacks'])
-            
-            day_nutrition = {
-                'calories': breakfast['nutrition']['calories'] + lunch['nutrition']['calories'] + 
-                            dinner['nutrition']['calories'] + snack['nutrition']['calories'],
-                'protein': breakfast['nutrition']['protein'] + lunch['nutrition']['protein'] + 
-                           dinner['nutrition']['protein'] + snack['nutrition']['protein'],
-                'carbs': breakfast['nutrition']['carbs'] + lunch['nutrition']['carbs'] + 
-                         dinner['nutrition']['carbs'] + snack['nutrition']['carbs'],
-                'fat': breakfast['nutrition']['fat'] + lunch['nutrition']['fat'] + 
-                       dinner['nutrition']['fat'] + snack['nutrition']['fat'],
-                'fiber': breakfast['nutrition']['fiber'] + lunch['nutrition']['fiber'] + 
-                         dinner['nutrition']['fiber'] + snack['nutrition']['fiber']
-            }
-            
-            fallback_plan.append({
-                'breakfast': breakfast,
-                'lunch': lunch,
-                'dinner': dinner,
-                'snacks': snack,
-                'nutrition': day_nutrition
-            })
-        
-        return fallback_plan
+        # Scored like any other day, so callers can rely on every day having a score
+        yield _plan_day(breakfast, lunch, dinner, snack, macro_targets)
+
+def choose_day(pools, preferences, current=None, selection=None):
+    """
+    Choose a new day's meals from stored candidate pools without any upstream calls
+    current maps meals to the IDs of the recipes being replaced, which are
+    avoided where a pool has other candidates
+    """
+    selection = selection or preferences.get('selection') or PLAN_SELECTION
+    macro_targets = get_macronutrient_targets(preferences.get('calorie_target', 2000))
+    current = current or {}
+    
+    # Leave out the current meals so the day actually changes
+    candidates = {}
+    for meal in MEAL_SEARCH_TYPES:
+        pool = pools.get(meal) or []
+        others = [recipe for recipe in pool if recipe['id'] != current.get(meal)]
+        candidates[meal] = others or pool
+    
+    if selection == 'optimize':
+        meals, _ = PlanOptimizer(candidates, macro_targets, MEAL_DISTRIBUTION).next_day()
+    else:
+        meals = {meal: random.choice(pool) if pool else None for meal, pool in candidates.items()}
+    
+    return _plan_day(meals['breakfast'], meals['lunch'], meals['dinner'], meals['snacks'], macro_targets)
+
+def choose_meal(pool, day_nutrition, current, preferences, selection=None):
+    """
+    Choose a replacement for one meal of a day from its stored candidate pool
+    day_nutrition is the day's current totals and current the recipe being
+    replaced; 'optimize' picks the candidate that brings the day closest to
+    the targets, otherwise a random other candidate is picked
+    """
+    selection = selection or preferences.get('selection') or PLAN_SELECTION
+    current_id = current['id'] if current else None
+    candidates = [recipe for recipe in pool if recipe['id'] != current_id] or list(pool)
+    if not candidates:
+        return None
+    
+    if selection != 'optimize':
+        return random.choice(candidates)
+    
+    macro_targets = get_macronutrient_targets(preferences.get('calorie_target', 2000))
+    current_nutrition = (current or {}).get('nutrition') or {}
+    
+    def score(recipe):
+        nutrition = recipe.get('nutrition') or {}
+        totals = {
+            nutrient: day_nutrition.get(nutrient, 0) - current_nutrition.get(nutrient, 0) + nutrition.get(nutrient, 0)
+            for nutrient in day_nutrition
+        }
+        return day_score(totals, macro_targets)
+    
+    return min(candidates, key=score)
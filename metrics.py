@@ -0,0 +1,143 @@
+"""
+Prometheus Metrics
+
+Instrumentation for the hot paths of the app, exposed at /metrics:
+- Route latency by route, method and status
+- Upstream call latency by Spoonacular endpoint and outcome
+- How often fallback recipes are served instead of real ones
+- Database commit time
+- Plan generation time by phase: search, detail, select and persist
+- Spoonacular quota rejections and time spent waiting on the rate limit
+- Keys fetched upstream versus shared between concurrent lookups
+- Plan views answered with a 304, from the fragment cache or by rendering
+
+Under gunicorn every worker has its own metrics, so the workers write them to
+a shared directory named by PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py sets
+it up) and a scrape of any worker aggregates all of them. Without that
+variable, metrics are kept in memory for the current process only.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+)
+from sqlalchemy import event
+
+import profiling
+
+# Histogram buckets in seconds, from a cache hit to a plan that waits on the full upstream deadline
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+
+ROUTE_SECONDS = Histogram(
+    'meal_planner_request_seconds', 'Time spent handling HTTP requests',
+    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+
+UPSTREAM_SECONDS = Histogram(
+    'meal_planner_upstream_seconds', 'Time spent on Spoonacular API calls',
+    ['endpoint', 'outcome'], buckets=LATENCY_BUCKETS
+)
+
+FALLBACK_RECIPES = Counter(
+    'meal_planner_fallback_recipes_total',
+    'Times fallback recipes replaced Spoonacular results, for a meal pool, a single recipe or a whole plan',
+    ['kind']
+)
+
+DB_COMMIT_SECONDS = Histogram(
+    'meal_planner_db_commit_seconds', 'Time spent committing database sessions, including the final flush',
+    buckets=LATENCY_BUCKETS
+)
+
+PLAN_PHASE_SECONDS = Histogram(
+    'meal_planner_plan_phase_seconds', 'Time spent in each phase of meal plan generation',
+    ['phase'], buckets=LATENCY_BUCKETS
+)
+
+QUOTA_REJECTIONS = Counter(
+    'meal_planner_quota_rejections_total', 'Spoonacular calls refused to stay within the daily quota',
+    ['priority']
+)
+
+SINGLEFLIGHT_KEYS = Counter(
+    'meal_planner_singleflight_keys_total',
+    'Lookup keys fetched upstream, shared with a concurrent fetch, or found after waiting for another worker',
+    ['namespace', 'result']
+)
+
+PLAN_VIEWS = Counter(
+    'meal_planner_plan_views_total',
+    'Plan views answered not modified, from the rendered fragment cache, or rendered',
+    ['view', 'result']
+)
+
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    'meal_planner_rate_limit_wait_seconds', 'Time Spoonacular calls waited for a rate limit token',
+    buckets=LATENCY_BUCKETS
+)
+
+
+@contextmanager
+def plan_phase(phase):
+    """
+    Time a phase of plan generation, for the metrics and the current profile; use as a context manager or decorator
+    """
+    with PLAN_PHASE_SECONDS.labels(phase).time(), profiling.phase(phase):
+        yield
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        # Label by route pattern rather than path so plan IDs don't create new series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        ROUTE_SECONDS.labels(route, request.method, response.status_code).observe(time.perf_counter() - started)
+    return response
+
+
+def _before_commit(session):
+    session.info['metrics_commit_started'] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop('metrics_commit_started', None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _after_rollback(session):
+    session.info.pop('metrics_commit_started', None)
+
+
+def init_app(app, db):
+    """
+    Record route latency for every request and commit time for every session commit
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+    event.listen(db.session, 'before_commit', _before_commit)
+    event.listen(db.session, 'after_commit', _after_commit)
+    event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def render():
+    """
+    Return (body, content type) of the metrics in Prometheus text format
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        # Aggregate the metric files written by every worker process
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
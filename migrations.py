@@ -0,0 +1,133 @@
+"""
+Database Migrations
+
+db.create_all() creates missing tables but never changes existing ones, so
+schema changes to existing tables are applied here. Every migration checks
+the current schema first and is safe to run on every startup.
+"""
+import json
+import logging
+
+from sqlalchemy import inspect, text
+
+from app import db
+
+MEALS = ('breakfast', 'lunch', 'dinner', 'snacks')
+
+def _columns(table):
+    return {column['name'] for column in inspect(db.engine).get_columns(table)}
+
+def normalize_meal_plan_recipes():
+    """
+    Move the recipe JSON stored on every meal_plan_day row into the recipe table
+    and replace it with references to the recipe rows
+    """
+    from plan_store import upsert_recipes
+
+    columns = _columns('meal_plan_day')
+    if not set(MEALS) & columns:
+        return
+
+    with db.engine.begin() as conn:
+        for meal in MEALS:
+            if f"{meal}_id" not in columns:
+                conn.execute(text(f"ALTER TABLE meal_plan_day ADD COLUMN {meal}_id INTEGER REFERENCES recipe (id)"))
+
+    # Old columns that couldn't be dropped are cleared instead, so only rows
+    # that still hold recipe JSON are left to migrate
+    old_columns = [meal for meal in MEALS if meal in columns]
+    rows = db.session.execute(text(
+        f"SELECT id, {', '.join(old_columns)} FROM meal_plan_day "
+        f"WHERE {' OR '.join(f'{meal} IS NOT NULL' for meal in old_columns)}"
+    )).all()
+    if not rows:
+        return
+
+    logging.info("Migrating meal plan days to normalized recipe storage")
+
+    def load(value):
+        # Depending on the driver, JSON columns read through text() come back as strings
+        return json.loads(value) if isinstance(value, str) else value
+
+    recipes = [load(value) for row in rows for value in row[1:]]
+    recipe_ids = upsert_recipes(recipes)
+
+    updates = []
+    for i, row in enumerate(rows):
+        ids = recipe_ids[i * len(old_columns):(i + 1) * len(old_columns)]
+        updates.append(dict({f"{meal}_id": recipe_id for meal, recipe_id in zip(old_columns, ids)}, day_id=row[0]))
+
+    # Recipe references that are already set are never overwritten
+    db.session.execute(
+        text(
+            f"UPDATE meal_plan_day SET {', '.join(f'{meal}_id = COALESCE({meal}_id, :{meal}_id)' for meal in old_columns)} "
+            f"WHERE id = :day_id"
+        ),
+        updates
+    )
+    db.session.commit()
+
+    # Drop the old JSON columns to reclaim their space
+    for meal in old_columns:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE meal_plan_day DROP COLUMN {meal}"))
+        except Exception as e:
+            logging.error(f"Could not drop meal_plan_day.{meal}, clearing it instead: {str(e)}")
+            with db.engine.begin() as conn:
+                conn.execute(text(f"UPDATE meal_plan_day SET {meal} = NULL"))
+
+    logging.info(f"Migrated {len(rows)} meal plan days")
+
+def add_meal_plan_day_index():
+    """
+    Add the unique (meal_plan_id, day_of_week) index, removing duplicate days first
+    """
+    indexes = {index['name'] for index in inspect(db.engine).get_indexes('meal_plan_day')}
+    if 'ix_meal_plan_day_plan_day' in indexes:
+        return
+
+    logging.info("Adding unique index on meal_plan_day (meal_plan_id, day_of_week)")
+
+    with db.engine.begin() as conn:
+        # Keep the first row stored for each day of a plan
+        conn.execute(text(
+            "DELETE FROM meal_plan_day WHERE id NOT IN ("
+            "SELECT MIN(id) FROM meal_plan_day GROUP BY meal_plan_id, day_of_week)"
+        ))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX ix_meal_plan_day_plan_day ON meal_plan_day (meal_plan_id, day_of_week)"
+        ))
+
+def add_meal_plan_candidate_pools():
+    """
+    Add the preferences and candidate_pools columns to meal_plan
+    """
+    columns = _columns('meal_plan')
+    with db.engine.begin() as conn:
+        for column in ('preferences', 'candidate_pools'):
+            if column not in columns:
+                logging.info(f"Adding meal_plan.{column}")
+                conn.execute(text(f"ALTER TABLE meal_plan ADD COLUMN {column} JSON"))
+
+def add_meal_plan_version():
+    """
+    Add the macro_targets and version columns to meal_plan
+    """
+    columns = _columns('meal_plan')
+    with db.engine.begin() as conn:
+        if 'macro_targets' not in columns:
+            logging.info("Adding meal_plan.macro_targets")
+            conn.execute(text("ALTER TABLE meal_plan ADD COLUMN macro_targets JSON"))
+        if 'version' not in columns:
+            logging.info("Adding meal_plan.version")
+            conn.execute(text("ALTER TABLE meal_plan ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+def upgrade():
+    """
+    Apply every pending migration; must be called inside an app context
+    """
+    normalize_meal_plan_recipes()
+    add_meal_plan_day_index()
+    add_meal_plan_candidate_pools()
+    add_meal_plan_version()
@@ -1,5 +1,7 @@
 from app import db
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
+from dietary import format_allergens
 from datetime import datetime
 
 class User(UserMixin, db.Model):
@@ -22,6 +24,13 @@ class User(UserMixin, db.Model):
     allergens = db.Column(db.String(255), default="")
     
     meal_plans = db.relationship('MealPlan', backref='user', lazy=True)
+    
+    @validates('allergens')
+    def normalize_allergens(self, key, allergens):
+        """
+        Store allergens in their canonical form (see dietary.py)
+        """
+        return format_allergens(allergens)
 
 class MealPlan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,20 +38,123 @@ class MealPlan(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     name = db.Column(db.String(100), default="Weekly Meal Plan")
     
-    days = db.relationship('MealPlanDay', backref='meal_plan', lazy=True, cascade='all, delete-orphan')
+    # What the plan was generated from, so days and meals can be regenerated
+    # without the session or another search
+    preferences = db.Column(db.JSON, nullable=True)
+    macro_targets = db.Column(db.JSON, nullable=True)
+    candidate_pools = db.Column(db.JSON, nullable=True)  # recipe IDs keyed by meal
+    
+    # Bumped whenever the plan's days change; plan views use it as their ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    
+    days = db.relationship('MealPlanDay', backref='meal_plan', lazy=True, cascade='all, delete-orphan',
+                           order_by='MealPlanDay.day_of_week')
+
+class Recipe(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # upstream (Spoonacular) recipe ID
+    title = db.Column(db.String(255))
+    image = db.Column(db.String(512))
+    ready_in_minutes = db.Column(db.Integer)
+    servings = db.Column(db.Integer)
+    source_url = db.Column(db.String(512))
+    
+    nutrition = db.Column(db.JSON)
+    ingredients = db.Column(db.JSON)
+    instructions = db.Column(db.JSON)
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    @staticmethod
+    def row_from_dict(recipe):
+        """
+        Convert a recipe dict (as returned by meal_planner) into column values
+        Returns None if the recipe has no numeric upstream ID
+        """
+        try:
+            recipe_id = int(recipe['id'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        
+        return {
+            'id': recipe_id,
+            'title': recipe.get('title'),
+            'image': recipe.get('image'),
+            'ready_in_minutes': recipe.get('readyInMinutes'),
+            'servings': recipe.get('servings'),
+            'source_url': recipe.get('sourceUrl'),
+            'nutrition': dict(recipe.get('nutrition') or {}),
+            'ingredients': recipe.get('ingredients') or [],
+            'instructions': recipe.get('instructions') or [],
+            'updated_at': datetime.utcnow()
+        }
+    
+    def to_dict(self):
+        """
+        Return the recipe in the dict format used by meal_planner and the templates
+        """
+        return {
+            'id': self.id,
+            'title': self.title,
+            'image': self.image,
+            'readyInMinutes': self.ready_in_minutes,
+            'servings': self.servings,
+            'sourceUrl': self.source_url,
+            'nutrition': self.nutrition,
+            'ingredients': self.ingredients,
+            'instructions': self.instructions
+        }
 
 class MealPlanDay(db.Model):
+    # Each plan has at most one row per day, and days are looked up by (plan, day)
+    __table_args__ = (
+        db.Index('ix_meal_plan_day_plan_day', 'meal_plan_id', 'day_of_week', unique=True),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     meal_plan_id = db.Column(db.Integer, db.ForeignKey('meal_plan.id'), nullable=False)
     day_of_week = db.Column(db.Integer, nullable=False)  # 0-6 for Monday-Sunday
     
-    breakfast = db.Column(db.JSON, nullable=True)
-    lunch = db.Column(db.JSON, nullable=True)
-    dinner = db.Column(db.JSON, nullable=True)
-    snacks = db.Column(db.JSON, nullable=True)
+    # Meals reference shared Recipe rows instead of storing a copy of the recipe
+    breakfast_id = db.Column(db.Integer, db.ForeignKey('recipe.id'), nullable=True)
+    lunch_id = db.Column(db.Integer, db.ForeignKey('recipe.id'), nullable=True)
+    dinner_id = db.Column(db.Integer, db.ForeignKey('recipe.id'), nullable=True)
+    snacks_id = db.Column(db.Integer, db.ForeignKey('recipe.id'), nullable=True)
+    
+    breakfast_recipe = db.relationship('Recipe', foreign_keys=[breakfast_id])
+    lunch_recipe = db.relationship('Recipe', foreign_keys=[lunch_id])
+    dinner_recipe = db.relationship('Recipe', foreign_keys=[dinner_id])
+    snacks_recipe = db.relationship('Recipe', foreign_keys=[snacks_id])
     
     total_calories = db.Column(db.Float, default=0)
     total_protein = db.Column(db.Float, default=0)
     total_carbs = db.Column(db.Float, default=0)
     total_fat = db.Column(db.Float, default=0)
     total_fiber = db.Column(db.Float, default=0)
+    
+    # Meals as recipe dicts, the shape the templates were written against
+    @property
+    def breakfast(self):
+        return self.breakfast_recipe.to_dict() if self.breakfast_recipe else None
+    
+    @property
+    def lunch(self):
+        return self.lunch_recipe.to_dict() if self.lunch_recipe else None
+    
+    @property
+    def dinner(self):
+        return self.dinner_recipe.to_dict() if self.dinner_recipe else None
+    
+    @property
+    def snacks(self):
+        return self.snacks_recipe.to_dict() if self.snacks_recipe else None
+
+class PlanJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # random hex token
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued, running, done, failed
+    preferences = db.Column(db.JSON, nullable=False)
+    meal_plan_id = db.Column(db.Integer, db.ForeignKey('meal_plan.id'), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,142 @@
+"""
+Nutrient Registry
+
+Every nutrient the planner tracks is listed once in NUTRIENTS, with its name
+in Spoonacular responses and its unit. Recipes and days carry their
+nutrition as a NutrientVector, a fixed-order array of amounts:
+- Parsing, day totals and plan totals work over the registry, so adding a
+  nutrient there is all it takes for it to be parsed, summed and shown
+- A vector takes a fraction of the memory of a dict with the same amounts
+- It reads like the nutrition dicts it replaces (nutrition['protein'],
+  .get(), .items()), so templates and callers don't change
+- JSON can't encode it directly; json_default converts it where recipes
+  are written to the cache, the catalog or a response
+"""
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping
+
+Nutrient = namedtuple('Nutrient', ['name', 'spoonacular_name', 'unit'])
+
+# Tracked nutrients in vector order; the first five are the ones plans are scored on
+NUTRIENTS = (
+    Nutrient('calories', 'Calories', 'kcal'),
+    Nutrient('protein', 'Protein', 'g'),
+    Nutrient('carbs', 'Carbohydrates', 'g'),
+    Nutrient('fat', 'Fat', 'g'),
+    Nutrient('fiber', 'Fiber', 'g'),
+    Nutrient('saturated_fat', 'Saturated Fat', 'g'),
+    Nutrient('sugar', 'Sugar', 'g'),
+    Nutrient('sodium', 'Sodium', 'mg'),
+    Nutrient('cholesterol', 'Cholesterol', 'mg'),
+    Nutrient('potassium', 'Potassium', 'mg'),
+    Nutrient('calcium', 'Calcium', 'mg'),
+    Nutrient('iron', 'Iron', 'mg'),
+    Nutrient('vitamin_c', 'Vitamin C', 'mg'),
+    Nutrient('vitamin_d', 'Vitamin D', 'µg')
+)
+
+NAMES = tuple(nutrient.name for nutrient in NUTRIENTS)
+INDEX = {name: i for i, name in enumerate(NAMES)}
+SPOONACULAR_INDEX = {nutrient.spoonacular_name: i for i, nutrient in enumerate(NUTRIENTS)}
+
+_ZEROS = array('d', bytes(8 * len(NUTRIENTS)))
+
+
+class NutrientVector(Mapping):
+    """
+    Amounts of every registered nutrient, in registry order
+    """
+    __slots__ = ('amounts',)
+
+    def __init__(self, amounts=None):
+        self.amounts = array('d', amounts) if amounts is not None else array('d', _ZEROS)
+
+    @classmethod
+    def of(cls, nutrition):
+        """
+        Return nutrition as a vector; takes a vector, a nutrition dict or None
+        Nutrients missing from a dict count as zero and unknown ones are ignored
+        """
+        if isinstance(nutrition, cls):
+            return nutrition
+        vector = cls()
+        if nutrition:
+            amounts = vector.amounts
+            for name, amount in nutrition.items():
+                i = INDEX.get(name)
+                if i is not None and amount:
+                    amounts[i] = amount
+        return vector
+
+    @classmethod
+    def from_spoonacular(cls, nutrients):
+        """
+        Build a vector from the 'nutrients' list of a Spoonacular nutrition object
+        """
+        vector = cls()
+        amounts = vector.amounts
+        for nutrient in nutrients or ():
+            i = SPOONACULAR_INDEX.get(nutrient.get('name'))
+            if i is not None:
+                amounts[i] = nutrient.get('amount') or 0
+        return vector
+
+    @classmethod
+    def total(cls, nutritions):
+        """
+        Add up any number of vectors or nutrition dicts; None entries are skipped
+        """
+        vector = cls()
+        for nutrition in nutritions:
+            if nutrition is not None:
+                vector += nutrition
+        return vector
+
+    def __iadd__(self, other):
+        amounts = self.amounts
+        for i, amount in enumerate(NutrientVector.of(other).amounts):
+            amounts[i] += amount
+        return self
+
+    def __add__(self, other):
+        vector = NutrientVector(self.amounts)
+        vector += other
+        return vector
+
+    def __sub__(self, other):
+        other = NutrientVector.of(other).amounts
+        return NutrientVector(a - b for a, b in zip(self.amounts, other))
+
+    def __getitem__(self, name):
+        return self.amounts[INDEX[name]]
+
+    def __iter__(self):
+        return iter(NAMES)
+
+    def __len__(self):
+        return len(NAMES)
+
+    def __contains__(self, name):
+        return name in INDEX
+
+    def __reduce__(self):
+        return NutrientVector, (self.amounts,)
+
+    def __repr__(self):
+        return f"NutrientVector({self.to_dict()!r})"
+
+    def to_dict(self):
+        """
+        Return the amounts as a plain dict keyed by nutrient name
+        """
+        return dict(zip(NAMES, self.amounts))
+
+
+def json_default(obj):
+    """
+    json.dumps default= hook that writes nutrient vectors as nutrition dicts
+    """
+    if isinstance(obj, NutrientVector):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,212 @@
+"""
+Background Plan Generation Jobs
+
+Generating a plan waits on Spoonacular, so instead of holding a web worker for
+the whole generation, requests submit a job and poll for its result:
+- submit_plan_job() records a PlanJob and queues it on a bounded thread pool
+- The pool generates the plan and stores it, marking the job done or failed
+- Job status lives in the database, so any worker process can answer a poll
+
+No external broker is needed. Jobs run in the process that accepted them;
+a job whose process dies before it finishes is reported as failed once it
+has been running for longer than JOB_TIMEOUT. Jobs still waiting for a
+worker are never timed out, as under load they may wait a while yet still run.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, db
+from models import PlanJob
+from meal_planner import generate_meal_plan, plan_candidate_pools
+from plan_store import save_meal_plan
+import profiling
+
+# Plans generated at the same time in each process
+MAX_WORKERS = int(os.environ.get("PLAN_JOB_WORKERS", 4))
+
+# Jobs allowed to wait for a worker in each process before new ones are refused
+MAX_QUEUE_DEPTH = int(os.environ.get("PLAN_JOB_QUEUE_LIMIT", 100))
+
+# Seconds after a job has started running after which it is considered lost
+JOB_TIMEOUT = int(os.environ.get("PLAN_JOB_TIMEOUT", 300))
+
+# Number of recent job durations kept for the metrics
+DURATION_SAMPLES = 500
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue is at its limit
+    """
+
+
+_lock = threading.Lock()
+_state = {'pid': None, 'executor': None}
+_metrics = {
+    'queued': 0,
+    'running': 0,
+    'submitted': 0,
+    'succeeded': 0,
+    'failed': 0,
+    'rejected': 0,
+    'durations': [],
+    'queue_waits': []
+}
+
+
+def _get_executor():
+    with _lock:
+        # Thread pools don't survive a fork, so each worker process starts its own
+        if _state['pid'] != os.getpid():
+            _state['pid'] = os.getpid()
+            _state['executor'] = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='plan-job')
+        return _state['executor']
+
+
+def _record(name, amount=1):
+    with _lock:
+        _metrics[name] += amount
+
+
+def _record_sample(name, seconds):
+    with _lock:
+        samples = _metrics[name]
+        samples.append(seconds)
+        if len(samples) > DURATION_SAMPLES:
+            del samples[0]
+
+
+def submit_plan_job(preferences):
+    """
+    Create a job that generates a meal plan for the given preferences
+    Returns the PlanJob; raises QueueFullError if too many jobs are waiting
+    """
+    with _lock:
+        if _metrics['queued'] >= MAX_QUEUE_DEPTH:
+            _metrics['rejected'] += 1
+            raise QueueFullError("Too many meal plans are being generated, please try again shortly")
+        _metrics['queued'] += 1
+        _metrics['submitted'] += 1
+
+    try:
+        job = PlanJob(id=uuid.uuid4().hex, status='queued', preferences=preferences)
+        db.session.add(job)
+        db.session.commit()
+    except Exception:
+        _record('queued', -1)
+        raise
+
+    # A job submitted by a sampled request is sampled too, since that is where its time goes
+    _get_executor().submit(_run_job, job.id, time.monotonic(), profiling.sampled())
+    return job
+
+
+def _run_job(job_id, submitted_at, sample=False):
+    """
+    Generate and store the plan for a job
+    """
+    _record('queued', -1)
+    _record('running')
+    _record_sample('queue_waits', time.monotonic() - submitted_at)
+    started = time.monotonic()
+
+    with app.app_context(), profiling.task(f"plan job {job_id}", sample=sample):
+        try:
+            job = db.session.get(PlanJob, job_id)
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            db.session.commit()
+
+            pools = plan_candidate_pools(job.preferences)
+            meal_plan = generate_meal_plan(job.preferences, pools=pools)
+            db_meal_plan = save_meal_plan(meal_plan, preferences=job.preferences, pools=pools)
+
+            job.meal_plan_id = db_meal_plan.id
+            job.status = 'done'
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            _record('succeeded')
+
+        except Exception as e:
+            logging.error(f"Error running plan job {job_id}: {str(e)}")
+            db.session.rollback()
+            _record('failed')
+
+            job = db.session.get(PlanJob, job_id)
+            if job is not None:
+                job.status = 'failed'
+                job.error = str(e)
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+
+        finally:
+            _record('running', -1)
+            _record_sample('durations', time.monotonic() - started)
+
+
+def get_plan_job(job_id):
+    """
+    Look up a job, marking it failed if it has been running for too long
+    Returns None if there is no such job
+    """
+    job = db.session.get(PlanJob, job_id)
+    if job is None:
+        return None
+
+    # The timeout starts when a worker picks the job up, not when it was queued
+    if (job.status == 'running' and job.started_at is not None
+            and job.started_at < datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT)):
+        job.status = 'failed'
+        job.error = "Meal plan generation timed out"
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    return job
+
+
+def job_to_dict(job):
+    """
+    Format a job for the status API
+    """
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'plan_id': job.meal_plan_id,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+def _summarize(samples):
+    if not samples:
+        return {'count': 0, 'avg': 0, 'p95': 0, 'max': 0}
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'avg': round(sum(ordered) / len(ordered), 4),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        'max': round(ordered[-1], 4)
+    }
+
+
+def job_metrics():
+    """
+    Return queue depth, job counts and recent job durations for this process
+    """
+    with _lock:
+        metrics = {name: value for name, value in _metrics.items() if not isinstance(value, list)}
+        durations = list(_metrics['durations'])
+        queue_waits = list(_metrics['queue_waits'])
+
+    metrics['workers'] = MAX_WORKERS
+    metrics['queue_limit'] = MAX_QUEUE_DEPTH
+    metrics['duration_seconds'] = _summarize(durations)
+    metrics['queue_wait_seconds'] = _summarize(queue_waits)
+    return metrics
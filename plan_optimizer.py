@@ -0,0 +1,141 @@
+"""
+Meal Plan Optimizer
+
+Chooses each day's breakfast, lunch, dinner and snack from the candidate pools
+so that the day's totals land as close as possible to the USDA targets from
+usda_guidelines.get_macronutrient_targets, instead of picking meals at random.
+
+Days are scored by the weighted squared relative deviation of their calories,
+protein, carbs, fat and fiber from the targets (fiber only counts when it falls
+short). Scoring is vectorized over the candidate pools:
+- Every breakfast+lunch and dinner+snack pair is scored against its share of the targets
+- The best pairs of each half are combined and every full day is scored at once
+- Recipes already used earlier in the week carry a variety penalty
+"""
+import os
+
+import numpy as np
+
+from nutrients import NutrientVector, INDEX
+
+NUTRIENTS = ('calories', 'protein', 'carbs', 'fat', 'fiber')
+MEALS = ('breakfast', 'lunch', 'dinner', 'snacks')
+
+# Positions of NUTRIENTS in nutrient vectors
+VECTOR_COLUMNS = [INDEX[name] for name in NUTRIENTS]
+
+# Relative importance of each nutrient's deviation (same order as NUTRIENTS)
+NUTRIENT_WEIGHTS = np.array([2.0, 1.0, 1.0, 1.0, 0.5])
+
+# Score added each time a recipe has already been chosen earlier in the plan
+VARIETY_PENALTY = float(os.environ.get("PLAN_VARIETY_PENALTY", 0.05))
+
+# Number of best breakfast+lunch and dinner+snack pairs combined into full days
+BEAM_WIDTH = 256
+
+
+def target_vector(macro_targets):
+    """
+    Convert get_macronutrient_targets output into a target array ordered like NUTRIENTS
+    """
+    return np.array([
+        macro_targets['calories'],
+        macro_targets['protein']['grams'],
+        macro_targets['carbs']['grams'],
+        macro_targets['fat']['grams'],
+        macro_targets['fiber']['grams']
+    ], dtype=float)
+
+
+def nutrition_matrix(recipes):
+    """
+    Stack the nutrition of a list of recipes into an (n, len(NUTRIENTS)) array
+    Missing recipes count as zero
+    """
+    if not recipes:
+        return np.zeros((0, len(NUTRIENTS)))
+    vectors = [NutrientVector.of((recipe or {}).get('nutrition')).amounts for recipe in recipes]
+    return np.array(vectors)[:, VECTOR_COLUMNS]
+
+
+def deviation_scores(totals, targets):
+    """
+    Score nutrition totals against targets; lower is better and 0 is a perfect day
+    totals can have any number of leading dimensions
+    """
+    relative = (totals - targets) / np.maximum(targets, 1e-9)
+    # Going over the fiber target is fine
+    relative[..., 4] = np.minimum(relative[..., 4], 0)
+    return (relative ** 2) @ NUTRIENT_WEIGHTS
+
+
+def day_score(day_nutrition, macro_targets):
+    """
+    Score one day's nutrition totals against the targets
+    """
+    totals = np.array([day_nutrition.get(name) or 0 for name in NUTRIENTS], dtype=float)
+    return float(deviation_scores(totals, target_vector(macro_targets)))
+
+
+def _best(scores, count):
+    """
+    Return the flat indexes of the `count` lowest scores
+    """
+    scores = scores.ravel()
+    if scores.size <= count:
+        return np.arange(scores.size)
+    return np.argpartition(scores, count)[:count]
+
+
+class PlanOptimizer:
+    """
+    Picks the best-scoring day from a plan's candidate pools, one day at a time
+    """
+
+    def __init__(self, pools, macro_targets, meal_shares):
+        # An empty pool still needs one (empty) choice so the day can be built
+        self.candidates = {meal: list(pools.get(meal) or []) or [None] for meal in MEALS}
+        self.matrices = {meal: nutrition_matrix(self.candidates[meal]) for meal in MEALS}
+        self.uses = {meal: np.zeros(len(self.candidates[meal])) for meal in MEALS}
+        self.targets = target_vector(macro_targets)
+        self.first_half_targets = self.targets * (meal_shares['breakfast'] + meal_shares['lunch'])
+        self.second_half_targets = self.targets * (meal_shares['dinner'] + meal_shares['snacks'])
+
+    def _pairs(self, first, second, targets):
+        """
+        Return the best pairs of two meals as (first indexes, second indexes, totals, penalties)
+        """
+        totals = self.matrices[first][:, None, :] + self.matrices[second][None, :, :]
+        penalties = VARIETY_PENALTY * (self.uses[first][:, None] + self.uses[second][None, :])
+
+        best = _best(deviation_scores(totals, targets) + penalties, BEAM_WIDTH)
+        first_index, second_index = np.unravel_index(best, penalties.shape)
+        return first_index, second_index, totals[first_index, second_index], penalties[first_index, second_index]
+
+    def next_day(self):
+        """
+        Choose the next day's meals
+        Returns the meals keyed by meal name and the day's deviation score
+        """
+        breakfast, lunch, first_totals, first_penalties = self._pairs('breakfast', 'lunch', self.first_half_targets)
+        dinner, snacks, second_totals, second_penalties = self._pairs('dinner', 'snacks', self.second_half_targets)
+
+        # Score every combination of the best pairs
+        totals = first_totals[:, None, :] + second_totals[None, :, :]
+        deviations = deviation_scores(totals, self.targets)
+        scores = deviations + first_penalties[:, None] + second_penalties[None, :]
+
+        first, second = np.unravel_index(np.argmin(scores), scores.shape)
+        chosen = {
+            'breakfast': breakfast[first],
+            'lunch': lunch[first],
+            'dinner': dinner[second],
+            'snacks': snacks[second]
+        }
+
+        meals = {}
+        for meal, index in chosen.items():
+            self.uses[meal][index] += 1
+            meals[meal] = self.candidates[meal][index]
+
+        return meals, float(deviations[first, second])
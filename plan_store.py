@@ -0,0 +1,338 @@
+"""
+Meal Plan Persistence
+
+Functions for storing generated meal plans in the database and loading them back.
+Recipes are stored once in the recipe table and referenced by the plan days:
+- Writes upsert every recipe of a plan in one statement and insert all of its days in another;
+  batches of plans are written the same way, with one more statement for the plans themselves
+- Fallback recipes and placeholders are only stored for IDs with no stored recipe, so
+  they never replace a real recipe other plans reference
+- Streamed plans are written one day at a time as the days are generated
+- Plans keep the preferences and candidate recipes they were generated from,
+  so days and single meals can be swapped later without calling upstream
+- Reads load a plan, its days (in day order) and all of its recipes in three queries
+- Every change to a stored plan's days bumps its version, which plan views use as their ETag
+"""
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import selectinload
+
+from app import db
+import metrics
+from meal_planner import is_fallback_recipe
+from models import MealPlan, MealPlanDay, Recipe
+from usda_guidelines import get_macronutrient_targets
+
+MEALS = ('breakfast', 'lunch', 'dinner', 'snacks')
+NUTRIENTS = ('calories', 'protein', 'carbs', 'fat', 'fiber')
+
+def _upsert_statement(rows, overwrite=True):
+    """
+    Build an INSERT ... ON CONFLICT DO UPDATE statement for recipe rows, or
+    ON CONFLICT DO NOTHING when stored rows mustn't be overwritten
+    Returns None on databases without ON CONFLICT support
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+
+    statement = insert(Recipe.__table__)
+    if not overwrite:
+        return statement.on_conflict_do_nothing(index_elements=['id'])
+    return statement.on_conflict_do_update(
+        index_elements=['id'],
+        set_={column: statement.excluded[column] for column in rows[0] if column != 'id'}
+    )
+
+def upsert_recipes(recipes):
+    """
+    Insert or update the given recipe dicts in bulk
+    Fallback recipes and placeholders are only inserted where no recipe with
+    their ID is stored yet, as other plans may reference the real recipe
+    Returns the recipe IDs in the same order (None for recipes that can't be stored)
+    """
+    rows = {}
+    placeholders = {}
+    recipe_ids = []
+    for recipe in recipes:
+        row = Recipe.row_from_dict(recipe) if recipe else None
+        if row is None:
+            recipe_ids.append(None)
+            continue
+        if is_fallback_recipe(recipe):
+            placeholders.setdefault(row['id'], row)
+        else:
+            rows[row['id']] = row
+        recipe_ids.append(row['id'])
+
+    # A real copy of a recipe in the same batch wins over its placeholder
+    placeholders = [row for recipe_id, row in placeholders.items() if recipe_id not in rows]
+
+    if rows:
+        rows = list(rows.values())
+        statement = _upsert_statement(rows)
+        if statement is not None:
+            db.session.execute(statement, rows)
+        else:
+            for row in rows:
+                db.session.merge(Recipe(**row))
+
+    if placeholders:
+        statement = _upsert_statement(placeholders, overwrite=False)
+        if statement is not None:
+            db.session.execute(statement, placeholders)
+        else:
+            for row in placeholders:
+                if db.session.get(Recipe, row['id']) is None:
+                    db.session.add(Recipe(**row))
+
+    return recipe_ids
+
+def _day_columns(day, recipe_ids):
+    """
+    Column values for a plan day given its recipe IDs in MEALS order
+    """
+    columns = {f"{meal}_id": recipe_id for meal, recipe_id in zip(MEALS, recipe_ids)}
+    columns.update(
+        total_calories=day['nutrition']['calories'],
+        total_protein=day['nutrition']['protein'],
+        total_carbs=day['nutrition']['carbs'],
+        total_fat=day['nutrition']['fat'],
+        total_fiber=day['nutrition']['fiber']
+    )
+    return columns
+
+def _pool_recipes(pools):
+    return [recipe for meal in MEALS for recipe in pools.get(meal) or [] if recipe]
+
+def _pool_ids(pools):
+    return {meal: [recipe['id'] for recipe in pools.get(meal) or [] if recipe] for meal in MEALS}
+
+def plan_macro_targets(preferences):
+    """
+    Return the macronutrient targets stored with a plan generated from preferences
+    """
+    return get_macronutrient_targets(preferences.get('calorie_target', 2000))
+
+def bump_version(plan_id):
+    """
+    Mark a plan as changed so cached views of it are no longer served
+    The caller is responsible for committing
+    """
+    db.session.execute(update(MealPlan).where(MealPlan.id == plan_id).values(version=MealPlan.version + 1))
+
+def create_meal_plan(name="Weekly Meal Plan", preferences=None, pools=None):
+    """
+    Add an empty meal plan and assign its ID, ready for days to be saved into
+    Only the IDs of the recipes in pools are recorded, not the recipes themselves
+    Returns the new MealPlan; the caller is responsible for committing
+    """
+    # Store meal plan in database (for anonymous user)
+    db_meal_plan = MealPlan(
+        name=name,
+        preferences=preferences,
+        macro_targets=plan_macro_targets(preferences) if preferences else None,
+        candidate_pools=_pool_ids(pools) if pools else None
+    )
+    db.session.add(db_meal_plan)
+    db.session.flush()
+    return db_meal_plan
+
+@metrics.plan_phase('persist')
+def save_meal_plan(meal_plan, name="Weekly Meal Plan", preferences=None, pools=None):
+    """
+    Store a generated meal plan and its days, along with the preferences and
+    candidate pools it was generated from
+    Returns the new MealPlan; the caller is responsible for committing
+    """
+    db_meal_plan = create_meal_plan(name, preferences, pools)
+
+    # Store every recipe in the plan and its pools at once, then insert all days in one statement
+    day_recipes = [day[meal] for day in meal_plan for meal in MEALS]
+    recipe_ids = upsert_recipes(day_recipes + (_pool_recipes(pools) if pools else []))
+
+    day_rows = []
+    for i, day in enumerate(meal_plan):
+        day_recipe_ids = recipe_ids[i * len(MEALS):(i + 1) * len(MEALS)]
+        day_rows.append(dict(_day_columns(day, day_recipe_ids), meal_plan_id=db_meal_plan.id, day_of_week=i))
+
+    if day_rows:
+        db.session.execute(insert(MealPlanDay), day_rows)
+
+    return db_meal_plan
+
+@metrics.plan_phase('persist')
+def save_meal_plans(plans, name="Weekly Meal Plan"):
+    """
+    Store many generated plans at once, given as (meal_plan, preferences, pools)
+    tuples: one statement inserts the plans, one upserts every recipe they use
+    and one inserts all of their days
+    Returns the new plan IDs in order; the caller is responsible for committing
+    """
+    if not plans:
+        return []
+
+    plan_rows = [
+        {
+            'name': name,
+            'preferences': preferences,
+            'macro_targets': plan_macro_targets(preferences) if preferences else None,
+            'candidate_pools': _pool_ids(pools) if pools else None
+        }
+        for _, preferences, pools in plans
+    ]
+    plan_ids = db.session.scalars(
+        insert(MealPlan).returning(MealPlan.id, sort_by_parameter_order=True), plan_rows
+    ).all()
+
+    # Plans generated together often share their pools, so store each pool object's recipes once
+    shared_pools = {id(pools): pools for _, _, pools in plans if pools}
+    day_recipes = [day[meal] for meal_plan, _, _ in plans for day in meal_plan for meal in MEALS]
+    pool_recipes = [recipe for pools in shared_pools.values() for recipe in _pool_recipes(pools)]
+    recipe_ids = upsert_recipes(day_recipes + pool_recipes)
+
+    day_rows = []
+    offset = 0
+    for plan_id, (meal_plan, _, _) in zip(plan_ids, plans):
+        for i, day in enumerate(meal_plan):
+            day_recipe_ids = recipe_ids[offset:offset + len(MEALS)]
+            offset += len(MEALS)
+            day_rows.append(dict(_day_columns(day, day_recipe_ids), meal_plan_id=plan_id, day_of_week=i))
+
+    if day_rows:
+        db.session.execute(insert(MealPlanDay), day_rows)
+
+    return plan_ids
+
+@metrics.plan_phase('persist_day')
+def save_plan_day(plan_id, day_index, day):
+    """
+    Store one generated day of a plan created with create_meal_plan
+    The caller is responsible for committing
+    """
+    recipe_ids = upsert_recipes([day[meal] for meal in MEALS])
+    db.session.execute(
+        insert(MealPlanDay),
+        [dict(_day_columns(day, recipe_ids), meal_plan_id=plan_id, day_of_week=day_index)]
+    )
+    bump_version(plan_id)
+
+def save_candidate_pools(plan_id, pools):
+    """
+    Store the candidate recipes a plan's meals are chosen from
+    The caller is responsible for committing
+    """
+    upsert_recipes(_pool_recipes(pools))
+    db.session.execute(update(MealPlan).where(MealPlan.id == plan_id).values(candidate_pools=_pool_ids(pools)))
+
+def load_candidate_pools(meal_plan):
+    """
+    Load the stored candidate recipes of a plan in one query
+    Returns recipe dicts keyed by meal, or None for plans stored without pools
+    """
+    pool_ids = meal_plan.candidate_pools
+    if not pool_ids:
+        return None
+
+    recipe_ids = {recipe_id for ids in pool_ids.values() for recipe_id in ids}
+    recipes = {recipe.id: recipe for recipe in Recipe.query.filter(Recipe.id.in_(recipe_ids))}
+    # Hold a reference so the recipes stay in the session's identity map
+    meal_plan.loaded_pool_recipes = list(recipes.values())
+
+    return {
+        meal: [recipes[recipe_id].to_dict() for recipe_id in pool_ids.get(meal, []) if recipe_id in recipes]
+        for meal in MEALS
+    }
+
+def replace_meal(meal_day, meal, recipe):
+    """
+    Swap one meal of a stored day for another recipe, adjusting the day's
+    totals by the difference between the two recipes
+    The caller is responsible for bumping the plan's version and committing
+    """
+    old_recipe = getattr(meal_day, meal)
+    new_row = db.session.get(Recipe, recipe['id'])
+    if new_row is None:
+        upsert_recipes([recipe])
+        new_row = db.session.get(Recipe, recipe['id'])
+    setattr(meal_day, f"{meal}_recipe", new_row)
+
+    old_nutrition = (old_recipe or {}).get('nutrition') or {}
+    new_nutrition = recipe.get('nutrition') or {}
+    for nutrient in NUTRIENTS:
+        column = f"total_{nutrient}"
+        change = (new_nutrition.get(nutrient) or 0) - (old_nutrition.get(nutrient) or 0)
+        setattr(meal_day, column, (getattr(meal_day, column) or 0) + change)
+
+def load_plan_days(meal_plan):
+    """
+    Load the days of a plan along with all of their recipes
+    Recipes are fetched in one query and kept in the session, so reading
+    day.breakfast and the other meals doesn't query the database again
+    """
+    days = meal_plan.days
+
+    recipe_ids = {getattr(day, f"{meal}_id") for day in days for meal in MEALS} - {None}
+    if recipe_ids:
+        # Hold a reference so the recipes stay in the session's identity map
+        meal_plan.loaded_recipes = Recipe.query.filter(Recipe.id.in_(recipe_ids)).all()
+
+    return days
+
+def plan_version(plan_id):
+    """
+    Return the current version of a plan without loading it, or None if there is no such plan
+    """
+    return db.session.query(MealPlan.version).filter(MealPlan.id == plan_id).scalar()
+
+def load_plan_averages(plan_ids):
+    """
+    Load the average daily nutrition of many plans in two queries, averaged by the database
+    Returns {plan_id: (preferences, [average of each of NUTRIENTS])} for the plans that have days
+    """
+    columns = [func.avg(func.coalesce(getattr(MealPlanDay, f"total_{nutrient}"), 0)) for nutrient in NUTRIENTS]
+    averages = {
+        plan_id: [float(average) for average in plan_averages]
+        for plan_id, *plan_averages in db.session.query(MealPlanDay.meal_plan_id, *columns)
+        .filter(MealPlanDay.meal_plan_id.in_(plan_ids))
+        .group_by(MealPlanDay.meal_plan_id)
+    }
+    if not averages:
+        return {}
+
+    preferences = db.session.query(MealPlan.id, MealPlan.preferences).filter(MealPlan.id.in_(averages))
+    return {plan_id: (plan_preferences, averages[plan_id]) for plan_id, plan_preferences in preferences}
+
+def load_plan(plan_id):
+    """
+    Load a plan with its days eagerly loaded in day order and all of its recipes
+    Returns (meal_plan, days), or (None, []) if there is no such plan
+    """
+    meal_plan = db.session.get(MealPlan, plan_id, options=[selectinload(MealPlan.days)])
+    if meal_plan is None:
+        return None, []
+    return meal_plan, load_plan_days(meal_plan)
+
+def plan_to_dict(meal_plan, days):
+    """
+    Return a loaded plan and its days as a JSON-serializable dict
+    """
+    return {
+        'id': meal_plan.id,
+        'name': meal_plan.name,
+        'created_at': meal_plan.created_at.isoformat() if meal_plan.created_at else None,
+        'version': meal_plan.version,
+        'preferences': meal_plan.preferences,
+        'macro_targets': meal_plan.macro_targets,
+        'days': [
+            {
+                'day_of_week': day.day_of_week,
+                'meals': {meal: getattr(day, meal) for meal in MEALS},
+                'nutrition': {nutrient: getattr(day, f"total_{nutrient}") for nutrient in NUTRIENTS}
+            }
+            for day in days
+        ]
+    }
@@ -0,0 +1,77 @@
+"""
+Worker Preloading
+
+With gunicorn's preload_app (on by default in gunicorn.conf.py) the app is
+imported once in the master and workers are forked from it:
+- Schema checks and migrations run once, in the master, rather than in every worker
+- The recipe snapshot is mapped and the recipe catalog index and similar
+  recipe index are built before the fork, so a new worker starts with them
+  and shares their pages with the master copy-on-write
+- Objects that exist at fork time are moved out of the garbage collector's
+  reach, since collecting them writes to (and so copies) the shared pages
+- Database connections opened in the master are dropped in every worker,
+  so no two processes ever use the same connection
+
+Without preloading, each worker builds the indexes itself before it takes
+its first request.
+"""
+import gc
+import time
+import logging
+
+from app import app, db
+from recipe_cache import cache
+from recipe_catalog import catalog
+from recipe_snapshot import snapshots
+from similar_recipes import similar
+
+
+def warm():
+    """
+    Build the in-process recipe indexes and compile the templates
+    Returns the seconds spent on each
+    """
+    timings = {}
+
+    started = time.perf_counter()
+    snapshots.current()
+    timings['snapshot'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    catalog.load()
+    timings['catalog'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    similar.load()
+    timings['similar'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    timings['templates'] = time.perf_counter() - started
+
+    # Connections must not be carried across a fork; each process opens its own
+    catalog.close()
+    cache.close()
+
+    logging.info(
+        "Preloaded " + ", ".join(f"{name} in {seconds:.2f}s" for name, seconds in timings.items())
+    )
+    return timings
+
+
+def freeze():
+    """
+    Keep the garbage collector away from every object that exists now; call right before forking
+    """
+    gc.collect()
+    gc.freeze()
+
+
+def after_fork():
+    """
+    Drop the database connections inherited from the master; call in every new worker
+    """
+    with app.app_context():
+        # close=False leaves the master's connections open for the master
+        db.engine.dispose(close=False)
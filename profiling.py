@@ -0,0 +1,445 @@
+"""
+Request Profiling
+
+Shows where the time of slow requests goes:
+- Every request records the time spent in each phase: Spoonacular round
+  trips, decoding their JSON into recipes, database flushes and commits,
+  template rendering and the plan generation phases. The slowest recent
+  requests of each worker are listed with that breakdown at /admin/profiles
+- Phases nest (upstream calls happen inside the search phase) and are
+  summed over the threads working for a request, so they can add up to
+  more than the request took
+- Some requests are also profiled by a stack sampler: a background thread
+  reads the request thread's stack every PROFILE_INTERVAL seconds, so the
+  request itself runs no profiling code between samples
+- A request is sampled when it sends an X-Profile header with the
+  PROFILE_TOKEN, or at random at PROFILE_SAMPLE_RATE. Plan jobs submitted
+  by a sampled request are sampled too
+- Sampled profiles are written to PROFILE_DIR in collapsed stack format
+  (one "frame;frame;frame count" line per distinct stack), which
+  flamegraph.pl, speedscope and similar tools read, with a JSON summary
+  beside each one
+
+It is safe to leave on: at most PROFILE_MAX_ACTIVE requests per worker are
+sampled at once, only the newest PROFILE_KEEP profiles are kept, and
+without a PROFILE_TOKEN neither the header nor the admin endpoints work.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import random
+import logging
+import sysconfig
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from flask import g, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+# Share of requests sampled without being asked to be (0 turns random sampling off)
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+# Token a request sends in the X-Profile header to be sampled, and an admin sends to read profiles
+TOKEN = os.environ.get("PROFILE_TOKEN") or None
+
+# Where sampled profiles are written
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Seconds between stack samples
+INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+
+# Most requests sampled at once in each process; others still record their phases
+MAX_ACTIVE = int(os.environ.get("PROFILE_MAX_ACTIVE", 2))
+
+# Newest profiles kept in PROFILE_DIR
+KEEP = int(os.environ.get("PROFILE_KEEP", 200))
+
+# Recent requests each process remembers for the slowest request list
+RECENT_REQUESTS = int(os.environ.get("PROFILE_RECENT_REQUESTS", 500))
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STDLIB = sysconfig.get_paths()['stdlib']
+
+# Profile of the request or task being handled; copied into parallel_map worker threads
+_current = contextvars.ContextVar('profile', default=None)
+
+_lock = threading.Lock()
+_recent = deque(maxlen=RECENT_REQUESTS)
+_state = {'sequence': 0}
+
+
+class Profile:
+    """
+    Phase times and, when sampled, stack samples of one request or background task
+    """
+
+    def __init__(self, kind, name, sampled):
+        self.kind = kind
+        self.name = name
+        self.sampled = sampled
+        self.thread_id = threading.get_ident()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.status = None
+        self.phases = {}
+        self.stacks = {}
+        self._lock = threading.Lock()
+
+    def record(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def add_sample(self, stack):
+        # Only the sampler thread adds samples
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class StackSampler:
+    """
+    Background thread sampling the stacks of the threads being profiled
+    It sleeps until a profile starts and stops sampling when none is running
+    """
+
+    def __init__(self, interval=INTERVAL, max_active=MAX_ACTIVE):
+        self.interval = interval
+        self.max_active = max_active
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._active = {}
+        self._thread = None
+        self._pid = None
+        self._labels = {}
+
+    def add(self, profile):
+        """
+        Start sampling a profile's thread; returns False if too many are sampled already
+        """
+        with self._lock:
+            # Threads don't survive a fork, so each worker starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._active = {}
+                self._thread = None
+            if len(self._active) >= self.max_active:
+                return False
+            self._active[profile.thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+            self._wake.set()
+            return True
+
+    def remove(self, profile):
+        with self._lock:
+            if self._active.get(profile.thread_id) is profile:
+                del self._active[profile.thread_id]
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                active = list(self._active.values())
+                if not active:
+                    self._wake.clear()
+                    continue
+            frames = sys._current_frames()
+            for profile in active:
+                frame = frames.get(profile.thread_id)
+                if frame is not None:
+                    profile.add_sample(self._collapse(frame))
+            del frames
+            time.sleep(self.interval)
+
+    def _collapse(self, frame):
+        """
+        Return a stack as collapsed stack frames, outermost first
+        """
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = _label(code)
+            labels.append(label)
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+
+def _label(code):
+    """
+    Name a function as "qualified name (file:line)", with files relative to the app, site-packages or the standard library
+    """
+    path = code.co_filename
+    if 'site-packages' + os.sep in path:
+        path = path.split('site-packages' + os.sep, 1)[1]
+    else:
+        for prefix in (ROOT, STDLIB):
+            if path.startswith(prefix + os.sep):
+                path = path[len(prefix) + 1:]
+                break
+    name = getattr(code, 'co_qualname', code.co_name)
+    # Semicolons separate frames in the collapsed format
+    return f"{name} ({path}:{code.co_firstlineno})".replace(';', ':')
+
+
+sampler = StackSampler()
+
+
+def sampled():
+    """
+    Whether the request or task being handled is being sampled
+    """
+    profile = _current.get()
+    return profile is not None and profile.sampled
+
+
+def record(phase, seconds):
+    """
+    Add time spent in a phase to the current profile, if any
+    """
+    profile = _current.get()
+    if profile is not None:
+        profile.record(phase, seconds)
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a phase of the current request or task; use as a context manager or decorator
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record(name, time.perf_counter() - started)
+
+
+def start(kind, name, sample=False):
+    """
+    Begin profiling the work this thread is about to do
+    The stack is only sampled if the sampler has room for another profile
+    """
+    profile = Profile(kind, name, False)
+    if sample:
+        profile.sampled = sampler.add(profile)
+    _current.set(profile)
+    return profile
+
+
+def finish(profile, status=None):
+    """
+    Stop profiling, remember the summary and save the stacks of a sampled profile
+    Returns the summary
+    """
+    sampler.remove(profile)
+    if _current.get() is profile:
+        _current.set(None)
+
+    phases = sorted(profile.phases.items(), key=lambda item: item[1], reverse=True)
+    summary = {
+        'kind': profile.kind,
+        'name': profile.name,
+        'status': status,
+        'pid': os.getpid(),
+        'started_at': round(profile.started_at, 3),
+        'duration_ms': round((time.perf_counter() - profile.started) * 1000, 2),
+        'phases_ms': {name: round(seconds * 1000, 2) for name, seconds in phases},
+        'profile': None
+    }
+    if profile.sampled:
+        summary['samples'] = sum(profile.stacks.values())
+        summary['profile'] = _save(profile, summary)
+
+    with _lock:
+        _recent.append(summary)
+    return summary
+
+
+@contextmanager
+def task(name, sample=False):
+    """
+    Profile a background task, such as a plan job, the way requests are profiled
+    """
+    profile = start('task', name, sample)
+    try:
+        yield profile
+    finally:
+        finish(profile)
+
+
+def _save(profile, summary):
+    """
+    Write a sampled profile's stacks and summary to PROFILE_DIR and drop the oldest profiles
+    Returns the profile ID, or None if it couldn't be written
+    """
+    with _lock:
+        _state['sequence'] += 1
+        sequence = _state['sequence']
+    started = time.strftime('%Y%m%d-%H%M%S', time.localtime(profile.started_at))
+    profile_id = f"{started}-{os.getpid()}-{sequence}"
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.collapsed"), 'w') as f:
+            for stack, count in sorted(profile.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), 'w') as f:
+            json.dump(dict(summary, profile=profile_id, interval=sampler.interval), f)
+        _prune()
+    except OSError as e:
+        logging.error(f"Error saving profile {profile_id}: {str(e)}")
+        return None
+    return profile_id
+
+
+def _prune():
+    """
+    Delete all but the newest KEEP profiles; every worker prunes the shared directory
+    """
+    profile_ids = sorted(name[:-5] for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+    for profile_id in profile_ids[:-KEEP]:
+        for extension in ('.json', '.collapsed'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, profile_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+def slowest(limit=20):
+    """
+    Return the summaries of this process's slowest recent requests and tasks, slowest first
+    """
+    with _lock:
+        recent = list(_recent)
+    recent.sort(key=lambda summary: summary['duration_ms'], reverse=True)
+    return recent[:limit]
+
+
+def saved(limit=20):
+    """
+    Return the summaries of the newest saved profiles of every process, newest first
+    """
+    try:
+        names = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith('.json')), reverse=True)
+    except FileNotFoundError:
+        return []
+
+    summaries = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            # Pruned by another worker, or still being written
+            continue
+    return summaries
+
+
+def profile_path(profile_id):
+    """
+    Return the path of a saved profile's collapsed stacks, or None if there is no such profile
+    """
+    if not profile_id.replace('-', '').isalnum():
+        return None
+    path = os.path.join(os.path.abspath(PROFILE_DIR), f"{profile_id}.collapsed")
+    return path if os.path.exists(path) else None
+
+
+def _token_matches(value):
+    return TOKEN is not None and value is not None and hmac.compare_digest(value.encode(), TOKEN.encode())
+
+
+def should_sample():
+    """
+    Whether to sample the current request: it asked to be, with the token, or it was picked at random
+    """
+    if _token_matches(request.headers.get('X-Profile')):
+        return True
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def authorized():
+    """
+    Whether the current request carries the token as a bearer token, as the admin endpoints require
+    """
+    header = request.headers.get('Authorization', '')
+    return header.startswith('Bearer ') and _token_matches(header[len('Bearer '):])
+
+
+def _before_request():
+    g.profile = start('request', f"{request.method} {request.path}", should_sample())
+
+
+def _after_request(response):
+    profile = g.get('profile')
+    if profile is not None:
+        profile.status = response.status_code
+    return response
+
+
+def _teardown_request(error):
+    # Runs after a streamed response has been sent, so streamed work is included
+    profile = g.pop('profile', None)
+    if profile is not None:
+        finish(profile, 500 if error is not None else profile.status)
+
+
+def _before_render(sender, template, context, **extra):
+    g.profile_render_started = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    started = g.pop('profile_render_started', None)
+    if started is not None:
+        record('render', time.perf_counter() - started)
+
+
+def _before_flush(session, flush_context, instances):
+    session.info['profile_flush_started'] = time.perf_counter()
+
+
+def _after_flush(session, flush_context):
+    started = session.info.pop('profile_flush_started', None)
+    if started is not None:
+        record('db_flush', time.perf_counter() - started)
+
+
+def _before_commit(session):
+    session.info['profile_commit_started'] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop('profile_commit_started', None)
+    if started is not None:
+        record('db_commit', time.perf_counter() - started)
+
+
+def _after_rollback(session):
+    session.info.pop('profile_commit_started', None)
+    session.info.pop('profile_flush_started', None)
+
+
+def init_app(app, db):
+    """
+    Profile every request, and time template rendering and database flushes and commits
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    event.listen(db.session, 'before_flush', _before_flush)
+    event.listen(db.session, 'after_flush_postexec', _after_flush)
+    event.listen(db.session, 'before_commit', _before_commit)
+    event.listen(db.session, 'after_commit', _after_commit)
+    event.listen(db.session, 'after_rollback', _after_rollback)
@@ -0,0 +1,329 @@
+"""
+Spoonacular Quota and Rate Limiting
+
+Every worker shares one Spoonacular API key, so its request rate and daily
+point quota are tracked in a local SQLite file that all worker processes on
+the host use:
+- A token bucket limits requests per second, waiting briefly for a token when empty
+- A daily ledger counts the points spent; the X-API-Quota-Used and X-API-Quota-Left
+  headers of every response correct it and reveal the key's actual daily quota
+- The last part of the quota is held back for cache fills (recipes and searches
+  with no cached copy at all); refreshes of expired entries and hedged duplicate
+  requests are refused once only the reserve is left, so callers serve the cache
+- status() reports the remaining quota so operators can see degradation coming
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+import metrics
+
+# Quota configuration (all values can be overridden from the environment)
+QUOTA_PATH = os.environ.get("SPOONACULAR_QUOTA_PATH", "spoonacular_quota.db")
+# Points per day until the headers report the key's quota; 0 for no limit until then, so a
+# fresh ledger doesn't hold a paid key to the free tier's quota
+DAILY_QUOTA = float(os.environ.get("SPOONACULAR_DAILY_QUOTA", 0))
+RESERVE_SHARE = float(os.environ.get("SPOONACULAR_QUOTA_RESERVE", 0.2))  # share of the quota kept for cache fills
+RATE_LIMIT = float(os.environ.get("SPOONACULAR_RATE_LIMIT", 5))        # requests per second, 0 for no limit
+BURST = float(os.environ.get("SPOONACULAR_RATE_BURST", 10))
+MAX_WAIT = float(os.environ.get("SPOONACULAR_RATE_MAX_WAIT", 2))       # seconds to wait for a token
+
+# Spoonacular point costs: a base cost per request plus a cost per result or recipe
+ENDPOINT_COSTS = {
+    'complexSearch': (1, 0.01),
+    'informationBulk': (1, 0.5),
+    'information': (1, 0)
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_bucket (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quota_ledger (
+    day TEXT PRIMARY KEY,
+    used REAL NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 0,
+    quota REAL
+);
+"""
+
+
+class QuotaExceeded(requests.ConnectionError):
+    """
+    Raised instead of calling upstream when the daily quota doesn't allow the call
+    """
+
+
+class RateLimited(QuotaExceeded):
+    """
+    Raised when no request token became available within the allowed wait
+    """
+
+
+def request_cost(endpoint, params=None):
+    """
+    Estimate the quota points a request will use
+    """
+    base, per_item = ENDPOINT_COSTS.get(endpoint, (1, 0))
+    params = params or {}
+    if endpoint == 'informationBulk':
+        items = len(str(params.get('ids', '')).split(','))
+        return base + per_item * max(0, items - 1)
+    return base + per_item * int(params.get('number', 0))
+
+
+def _today():
+    # Spoonacular resets quotas at midnight UTC
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+
+class QuotaLimiter:
+    """
+    Token bucket and daily quota ledger shared by every process using the same file
+    """
+
+    def __init__(self, path=QUOTA_PATH, daily_quota=DAILY_QUOTA, reserve_share=RESERVE_SHARE,
+                 rate_limit=RATE_LIMIT, burst=BURST, max_wait=MAX_WAIT):
+        self.path = path
+        self.daily_quota = daily_quota
+        self.reserve_share = reserve_share
+        self.rate_limit = rate_limit
+        self.burst = max(1, burst)
+        self.max_wait = max_wait
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {
+            'allowed': 0,
+            'waits': 0,
+            'rate_limited': 0,
+            'quota_rejections': 0,
+            'errors': 0
+        }
+
+    def _connection(self):
+        """
+        Return this thread's connection, reconnecting after a fork
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _reserve(self, cost, priority):
+        """
+        Take a token and book the cost against today's quota in one transaction
+        Returns 0 on success, the seconds until a token is available, or None
+        if the quota doesn't allow the call
+        """
+        now = time.time()
+        day = _today()
+        conn = self._connection()
+
+        with conn:
+            # Take the write lock up front so concurrent workers can't both spend the last token
+            conn.execute("BEGIN IMMEDIATE")
+
+            row = conn.execute("SELECT used, quota FROM quota_ledger WHERE day = ?", (day,)).fetchone()
+            limit = self._limit(row[1] if row else None)
+            if limit:
+                # Only cache fills may dip into the reserve
+                floor = 0 if priority == 'fill' else limit * self.reserve_share
+                if limit - (row[0] if row else 0) - cost < floor:
+                    return None
+
+            if self.rate_limit > 0:
+                row = conn.execute("SELECT tokens, updated_at FROM rate_bucket WHERE id = 1").fetchone()
+                tokens, updated_at = row if row else (self.burst, now)
+                tokens = min(self.burst, tokens + max(0, now - updated_at) * self.rate_limit)
+                if tokens < 1:
+                    return (1 - tokens) / self.rate_limit
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_bucket (id, tokens, updated_at) VALUES (1, ?, ?)",
+                    (tokens - 1, now)
+                )
+
+            conn.execute(
+                "INSERT INTO quota_ledger (day, used, requests) VALUES (?, ?, 1) "
+                "ON CONFLICT (day) DO UPDATE SET used = used + excluded.used, requests = requests + 1",
+                (day, cost)
+            )
+            return 0
+
+    def _limit(self, reported_quota):
+        # The quota reported by Spoonacular wins over the configured one
+        limit = reported_quota if reported_quota is not None else self.daily_quota
+        return limit if limit > 0 else None
+
+    def _ledger(self):
+        """
+        Return (used, requests, limit) for today; limit is None without a daily quota
+        """
+        row = self._connection().execute(
+            "SELECT used, requests, quota FROM quota_ledger WHERE day = ?", (_today(),)
+        ).fetchone()
+        used, requests_today, reported_quota = row if row else (0, 0, None)
+        return used, requests_today, self._limit(reported_quota)
+
+    def acquire(self, endpoint, params=None, priority='fill', max_wait=None):
+        """
+        Wait for a request token and book the request against the daily quota
+        priority is 'fill' for data with no cached copy, or 'refresh' for
+        data that could be served from an expired cache entry instead
+        Raises QuotaExceeded if the quota doesn't allow the call and
+        RateLimited if no token is available within max_wait seconds
+        """
+
+        cost = request_cost(endpoint, params)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        waited = 0
+
+        while True:
+            try:
+                wait = self._reserve(cost, priority)
+            except sqlite3.Error as e:
+                # Don't take the API down with the ledger
+                logging.error(f"Quota ledger error, allowing {endpoint} call: {str(e)}")
+                self._count('errors')
+                return
+
+            if wait is None:
+                self._count('quota_rejections')
+                metrics.QUOTA_REJECTIONS.labels(priority).inc()
+                raise QuotaExceeded(f"Spoonacular daily quota is too low for a {priority} {endpoint} call")
+
+            if wait == 0:
+                self._count('allowed')
+                if waited:
+                    self._count('waits')
+                    metrics.RATE_LIMIT_WAIT_SECONDS.observe(waited)
+                return
+
+            if waited + wait > max_wait:
+                self._count('rate_limited')
+                raise RateLimited(f"No Spoonacular request token available for {endpoint}")
+
+            time.sleep(wait)
+            waited += wait
+
+    def record_response(self, headers):
+        """
+        Bring today's ledger in line with the quota headers of a Spoonacular response
+        """
+        used = headers.get('X-API-Quota-Used')
+        if used is None:
+            return
+
+        try:
+            used = float(used)
+            left = headers.get('X-API-Quota-Left')
+            reported_quota = used + float(left) if left is not None else None
+            self._connection().execute(
+                "INSERT INTO quota_ledger (day, used, quota) VALUES (?, ?, ?) "
+                "ON CONFLICT (day) DO UPDATE SET used = excluded.used, quota = COALESCE(excluded.quota, quota)",
+                (_today(), used, reported_quota)
+            )
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Quota ledger update error: {str(e)}")
+            self._count('errors')
+
+    def mark_exhausted(self):
+        """
+        Record that Spoonacular has refused a call because today's quota is used up
+        """
+        try:
+            # A quota of 0 reads as "no quota", so an empty ledger books one point against a quota of one
+            self._connection().execute(
+                "INSERT INTO quota_ledger (day, used, quota) VALUES (?, 1, 1) "
+                "ON CONFLICT (day) DO UPDATE SET used = MAX(used, 1), quota = MAX(used, 1)",
+                (_today(),)
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Quota ledger update error: {str(e)}")
+            self._count('errors')
+        logging.error("Spoonacular reports the daily quota is used up")
+
+    def remaining(self):
+        """
+        Return the quota points left today, or None when there is no daily quota
+        """
+        try:
+            used, _, limit = self._ledger()
+        except sqlite3.Error as e:
+            logging.error(f"Quota ledger read error: {str(e)}")
+            self._count('errors')
+            return None
+        return max(0, limit - used) if limit else None
+
+    def is_tight(self):
+        """
+        Whether only the reserve for cache fills is left of today's quota
+        """
+        try:
+            used, _, limit = self._ledger()
+        except sqlite3.Error as e:
+            logging.error(f"Quota ledger read error: {str(e)}")
+            self._count('errors')
+            return False
+        return bool(limit) and limit - used <= limit * self.reserve_share
+
+    def status(self):
+        """
+        Return today's quota usage, the rate limit and this process's counters
+        """
+        status = {
+            'day': _today(),
+            'rate_limit': self.rate_limit or None,
+            'burst': self.burst
+        }
+
+        try:
+            used, requests_today, limit = self._ledger()
+            bucket = self._connection().execute("SELECT tokens, updated_at FROM rate_bucket WHERE id = 1").fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Quota ledger read error: {str(e)}")
+            self._count('errors')
+            used, requests_today, limit, bucket = None, None, None, None
+
+        remaining = max(0, limit - used) if limit and used is not None else None
+        reserve = limit * self.reserve_share if limit else None
+        status.update(
+            daily_quota=limit,
+            used=used,
+            requests=requests_today,
+            remaining=remaining,
+            reserve=reserve,
+            tight=remaining is not None and remaining <= reserve,
+            exhausted=remaining == 0
+        )
+
+        if bucket and self.rate_limit > 0:
+            tokens, updated_at = bucket
+            status['tokens'] = round(min(self.burst, tokens + max(0, time.time() - updated_at) * self.rate_limit), 2)
+
+        now = datetime.now(timezone.utc)
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        status['resets_in_seconds'] = int((midnight - now).total_seconds())
+
+        with self._lock:
+            status['counters'] = dict(self._counters)
+        return status
+
+
+# Shared limiter used by upstream
+limiter = QuotaLimiter()
@@ -0,0 +1,369 @@
+"""
+Persistent Recipe Cache
+
+Stores Spoonacular responses in a local SQLite file so that recipe data:
+- Survives application restarts
+- Is shared by every gunicorn worker on the same host
+- Expires after a configurable TTL
+- Is bounded in size with least-recently-used eviction
+- Remembers recipe IDs that failed upstream (negative caching)
+- Keeps expired entries for a while to serve when upstream can't be called
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import profiling
+from nutrients import json_default
+
+# Cache configuration (all values can be overridden from the environment)
+CACHE_PATH = os.environ.get("RECIPE_CACHE_PATH", "recipe_cache.db")
+CACHE_TTL = int(os.environ.get("RECIPE_CACHE_TTL", 7 * 24 * 3600))            # 1 week
+NEGATIVE_TTL = int(os.environ.get("RECIPE_CACHE_NEGATIVE_TTL", 15 * 60))      # 15 minutes
+MAX_ENTRIES = int(os.environ.get("RECIPE_CACHE_MAX_ENTRIES", 50000))
+STALE_TTL = int(os.environ.get("RECIPE_CACHE_STALE_TTL", 7 * 24 * 3600))      # kept 1 week past expiry
+
+# Only refresh the LRU timestamp of an entry once per interval to keep
+# cache hits from turning into a write on every read
+TOUCH_INTERVAL = 60
+
+# Check the cache size every N writes rather than on every write
+EVICTION_CHECK_INTERVAL = 100
+
+# Returned by get() when there is no usable entry for a key
+MISS = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entry (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    negative INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS ix_cache_entry_accessed_at ON cache_entry (accessed_at);
+"""
+
+
+class RecipeCache:
+    """
+    SQLite-backed key/value cache with TTL, LRU eviction and negative entries
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES,
+                 stale_ttl=STALE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'stale_hits': 0,
+            'expired': 0,
+            'evictions': 0,
+            'errors': 0
+        }
+
+    def _connection(self):
+        """
+        Return this thread's connection, reconnecting after a fork
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """
+        Close this thread's connection, such as before forking; the next use reconnects
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    @profiling.phase('cache')
+    def get(self, namespace, key, allow_expired=False):
+        """
+        Look up a cached value
+        Returns the value, None for a negatively cached key, or MISS
+        With allow_expired, expired values that haven't been evicted yet are returned too
+        """
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value, negative, expires_at, accessed_at FROM cache_entry "
+                "WHERE namespace = ? AND key = ?",
+                (namespace, str(key))
+            ).fetchone()
+
+            if row is None:
+                self._count('misses')
+                return MISS
+
+            value, negative, expires_at, accessed_at = row
+            if expires_at <= now:
+                if not allow_expired or negative:
+                    self._count('expired')
+                    self._count('misses')
+                    return MISS
+                self._count('stale_hits')
+                return json.loads(value)
+
+            if now - accessed_at > TOUCH_INTERVAL:
+                conn.execute(
+                    "UPDATE cache_entry SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    (now, namespace, str(key))
+                )
+
+            if negative:
+                self._count('negative_hits')
+                return None
+
+            self._count('hits')
+            return json.loads(value)
+
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Recipe cache read error: {str(e)}")
+            self._count('errors')
+            self._count('misses')
+            return MISS
+
+    @profiling.phase('cache')
+    def get_many(self, namespace, keys, allow_expired=False):
+        """
+        Look up several keys at once
+        Returns a dict with an entry (value, or None if negatively cached)
+        for every key found; keys that missed are left out
+        With allow_expired, expired values that haven't been evicted yet are returned too
+        """
+        now = time.time()
+        keys_by_name = {str(key): key for key in keys}
+        names = list(keys_by_name)
+        found = {}
+        stale = []
+
+        try:
+            conn = self._connection()
+            # Stay well under SQLite's bound-parameter limit
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                rows = conn.execute(
+                    "SELECT key, value, negative, expires_at, accessed_at FROM cache_entry "
+                    f"WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [namespace] + chunk
+                ).fetchall()
+
+                for name, value, negative, expires_at, accessed_at in rows:
+                    if expires_at <= now:
+                        if allow_expired and not negative:
+                            self._count('stale_hits')
+                            found[keys_by_name[name]] = json.loads(value)
+                        else:
+                            self._count('expired')
+                        continue
+                    if now - accessed_at > TOUCH_INTERVAL:
+                        stale.append(name)
+                    if negative:
+                        self._count('negative_hits')
+                        found[keys_by_name[name]] = None
+                    else:
+                        self._count('hits')
+                        found[keys_by_name[name]] = json.loads(value)
+
+            if stale:
+                conn.executemany(
+                    "UPDATE cache_entry SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    [(now, namespace, name) for name in stale]
+                )
+
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Recipe cache read error: {str(e)}")
+            self._count('errors')
+            found = {}
+
+        self._count('misses', len(names) - len(found))
+        return found
+
+    def items(self, namespace):
+        """
+        Yield (key, value) for every positive entry in a namespace, expired or not
+        Doesn't count as lookups or refresh access times
+        """
+        try:
+            rows = self._connection().execute(
+                "SELECT key, value FROM cache_entry WHERE namespace = ? AND negative = 0", (namespace,)
+            ).fetchall()
+            for key, value in rows:
+                yield key, json.loads(value)
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Recipe cache read error: {str(e)}")
+            self._count('errors')
+
+    def fingerprint(self, namespace):
+        """
+        Return (entries, latest expiry) of the positive entries in a namespace,
+        which changes whenever one is added, replaced or evicted
+        """
+        try:
+            return tuple(self._connection().execute(
+                "SELECT COUNT(*), MAX(expires_at) FROM cache_entry WHERE namespace = ? AND negative = 0",
+                (namespace,)
+            ).fetchone())
+        except sqlite3.Error as e:
+            logging.error(f"Recipe cache read error: {str(e)}")
+            self._count('errors')
+            return None
+
+    def extract(self, namespace, paths):
+        """
+        Yield (key, *values) for every positive entry in a namespace, expired or not,
+        reading each JSON path from the stored value without decoding the rest
+        """
+        columns = ', '.join('json_extract(value, ?)' for _ in paths)
+        try:
+            rows = self._connection().execute(
+                f"SELECT key, {columns} FROM cache_entry WHERE namespace = ? AND negative = 0",
+                list(paths) + [namespace]
+            ).fetchall()
+            yield from rows
+        except sqlite3.Error as e:
+            logging.error(f"Recipe cache read error: {str(e)}")
+            self._count('errors')
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        Store a value for the given key
+        """
+        self._write(namespace, key, json.dumps(value, default=json_default), False, ttl if ttl is not None else self.ttl)
+
+    def set_many(self, namespace, items, ttl=None):
+        """
+        Store several values in a single transaction
+        """
+        if not items:
+            return
+
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.ttl)
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache_entry "
+                    "(namespace, key, value, negative, expires_at, accessed_at) VALUES (?, ?, ?, 0, ?, ?)",
+                    [(namespace, str(key), json.dumps(value, default=json_default), expires_at, now) for key, value in items.items()]
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Recipe cache write error: {str(e)}")
+            self._count('errors')
+            return
+
+        with self._lock:
+            check_size = (self._writes % EVICTION_CHECK_INTERVAL) + len(items) >= EVICTION_CHECK_INTERVAL
+            self._writes += len(items)
+        if check_size:
+            self.evict()
+
+    def set_negative(self, namespace, key, ttl=None):
+        """
+        Remember that a key failed upstream so it is not retried until the entry expires
+        """
+        self._write(namespace, key, None, True, ttl if ttl is not None else self.negative_ttl)
+
+    def _write(self, namespace, key, value, negative, ttl):
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entry "
+                "(namespace, key, value, negative, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, str(key), value, int(negative), now + ttl, now)
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Recipe cache write error: {str(e)}")
+            self._count('errors')
+            return
+
+        with self._lock:
+            self._writes += 1
+            check_size = self._writes % EVICTION_CHECK_INTERVAL == 0
+        if check_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop entries that expired more than stale_ttl ago (negative ones as soon
+        as they expire) and, if the cache is still over its size limit, the
+        least recently used ones
+        """
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                "DELETE FROM cache_entry WHERE expires_at <= ? AND (negative = 1 OR expires_at <= ?)",
+                (now, now - self.stale_ttl)
+            )
+
+            count = conn.execute("SELECT COUNT(*) FROM cache_entry").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM cache_entry WHERE rowid IN ("
+                    "SELECT rowid FROM cache_entry ORDER BY accessed_at LIMIT ?)",
+                    (overflow,)
+                )
+                self._count('evictions', overflow)
+        except sqlite3.Error as e:
+            logging.error(f"Recipe cache eviction error: {str(e)}")
+            self._count('errors')
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        """
+        self._connection().execute("DELETE FROM cache_entry")
+
+    def stats(self):
+        """
+        Return hit/miss counters for this process plus the current cache size
+        """
+        with self._lock:
+            stats = dict(self._counters)
+
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['negative_hits']) / lookups, 4) if lookups else 0.0
+
+        try:
+            stats['entries'] = self._connection().execute("SELECT COUNT(*) FROM cache_entry").fetchone()[0]
+        except sqlite3.Error:
+            stats['entries'] = None
+
+        return stats
+
+
+# Shared cache instance used by meal_planner
+cache = RecipeCache()
@@ -0,0 +1,395 @@
+"""
+Local Recipe Catalog
+
+A local store of recipes that search_recipes can answer from without calling
+Spoonacular. Recipes are ingested from JSON or NDJSON files into a SQLite
+store; each process keeps only a compact in-memory index of them:
+- Grouped by meal type and dietary mask (see dietary.py)
+- Sorted by calories within each group, so a calorie range is two bisections
+- Rebuilt when the store's files change, so recipes ingested by another
+  process show up within RECIPE_CATALOG_CHECK_INTERVAL seconds
+- Allergens outside the mask vocabulary are checked against the ingredients
+  of the stored recipes a search picks
+
+Full recipe data stays on disk and is read by ID when a search result is used.
+
+Ingest recipes (Spoonacular information objects or our own recipe format):
+
+    python recipe_catalog.py ingest recipes.ndjson
+    python recipe_catalog.py ingest breakfasts.json --meal-type breakfast
+    python recipe_catalog.py stats
+"""
+import os
+import sys
+import json
+import random
+import sqlite3
+import logging
+import argparse
+import threading
+from array import array
+import time
+from bisect import bisect_left, bisect_right
+
+from nutrients import json_default
+from dietary import compile_preferences, contains_allergens, recipe_mask, suits
+
+CATALOG_PATH = os.environ.get("RECIPE_CATALOG_PATH", "recipe_catalog.db")
+
+# Seconds between checks of the store for recipes ingested since the index was built
+CHECK_INTERVAL = float(os.environ.get("RECIPE_CATALOG_CHECK_INTERVAL", 5))
+
+# Candidates checked per wanted result when a search has allergens only ingredients reveal
+ALLERGEN_CHECK_FACTOR = 10
+
+# Meal types the catalog indexes (the same types search_recipes is called with)
+MEAL_TYPES = ('breakfast', 'lunch', 'dinner', 'snack')
+
+# Spoonacular dish types and the meal types they can be served as
+DISH_TYPE_MEALS = {
+    'breakfast': ('breakfast',),
+    'brunch': ('breakfast', 'lunch'),
+    'morning meal': ('breakfast',),
+    'lunch': ('lunch',),
+    'salad': ('lunch',),
+    'soup': ('lunch', 'dinner'),
+    'main course': ('lunch', 'dinner'),
+    'main dish': ('lunch', 'dinner'),
+    'dinner': ('dinner',),
+    'snack': ('snack',),
+    'fingerfood': ('snack',),
+    'appetizer': ('snack',),
+    'antipasti': ('snack',),
+    'starter': ('snack',)
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recipe (
+    id INTEGER PRIMARY KEY,
+    meal_types TEXT NOT NULL,
+    flags INTEGER NOT NULL,
+    calories REAL NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+def meal_types_for(record, meal_type=None):
+    """
+    Work out which meal types a recipe can be served as
+    """
+    if meal_type:
+        return [meal_type]
+    if record.get('mealTypes'):
+        return [m for m in record['mealTypes'] if m in MEAL_TYPES]
+
+    meal_types = []
+    for dish_type in record.get('dishTypes', []):
+        for meal in DISH_TYPE_MEALS.get(dish_type.lower(), ()):
+            if meal not in meal_types:
+                meal_types.append(meal)
+    return meal_types
+
+
+def to_recipe(record):
+    """
+    Convert an ingested record into our recipe format
+    Spoonacular objects list nutrients; our own format already has totals
+    """
+    from meal_planner import parse_recipe
+
+    if 'nutrients' in record.get('nutrition', {}):
+        return parse_recipe(record)
+    recipe = dict(record)
+    recipe['nutrition'] = dict(record.get('nutrition') or {})
+    recipe.pop('mealTypes', None)
+    return recipe
+
+
+class RecipeCatalog:
+    """
+    SQLite recipe store with an in-memory search index
+    """
+
+    def __init__(self, path=CATALOG_PATH, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reloading = threading.Lock()
+        # Replaced whole on every load, so readers never see a half-swapped state
+        self._state = {'index': None, 'fingerprint': None, 'checked_at': None}
+
+    def _connection(self):
+        """
+        Return this thread's connection, reconnecting after a fork
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """
+        Close this thread's connection, such as before forking; the next use reconnects
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    def fingerprint(self):
+        """
+        Return the modification times and sizes of the store's files, which change whenever recipes are ingested
+        """
+        files = []
+        for path in (self.path, f"{self.path}-wal"):
+            try:
+                stat = os.stat(path)
+                files.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                files.append(None)
+        return tuple(files)
+
+    def load(self):
+        """
+        Build the search index from the store
+        The index maps meal type -> dietary mask -> (sorted calories, recipe IDs)
+        """
+        # Taken first, so recipes ingested while the index is built trigger another load
+        fingerprint = self.fingerprint()
+        index = {meal: {} for meal in MEAL_TYPES}
+        if os.path.exists(self.path):
+            rows = self._connection().execute(
+                "SELECT id, meal_types, flags, calories FROM recipe ORDER BY calories"
+            )
+            for recipe_id, meal_types, flags, calories in rows:
+                for meal in meal_types.split(','):
+                    if meal not in index:
+                        continue
+                    group = index[meal].get(flags)
+                    if group is None:
+                        group = index[meal][flags] = (array('d'), array('q'))
+                    group[0].append(calories)
+                    group[1].append(recipe_id)
+
+        with self._lock:
+            self._state = {'index': index, 'fingerprint': fingerprint, 'checked_at': time.monotonic()}
+        return index
+
+    def _get_index(self):
+        state = self._state
+        if state['index'] is None:
+            return self.load()
+        if time.monotonic() - state['checked_at'] >= self.check_interval:
+            # One thread checks the store; the others keep using the current index meanwhile
+            if self._reloading.acquire(blocking=False):
+                try:
+                    if self.fingerprint() != state['fingerprint']:
+                        return self.load()
+                    self._state = dict(state, checked_at=time.monotonic())
+                finally:
+                    self._reloading.release()
+        return state['index']
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return self._connection().execute("SELECT COUNT(*) FROM recipe").fetchone()[0]
+
+    def search_ids(self, meal_type, preferences, calories_per_meal, number=5):
+        """
+        Return up to `number` random recipe IDs matching the search
+        Returns None if the catalog has no recipes for the meal type
+        """
+        groups = self._get_index().get(meal_type)
+        if not groups:
+            return None
+        profile = compile_preferences(preferences)
+        required = profile.mask
+
+        low, high = calories_per_meal * 0.9, calories_per_meal * 1.1
+
+        # Find the matching slice of every group that has all required bits
+        ranges = []
+        total = 0
+        for flags, (calories, recipe_ids) in groups.items():
+            if not suits(flags, required):
+                continue
+            start, end = bisect_left(calories, low), bisect_right(calories, high)
+            if end > start:
+                ranges.append((total, start, recipe_ids))
+                total += end - start
+
+        offsets = [offset for offset, _, _ in ranges]
+
+        def pick(positions):
+            # The recipe IDs at positions across all matching slices
+            picked = []
+            for position in positions:
+                offset, start, recipe_ids = ranges[bisect_right(offsets, position) - 1]
+                picked.append(recipe_ids[start + position - offset])
+            return picked
+
+        if not profile.other_allergens:
+            return pick(random.sample(range(total), min(number, total)))
+
+        # The masks can't describe these allergens, so the ingredients of
+        # random candidates are checked until enough of them are free of them
+        results = []
+        positions = random.sample(range(total), min(total, number * ALLERGEN_CHECK_FACTOR))
+        for i in range(0, len(positions), number):
+            candidate_ids = pick(positions[i:i + number])
+            recipes = self.get_many(candidate_ids)
+            results.extend(
+                recipe_id for recipe_id in candidate_ids
+                if recipe_id in recipes and not contains_allergens(recipes[recipe_id], profile.other_allergens)
+            )
+            if len(results) >= number:
+                break
+        return results[:number]
+
+    def get_many(self, recipe_ids):
+        """
+        Return the stored recipes for the given IDs, keyed by ID
+        IDs that aren't in the catalog are left out
+        """
+        ids_by_value = {}
+        for recipe_id in recipe_ids:
+            try:
+                ids_by_value[int(recipe_id)] = recipe_id
+            except (TypeError, ValueError):
+                continue
+        if not ids_by_value or not os.path.exists(self.path):
+            return {}
+
+        found = {}
+        values = list(ids_by_value)
+        try:
+            conn = self._connection()
+            for i in range(0, len(values), 500):
+                chunk = values[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT id, data FROM recipe WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                for recipe_id, data in rows:
+                    found[ids_by_value[recipe_id]] = json.loads(data)
+        except sqlite3.Error as e:
+            logging.error(f"Recipe catalog read error: {str(e)}")
+        return found
+
+    def nutrition_rows(self, names):
+        """
+        Yield (id, meal types, dietary mask, [amounts]) for every stored recipe,
+        with the amounts of the named nutrients read straight from the stored JSON
+        """
+        if not os.path.exists(self.path):
+            return
+        columns = ', '.join(f"json_extract(data, '$.nutrition.{name}')" for name in names)
+        try:
+            rows = self._connection().execute(f"SELECT id, meal_types, flags, {columns} FROM recipe")
+            for recipe_id, meal_types, flags, *amounts in rows:
+                yield recipe_id, meal_types, flags, [amount or 0 for amount in amounts]
+        except sqlite3.Error as e:
+            logging.error(f"Recipe catalog read error: {str(e)}")
+
+    def records(self):
+        """
+        Yield (recipe, meal types, dietary mask) for every stored recipe
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            rows = self._connection().execute("SELECT meal_types, flags, data FROM recipe")
+            for meal_types, flags, data in rows:
+                yield json.loads(data), meal_types.split(','), flags
+        except sqlite3.Error as e:
+            logging.error(f"Recipe catalog read error: {str(e)}")
+
+    def ingest(self, records, meal_type=None):
+        """
+        Add or replace recipes in the store and rebuild the index
+        Returns the number of recipes stored
+        """
+        conn = self._connection()
+        batch = []
+        count = 0
+
+        def flush():
+            conn.executemany(
+                "INSERT OR REPLACE INTO recipe (id, meal_types, flags, calories, data) VALUES (?, ?, ?, ?, ?)",
+                batch
+            )
+            batch.clear()
+
+        with conn:
+            for record in records:
+                meal_types = meal_types_for(record, meal_type)
+                if record.get('id') is None or not meal_types:
+                    continue
+
+                recipe = to_recipe(record)
+                batch.append((
+                    int(recipe['id']),
+                    ','.join(meal_types),
+                    recipe_mask(record, recipe['nutrition']),
+                    float(recipe['nutrition'].get('calories') or 0),
+                    json.dumps(recipe, default=json_default)
+                ))
+                count += 1
+                if len(batch) >= 5000:
+                    flush()
+            flush()
+
+        self.load()
+        return count
+
+
+def read_records(path):
+    """
+    Yield recipe objects from a JSON array file or an NDJSON file
+    """
+    with open(path) as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+
+        if first == '[':
+            yield from json.load(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Shared catalog instance used by meal_planner
+catalog = RecipeCatalog()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the local recipe catalog")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help="Load recipes from a JSON or NDJSON file")
+    ingest_parser.add_argument('path')
+    ingest_parser.add_argument('--meal-type', choices=MEAL_TYPES, help="Meal type for every recipe in the file")
+
+    subparsers.add_parser('stats', help="Show how many recipes are indexed per meal type")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'ingest':
+        count = catalog.ingest(read_records(args.path), meal_type=args.meal_type)
+        print(f"Ingested {count} recipes into {catalog.path}")
+    else:
+        for meal, groups in catalog.load().items():
+            print(f"{meal}: {sum(len(ids) for _, ids in groups.values())} recipes")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,548 @@
+"""
+Recipe Snapshots
+
+A read-only binary file of recipes that processes map into memory rather
+than loading the recipes as Python objects:
+- A versioned header and a directory of sections, each a flat
+  little-endian array aligned to 64 bytes
+- Recipe IDs sorted ascending, so finding a recipe is a binary search
+- Nutrition stored a column per nutrient, so reading one nutrient of every
+  recipe reads contiguous memory
+- Titles, images, source URLs, ingredient names, units and instruction
+  steps live in string tables: one block of UTF-8 and the offset of every
+  string in it
+- Each recipe's ingredients and steps are a slice of those tables, found
+  through an array of start positions
+- Sections are read in place through numpy views of the mapping, so opening
+  a snapshot copies nothing and its pages are shared (through the page
+  cache) by every process that maps the file
+- A recipe is turned into a dict only when it is looked up
+
+A snapshot is published by writing a new file and renaming it over the old
+one. Every process checks the file every few seconds and swaps in the new
+snapshot without a restart; lookups already running finish on the old one.
+
+    python recipe_snapshot.py build                      # from the catalog and the cache
+    python recipe_snapshot.py build --input recipes.ndjson
+    python recipe_snapshot.py info
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+from nutrients import NAMES, NutrientVector
+from dietary import recipe_mask, search_mask
+from recipe_cache import cache
+from recipe_catalog import catalog, MEAL_TYPES, meal_types_for, read_records, to_recipe
+
+SNAPSHOT_PATH = os.environ.get("RECIPE_SNAPSHOT_PATH", "recipe_snapshot.bin")
+
+# Seconds between checks for a newly published snapshot
+CHECK_INTERVAL = float(os.environ.get("RECIPE_SNAPSHOT_CHECK_INTERVAL", 5))
+
+MAGIC = b'RCPSNAP\x00'
+
+# Incremented whenever the layout changes; files of any other version are refused rather than misread
+VERSION = 1
+
+# Magic, version, number of sections, number of recipes
+HEADER = struct.Struct('<8sIIQ')
+
+# Name, numpy type, offset and length in bytes of every section
+SECTION = struct.Struct('<24s8sQQ')
+
+ALIGNMENT = 64
+
+# Stored in place of a missing readyInMinutes or servings
+MISSING = -1
+
+# String tables of the recipe fields with one string per recipe
+RECIPE_STRINGS = {'title': 'title', 'image': 'image', 'url': 'sourceUrl'}
+
+# Every section a reader views; a file without one of them is refused when opened
+STRING_TABLES = list(RECIPE_STRINGS) + ['ingredient', 'unit', 'step']
+REQUIRED_SECTIONS = [
+    'meta', 'ids', 'nutrition', 'diet_mask', 'meal_types', 'ready_in_minutes', 'servings',
+    'ingredient_start', 'ingredient_name', 'ingredient_amount', 'ingredient_unit', 'step_start',
+] + [f"{name}.{part}" for name in STRING_TABLES for part in ('data', 'offsets')]
+
+
+class SnapshotError(ValueError):
+    """
+    Raised when a file isn't a snapshot this version can read
+    """
+
+
+class StringTable:
+    """
+    Strings stored as one block of UTF-8 and the offset of every string in it
+    """
+
+    def __init__(self, buffer, base, offsets):
+        self._buffer = buffer
+        self._base = base
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i:i + 2].tolist()
+        return self._buffer[self._base + start:self._base + end].decode()
+
+    def slice(self, start, end):
+        """
+        Return the strings from start up to end
+        """
+        bounds = self.offsets[start:end + 1].tolist()
+        buffer, base = self._buffer, self._base
+        return [buffer[base + a:base + b].decode() for a, b in zip(bounds, bounds[1:])]
+
+    @staticmethod
+    def encode(strings):
+        """
+        Return the offsets and the UTF-8 block of a list of strings
+        """
+        encoded = [(string or '').encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.uint64, count=len(encoded)), out=offsets[1:])
+        return offsets, np.frombuffer(b''.join(encoded), dtype='u1')
+
+
+class RecipeSnapshot:
+    """
+    A snapshot file mapped read-only into memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < HEADER.size:
+                raise SnapshotError(f"{path} is not a recipe snapshot")
+            self.identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Nothing is viewed through the mapping until the file checks out, so it can be closed here
+        try:
+            table, meta = self._read_table(stat.st_size)
+        except Exception:
+            self._mmap.close()
+            raise
+
+        sections, offsets = {}, {}
+        for name, (dtype, offset, length) in table.items():
+            offsets[name] = offset
+            sections[name] = np.frombuffer(self._mmap, dtype, length // dtype.itemsize, offset)
+
+        self.created_at = meta['created_at']
+        self.nutrient_names = meta['nutrients']
+        self.meal_type_names = meta['meal_types']
+
+        self.ids = sections['ids']
+        self.nutrition = sections['nutrition'].reshape(len(self.nutrient_names), self.size)
+        self.diet_masks = sections['diet_mask']
+        self.meal_types = sections['meal_types']
+        self.ready_in_minutes = sections['ready_in_minutes']
+        self.servings = sections['servings']
+        self.strings = {
+            name: StringTable(self._mmap, offsets[f"{name}.data"], sections[f"{name}.offsets"])
+            for name in STRING_TABLES
+        }
+        self._ingredient_start = sections['ingredient_start']
+        self._ingredient_name = sections['ingredient_name']
+        self._ingredient_amount = sections['ingredient_amount']
+        self._ingredient_unit = sections['ingredient_unit']
+        self._step_start = sections['step_start']
+
+        # Nutrients added to the registry after the snapshot was written read as zero
+        columns = {name: i for i, name in enumerate(self.nutrient_names)}
+        self._columns = [columns.get(name) for name in NAMES]
+        self._registry_order = self._columns == list(range(len(NAMES)))
+
+    def _read_table(self, file_size):
+        """
+        Validate the header and section table, returning the sections by name and the metadata
+        """
+        try:
+            magic, version, section_count, self.size = HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC:
+                raise SnapshotError(f"{self.path} is not a recipe snapshot")
+            if version != VERSION:
+                raise SnapshotError(f"{self.path} is snapshot version {version}; only version {VERSION} can be read")
+
+            table = {}
+            for n in range(section_count):
+                name, dtype, offset, length = SECTION.unpack_from(self._mmap, HEADER.size + n * SECTION.size)
+                name, dtype = name.rstrip(b'\0').decode(), np.dtype(dtype.rstrip(b'\0').decode())
+                if offset + length > file_size:
+                    raise SnapshotError(f"{self.path} is truncated")
+                table[name] = (dtype, offset, length)
+
+            missing = [name for name in REQUIRED_SECTIONS if name not in table]
+            if missing:
+                raise SnapshotError(f"{self.path} is missing sections: {', '.join(missing)}")
+
+            _, offset, length = table['meta']
+            meta = json.loads(self._mmap[offset:offset + length])
+            dtype, _, length = table['nutrition']
+            if length != len(meta['nutrients']) * self.size * dtype.itemsize:
+                raise SnapshotError(f"{self.path} has a nutrition section of the wrong size")
+        except (struct.error, UnicodeDecodeError, TypeError, KeyError) as e:
+            raise SnapshotError(f"{self.path} is not a readable recipe snapshot: {e!r}") from e
+        return table, meta
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, recipe_id):
+        try:
+            return self.rows([int(recipe_id)])[0] >= 0
+        except (TypeError, ValueError):
+            return False
+
+    def rows(self, recipe_ids):
+        """
+        Return the row of every recipe ID, or -1 for IDs not in the snapshot
+        """
+        values = np.asarray(recipe_ids, dtype=np.int64)
+        if not self.size:
+            return np.full(len(values), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, values), self.size - 1)
+        return np.where(self.ids[rows] == values, rows, -1)
+
+    def column(self, name):
+        """
+        Return the amounts of one nutrient for every recipe, in row order, without copying them
+        """
+        i = self._columns[NAMES.index(name)]
+        return self.nutrition[i] if i is not None else np.zeros(self.size)
+
+    def points(self, names):
+        """
+        Return a (recipes, nutrients) array of the named nutrients
+        """
+        return np.column_stack([self.column(name) for name in names]) if names else np.empty((self.size, 0))
+
+    def vector(self, row):
+        """
+        Return the nutrition of the recipe in a row
+        """
+        if self._registry_order:
+            return NutrientVector(self.nutrition[:, row].tolist())
+        amounts = self.nutrition[:, row].tolist()
+        return NutrientVector(amounts[i] if i is not None else 0.0 for i in self._columns)
+
+    def recipe(self, row):
+        """
+        Return the recipe in a row in our recipe format
+        """
+        row = int(row)
+        strings = self.strings
+
+        start, end = self._ingredient_start[row:row + 2].tolist()
+        ingredient_names, units = strings['ingredient'], strings['unit']
+        ingredients = [
+            {
+                'name': ingredient_names[name],
+                'amount': int(amount) if amount.is_integer() else amount,
+                'unit': units[unit]
+            }
+            for name, amount, unit in zip(
+                self._ingredient_name[start:end].tolist(),
+                self._ingredient_amount[start:end].tolist(),
+                self._ingredient_unit[start:end].tolist()
+            )
+        ]
+        step_start, step_end = self._step_start[row:row + 2].tolist()
+        ready_in_minutes, servings = int(self.ready_in_minutes[row]), int(self.servings[row])
+
+        return {
+            'id': int(self.ids[row]),
+            'title': strings['title'][row],
+            'image': strings['image'][row],
+            'readyInMinutes': ready_in_minutes if ready_in_minutes != MISSING else None,
+            'servings': servings if servings != MISSING else None,
+            'sourceUrl': strings['url'][row],
+            'diet_mask': int(self.diet_masks[row]),
+            'nutrition': self.vector(row),
+            'ingredients': ingredients,
+            'instructions': strings['step'].slice(step_start, step_end)
+        }
+
+    def get_many(self, recipe_ids):
+        """
+        Return the recipes for the given IDs, keyed by ID
+        IDs that aren't in the snapshot are left out
+        """
+        ids_by_value = {}
+        for recipe_id in recipe_ids:
+            try:
+                ids_by_value[int(recipe_id)] = recipe_id
+            except (TypeError, ValueError):
+                continue
+        if not ids_by_value:
+            return {}
+
+        values = list(ids_by_value)
+        return {
+            ids_by_value[value]: self.recipe(row)
+            for value, row in zip(values, self.rows(values).tolist()) if row >= 0
+        }
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'version': VERSION,
+            'recipes': self.size,
+            'bytes': self.identity[3],
+            'created_at': self.created_at,
+            'nutrients': self.nutrient_names
+        }
+
+
+class SnapshotStore:
+    """
+    The snapshot published at a path, swapped for a new one whenever the file is replaced
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # Replaced whole on every check, so readers never see a half-swapped state
+        self._state = {'snapshot': None, 'checked_at': None}
+        self._swaps = 0
+
+    def current(self):
+        """
+        Return the snapshot in use, or None if none has been published
+        A lookup should use the one snapshot throughout rather than call this again
+        """
+        state = self._state
+        if state['checked_at'] is not None and time.monotonic() - state['checked_at'] < self.check_interval:
+            return state['snapshot']
+        return self.reload()
+
+    def reload(self, force=False):
+        """
+        Check the file now and swap in the snapshot there if it has been replaced
+        """
+        with self._lock:
+            state = self._state
+            # Another thread may have checked while this one waited
+            if not force and state['checked_at'] is not None and time.monotonic() - state['checked_at'] < self.check_interval:
+                return state['snapshot']
+
+            snapshot = state['snapshot']
+            try:
+                stat = os.stat(self.path)
+                identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                identity = None
+
+            if identity is None:
+                snapshot = None
+            elif snapshot is None or snapshot.identity != identity:
+                try:
+                    snapshot = RecipeSnapshot(self.path)
+                    self._swaps += 1
+                    logging.info(f"Loaded recipe snapshot of {len(snapshot)} recipes from {self.path}")
+                except (OSError, ValueError) as e:
+                    # Keep serving the previous snapshot, if any, until a readable one is published
+                    logging.error(f"Recipe snapshot load error: {str(e)}")
+
+            # The previous snapshot stays mapped until the last lookup using it lets go of it
+            self._state = {'snapshot': snapshot, 'checked_at': time.monotonic()}
+            return snapshot
+
+    def get_many(self, recipe_ids):
+        """
+        Return the recipes in the current snapshot for the given IDs, keyed by ID
+        """
+        snapshot = self.current()
+        return snapshot.get_many(recipe_ids) if snapshot is not None else {}
+
+    def stats(self):
+        snapshot = self._state['snapshot']
+        stats = snapshot.stats() if snapshot is not None else {'path': self.path, 'recipes': 0}
+        stats['swaps'] = self._swaps
+        return stats
+
+
+def _integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def write_snapshot(path, recipes):
+    """
+    Write (recipe, meal types, dietary mask) tuples to a new snapshot and publish it at path
+    The mask adds to the bits the recipe itself carries. Later recipes replace
+    earlier ones with the same ID. Returns the number of recipes written
+    """
+    by_id = {}
+    for recipe, meal_types, mask in recipes:
+        try:
+            by_id[int(recipe['id'])] = (recipe, meal_types, mask)
+        except (KeyError, TypeError, ValueError):
+            continue
+    ids = sorted(by_id)
+    count = len(ids)
+
+    nutrition = np.zeros((len(NAMES), count), dtype='<f8')
+    diet_masks = np.zeros(count, dtype='<u4')
+    meal_bits = np.zeros(count, dtype='u1')
+    ready_in_minutes = np.full(count, MISSING, dtype='<i4')
+    servings = np.full(count, MISSING, dtype='<i4')
+    strings = {name: [] for name in RECIPE_STRINGS}
+    ingredient_start = np.zeros(count + 1, dtype='<u8')
+    step_start = np.zeros(count + 1, dtype='<u8')
+    ingredient_names, ingredient_amounts, units = [], [], []
+    ingredient_vocabulary, unit_vocabulary, steps = {}, {}, []
+
+    for row, recipe_id in enumerate(ids):
+        recipe, meal_types, mask = by_id[recipe_id]
+        vector = NutrientVector.of(recipe.get('nutrition'))
+        nutrition[:, row] = vector.amounts
+        diet_masks[row] = recipe_mask(recipe, vector) | mask
+        for meal in meal_types or ():
+            if meal in MEAL_TYPES:
+                meal_bits[row] |= 1 << MEAL_TYPES.index(meal)
+        ready_in_minutes[row] = _integer(recipe.get('readyInMinutes'))
+        servings[row] = _integer(recipe.get('servings'))
+        for name, field in RECIPE_STRINGS.items():
+            strings[name].append(recipe.get(field))
+
+        # Ingredient names and units repeat across recipes, so each is stored once
+        for ingredient in recipe.get('ingredients') or ():
+            name, unit = ingredient.get('name') or '', ingredient.get('unit') or ''
+            ingredient_names.append(ingredient_vocabulary.setdefault(name, len(ingredient_vocabulary)))
+            ingredient_amounts.append(float(ingredient.get('amount') or 0))
+            units.append(unit_vocabulary.setdefault(unit, len(unit_vocabulary)))
+        ingredient_start[row + 1] = len(ingredient_amounts)
+
+        steps.extend(recipe.get('instructions') or ())
+        step_start[row + 1] = len(steps)
+
+    meta = json.dumps({'nutrients': list(NAMES), 'meal_types': list(MEAL_TYPES), 'created_at': time.time()})
+    sections = [
+        ('meta', np.frombuffer(meta.encode(), dtype='u1')),
+        ('ids', np.asarray(ids, dtype='<i8')),
+        ('nutrition', nutrition.ravel()),
+        ('diet_mask', diet_masks),
+        ('meal_types', meal_bits),
+        ('ready_in_minutes', ready_in_minutes),
+        ('servings', servings),
+        ('ingredient_start', ingredient_start),
+        ('ingredient_name', np.asarray(ingredient_names, dtype='<u4')),
+        ('ingredient_amount', np.asarray(ingredient_amounts, dtype='<f8')),
+        ('ingredient_unit', np.asarray(units, dtype='<u4')),
+        ('step_start', step_start)
+    ]
+    tables = dict(strings, ingredient=list(ingredient_vocabulary), unit=list(unit_vocabulary), step=steps)
+    for name, values in tables.items():
+        offsets, data = StringTable.encode(values)
+        sections += [(f"{name}.offsets", offsets), (f"{name}.data", data)]
+
+    # Sections start on aligned offsets after the header and directory
+    layout = []
+    offset = HEADER.size + SECTION.size * len(sections)
+    for name, values in sections:
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        layout.append((name, values, offset))
+        offset += values.nbytes
+
+    # Written beside the target and renamed over it, so readers only ever see a complete file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(layout), count))
+            for name, values, offset in layout:
+                f.write(SECTION.pack(name.encode(), values.dtype.str.encode(), offset, values.nbytes))
+            for name, values, offset in layout:
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(np.ascontiguousarray(values).data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return count
+
+
+def local_recipes(include_cache=True):
+    """
+    Yield (recipe, meal types, dietary mask) for every recipe in the local catalog and the cache
+    Cached recipes take the meal types and dietary bits of the searches that
+    returned them, and come first so catalog copies replace them
+    """
+    if include_cache:
+        searched = {}
+        for key, results in cache.items('search'):
+            try:
+                params = json.loads(key)
+                meal_type, mask = params.get('type'), search_mask(params)
+            except (ValueError, AttributeError):
+                continue
+            for result in results or ():
+                recipe_id = str(result.get('id'))
+                meal_types, bits = searched.get(recipe_id, ((), 0))
+                if meal_type in MEAL_TYPES and meal_type not in meal_types:
+                    meal_types += (meal_type,)
+                searched[recipe_id] = (meal_types, bits | mask)
+
+        for key, recipe in cache.items('recipe'):
+            meal_types, mask = searched.get(key, ((), 0))
+            yield recipe, list(meal_types), mask
+
+    yield from catalog.records()
+
+
+# Shared snapshot store used by meal_planner and the similar recipe index
+snapshots = SnapshotStore()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and inspect recipe snapshots")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Publish a snapshot of the catalog and cache, or of a file")
+    build_parser.add_argument('--output', default=SNAPSHOT_PATH, help="Snapshot to write or replace")
+    build_parser.add_argument('--input', help="JSON or NDJSON file of recipes to snapshot instead")
+    build_parser.add_argument('--meal-type', choices=MEAL_TYPES, help="Meal type for every recipe in the file")
+    build_parser.add_argument('--no-cache', action='store_true', help="Leave out recipes only the cache holds")
+
+    info_parser = subparsers.add_parser('info', help="Describe a snapshot")
+    info_parser.add_argument('path', nargs='?', default=SNAPSHOT_PATH)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        if args.input:
+            recipes = (
+                (to_recipe(record), meal_types_for(record, args.meal_type), 0)
+                for record in read_records(args.input)
+            )
+        else:
+            recipes = local_recipes(include_cache=not args.no_cache)
+        count = write_snapshot(args.output, recipes)
+        print(f"Wrote a snapshot of {count} recipes to {args.output}")
+    else:
+        print(json.dumps(RecipeSnapshot(args.path).stats(), indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
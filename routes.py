@@ -1,60 +1,116 @@
+import os
 import json
-from flask import render_template, request, redirect, url_for, session, jsonify, flash
+from flask import render_template, request, redirect, url_for, session, jsonify, flash, abort, Response, stream_with_context, send_file
 from app import app, db
 from models import MealPlan, MealPlanDay
-from meal_planner import generate_meal_plan, get_recipe_details
-from usda_guidelines import get_calorie_target, get_macronutrient_targets
+from meal_planner import (
+    generate_meal_plan, iter_meal_plan, plan_candidate_pools, choose_day, choose_meal, get_recipe_details,
+    get_local_recipes, search_flights, recipe_flights, MEAL_SEARCH_TYPES
+)
+from recipe_cache import cache
+from nutrients import json_default
+from dietary import format_allergens
+from fragment_cache import fragments
+from recipe_catalog import MEAL_TYPES
+from similar_recipes import similar, query_tags
+import upstream
+import metrics
+import profiling
+from quota import limiter
+from cohort_planner import plan_cohort
+from plan_jobs import submit_plan_job, get_plan_job, job_to_dict, job_metrics, QueueFullError
+from plan_store import (
+    save_meal_plan, create_meal_plan, save_plan_day, save_candidate_pools, load_candidate_pools, replace_meal,
+    plan_macro_targets, bump_version, plan_version, plan_to_dict, load_plan_averages, load_plan, MEALS
+)
+from usda_guidelines import (
+    get_calorie_target, get_macronutrient_targets, check_compliance_batch, compliance_scores, compliance_results
+)
 import logging
 
+# Generate plans in background jobs instead of inside the request
+ASYNC_PLAN_JOBS = os.environ.get("ASYNC_PLAN_JOBS", "1") == "1"
+
+# Seconds clients should wait before polling a job again
+JOB_POLL_INTERVAL = 2
+
+# Most plans a single batch compliance request may score
+COMPLIANCE_BATCH_LIMIT = int(os.environ.get("COMPLIANCE_BATCH_LIMIT", 10000))
+
+# Most profiles a single cohort planning request may contain
+COHORT_BATCH_LIMIT = int(os.environ.get("COHORT_BATCH_LIMIT", 1000))
+
+# Most similar recipes a single request may ask for
+SIMILAR_RESULTS_LIMIT = int(os.environ.get("SIMILAR_RESULTS_LIMIT", 50))
+
+# Part of every plan ETag; bump it when a deploy changes how plans render
+PLAN_VIEW_REVISION = os.environ.get("PLAN_VIEW_REVISION", "1")
+
+# Used for plans stored before plans kept their preferences
+DEFAULT_PREFERENCES = {
+    'calorie_target': 2000,
+    'diet_type': 'balanced',
+    'vegetarian': False,
+    'vegan': False,
+    'gluten_free': False,
+    'dairy_free': False,
+    'allergens': ''
+}
+
 @app.route('/')
 def index():
     """Render the home page with meal preference form"""
     return render_template('index.html')
 
+def _preferences_from_json(data):
+    """Read meal preferences from a JSON object"""
+    return {
+        'calorie_target': int(data.get('calorie_target', 2000)),
+        'diet_type': data.get('diet_type', 'balanced'),
+        'vegetarian': bool(data.get('vegetarian')),
+        'vegan': bool(data.get('vegan')),
+        'gluten_free': bool(data.get('gluten_free')),
+        'dairy_free': bool(data.get('dairy_free')),
+        'allergens': format_allergens(data.get('allergens', ''))
+    }
+
+def _preferences_from_request():
+    """Read meal preferences from a JSON body, the preferences form or the query string"""
+    data = request.get_json(silent=True)
+    if data is not None:
+        return _preferences_from_json(data)
+    
+    # Form fields, or query parameters for GET requests such as the plan stream
+    values = request.values
+    return {
+        'calorie_target': int(values.get('calorie_target', 2000)),
+        'diet_type': values.get('diet_type', 'balanced'),
+        'vegetarian': 'vegetarian' in values,
+        'vegan': 'vegan' in values,
+        'gluten_free': 'gluten_free' in values,
+        'dairy_free': 'dairy_free' in values,
+        'allergens': format_allergens(values.get('allergens', ''))
+    }
+
 @app.route('/generate_plan', methods=['POST'])
 def generate_plan():
     """Generate a meal plan based on user preferences"""
     try:
         # Get user preferences from form
-        preferences = {
-            'calorie_target': int(request.form.get('calorie_target', 2000)),
-            'diet_type': request.form.get('diet_type', 'balanced'),
-            'vegetarian': 'vegetarian' in request.form,
-            'vegan': 'vegan' in request.form,
-            'gluten_free': 'gluten_free' in request.form,
-            'dairy_free': 'dairy_free' in request.form,
-            'allergens': request.form.get('allergens', '')
-        }
+        preferences = _preferences_from_request()
         
         # Store preferences in session
         session['preferences'] = preferences
         
-        # Generate meal plan
-        meal_plan = generate_meal_plan(preferences)
-        
-        # Store meal plan in database (for anonymous user)
-        db_meal_plan = MealPlan(name="Weekly Meal Plan")
-        db.session.add(db_meal_plan)
-        db.session.flush()
-        
-        days_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        
-        for i, day in enumerate(meal_plan):
-            meal_day = MealPlanDay(
-                meal_plan_id=db_meal_plan.id,
-                day_of_week=i,
-                breakfast=day['breakfast'],
-                lunch=day['lunch'],
-                dinner=day['dinner'],
-                snacks=day['snacks'],
-                total_calories=day['nutrition']['calories'],
-                total_protein=day['nutrition']['protein'],
-                total_carbs=day['nutrition']['carbs'],
-                total_fat=day['nutrition']['fat'],
-                total_fiber=day['nutrition']['fiber']
-            )
-            db.session.add(meal_day)
+        if ASYNC_PLAN_JOBS:
+            # Generate the plan in the background and let the browser poll for it
+            job = submit_plan_job(preferences)
+            return redirect(url_for('plan_job', job_id=job.id))
         
+        # Generate meal plan, keeping its candidates for regenerating days later
+        pools = plan_candidate_pools(preferences)
+        meal_plan = generate_meal_plan(preferences, pools=pools)
+        db_meal_plan = save_meal_plan(meal_plan, preferences=preferences, pools=pools)
         db.session.commit()
         
         # Redirect to meal plan view
@@ -65,16 +121,184 @@ def generate_plan():
         flash(f"Error generating meal plan: {str(e)}", "danger")
         return redirect(url_for('index'))
 
-@app.route('/plan/<int:plan_id>')
-def view_plan(plan_id):
-    """View a generated meal plan"""
-    meal_plan = MealPlan.query.get_or_404(plan_id)
-    days = meal_plan.days
+def _sse(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, default=json_default)}\n\n"
+
+@app.route('/generate_plan/stream', methods=['GET', 'POST'])
+def generate_plan_stream():
+    """Generate a meal plan and stream each day to the browser as a Server-Sent Event"""
+    preferences = _preferences_from_request()
+    session['preferences'] = preferences
     
-    # Get USDA guideline targets based on calorie level
-    preferences = session.get('preferences', {'calorie_target': 2000})
-    calorie_target = preferences['calorie_target']
-    macro_targets = get_macronutrient_targets(calorie_target)
+    @stream_with_context
+    def events():
+        try:
+            # Create the plan up front so each day can be stored as soon as it is ready
+            db_meal_plan = create_meal_plan(preferences=preferences)
+            db.session.commit()
+            plan_id = db_meal_plan.id
+            yield _sse('plan', {'plan_id': plan_id, 'plan_url': url_for('view_plan', plan_id=plan_id)})
+            
+            pools = plan_candidate_pools(preferences)
+            save_candidate_pools(plan_id, pools)
+            
+            for day_index, day in enumerate(iter_meal_plan(preferences, pools=pools)):
+                save_plan_day(plan_id, day_index, day)
+                db.session.commit()
+                yield _sse('day', dict(day, day_index=day_index))
+            
+            yield _sse('done', {'plan_id': plan_id, 'plan_url': url_for('view_plan', plan_id=plan_id)})
+        
+        except Exception as e:
+            logging.error(f"Error streaming meal plan: {str(e)}")
+            db.session.rollback()
+            yield _sse('error', {'error': str(e)})
+    
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/cohort_plans', methods=['POST'])
+def cohort_plans():
+    """API endpoint generating plans for a list of preference profiles in one batch"""
+    data = request.get_json(silent=True) or {}
+    profiles = data.get('profiles')
+    if not isinstance(profiles, list) or not profiles or len(profiles) > COHORT_BATCH_LIMIT:
+        abort(400)
+    
+    try:
+        preferences = [_preferences_from_json(profile) for profile in profiles]
+        days = int(data.get('days', 7))
+    except (TypeError, ValueError, AttributeError) as e:
+        logging.error(f"Invalid cohort plan request: {str(e)}")
+        abort(400)
+    if not 1 <= days <= 7:
+        abort(400)
+    
+    try:
+        results, stats = plan_cohort(preferences, days=days)
+        db.session.commit()
+    except Exception as e:
+        logging.error(f"Error generating cohort plans: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    # Echo back whatever the caller uses to tell its clients apart
+    plans = [
+        dict(result, client_id=profile.get('client_id'), plan_url=url_for('view_plan', plan_id=result['plan_id']))
+        for profile, result in zip(profiles, results)
+    ]
+    return jsonify({'plans': plans, 'stats': stats})
+
+@app.route('/plan_jobs/<job_id>')
+def plan_job(job_id):
+    """Wait for a background meal plan job and redirect to the plan when it is ready"""
+    job = get_plan_job(job_id)
+    if job is None:
+        flash("Meal plan request not found", "danger")
+        return redirect(url_for('index'))
+    
+    if job.status == 'done':
+        return redirect(url_for('view_plan', plan_id=job.meal_plan_id))
+    
+    if job.status == 'failed':
+        flash(f"Error generating meal plan: {job.error}", "danger")
+        return redirect(url_for('index'))
+    
+    # Ask the browser to check again shortly
+    response = app.response_class("Your meal plan is being generated...", status=202, mimetype='text/plain')
+    response.headers['Refresh'] = str(JOB_POLL_INTERVAL)
+    response.headers['Retry-After'] = str(JOB_POLL_INTERVAL)
+    return response
+
+@app.route('/api/plan_jobs', methods=['POST'])
+def create_plan_job():
+    """API endpoint to start generating a meal plan in the background"""
+    try:
+        job = submit_plan_job(_preferences_from_request())
+    except QueueFullError as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(JOB_POLL_INTERVAL)
+        return response
+    
+    response = jsonify(dict(job_to_dict(job), status_url=url_for('plan_job_status', job_id=job.id)))
+    response.status_code = 202
+    response.headers['Location'] = url_for('plan_job_status', job_id=job.id)
+    return response
+
+@app.route('/api/plan_jobs/<job_id>')
+def plan_job_status(job_id):
+    """API endpoint to poll a background meal plan job"""
+    job = get_plan_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    result = job_to_dict(job)
+    if job.status == 'done':
+        result['plan_url'] = url_for('view_plan', plan_id=job.meal_plan_id)
+    
+    response = jsonify(result)
+    if job.status in ('queued', 'running'):
+        response.headers['Retry-After'] = str(JOB_POLL_INTERVAL)
+    return response
+
+@app.route('/api/plan_jobs/metrics')
+def plan_job_metrics():
+    """API endpoint with queue depth and job durations for this worker"""
+    return jsonify(job_metrics())
+
+def _plan_response(body, mimetype, etag=None):
+    """Wrap a plan view; with an ETag, caches may keep it but must revalidate"""
+    response = Response(body, mimetype=mimetype)
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.no_store = True
+    return response
+
+def _cached_plan_view(plan_id, view, render, mimetype):
+    """
+    Serve a plan view with a strong ETag made from the plan's version
+    Conditional GETs for the current version get a 304 after a single query,
+    and repeated views are served from the rendered fragment cache
+    render(meal_plan, days) produces the body on a cache miss
+    """
+    version = plan_version(plan_id)
+    if version is None:
+        abort(404)
+    
+    etag = f"{view}-{plan_id}-{version}-{PLAN_VIEW_REVISION}"
+    if request.if_none_match.contains(etag):
+        metrics.PLAN_VIEWS.labels(view, 'not_modified').inc()
+        response = _plan_response(None, mimetype, etag)
+        response.status_code = 304
+        return response
+    
+    body = fragments.get((view, plan_id, version))
+    if body is not None:
+        metrics.PLAN_VIEWS.labels(view, 'hit').inc()
+        return _plan_response(body, mimetype, etag)
+    
+    meal_plan, days = load_plan(plan_id)
+    if meal_plan is None:
+        abort(404)
+    
+    # The plan may have changed since its version was read, so key by what was loaded
+    body = render(meal_plan, days)
+    fragments.set((view, plan_id, meal_plan.version), body)
+    metrics.PLAN_VIEWS.labels(view, 'miss').inc()
+    return _plan_response(body, mimetype, f"{view}-{plan_id}-{meal_plan.version}-{PLAN_VIEW_REVISION}")
+
+def _render_plan(meal_plan, days):
+    """Render the plan page from what is stored with the plan, never the session"""
+    preferences = meal_plan.preferences or DEFAULT_PREFERENCES
+    macro_targets = meal_plan.macro_targets or plan_macro_targets(preferences)
     
     days_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     
@@ -87,12 +311,66 @@ def view_plan(plan_id):
         macro_targets=macro_targets
     )
 
+@app.route('/plan/<int:plan_id>')
+def view_plan(plan_id):
+    """View a generated meal plan"""
+    # Reading the session makes Flask add Vary: Cookie, so it is only read after
+    # a redirect that flashed a message; other views stay shareable
+    if request.args.get('flashed') and session.get('_flashes'):
+        # The page shows this visitor's flashed messages, so it can't be shared or cached
+        meal_plan, days = load_plan(plan_id)
+        if meal_plan is None:
+            abort(404)
+        metrics.PLAN_VIEWS.labels('html', 'uncached').inc()
+        return _plan_response(_render_plan(meal_plan, days), 'text/html')
+    
+    return _cached_plan_view(plan_id, 'html', _render_plan, 'text/html')
+
+@app.route('/api/plan/<int:plan_id>')
+def plan_api(plan_id):
+    """API endpoint with a stored meal plan and its days"""
+    return _cached_plan_view(
+        plan_id, 'json', lambda meal_plan, days: json.dumps(plan_to_dict(meal_plan, days)), 'application/json'
+    )
+
 @app.route('/recipe/<recipe_id>')
 def recipe_details(recipe_id):
     """View details for a specific recipe"""
     recipe = get_recipe_details(recipe_id)
     return render_template('recipe_details.html', recipe=recipe)
 
+@app.route('/api/recipe/<int:recipe_id>/similar')
+def similar_recipes(recipe_id):
+    """API endpoint with the locally held recipes closest in nutrition to a recipe"""
+    k = request.args.get('k', 10, type=int)
+    meal_type = request.args.get('meal_type') or None
+    if k is None or not 0 < k <= SIMILAR_RESULTS_LIMIT or (meal_type is not None and meal_type not in MEAL_TYPES):
+        abort(400)
+    
+    # The same diet options as plan generation, read from the query string
+    preferences = _preferences_from_request()
+    if query_tags(preferences, meal_type) is None:
+        return jsonify({'error': 'Similar recipes can\'t be filtered by these allergens'}), 400
+    
+    neighbours = similar.similar(recipe_id, k, preferences, meal_type)
+    if neighbours is None:
+        return jsonify({'error': 'Recipe not found'}), 404
+    
+    recipes = get_local_recipes([neighbour_id for neighbour_id, _ in neighbours])
+    return jsonify({
+        'recipe_id': recipe_id,
+        'results': [
+            {
+                'id': neighbour_id,
+                'title': recipes[neighbour_id].get('title'),
+                'image': recipes[neighbour_id].get('image'),
+                'nutrition': recipes[neighbour_id].get('nutrition'),
+                'distance': round(distance, 4)
+            }
+            for neighbour_id, distance in neighbours if neighbour_id in recipes
+        ]
+    })
+
 @app.route('/api/guidelines')
 def get_guidelines():
     """API endpoint to get USDA guidelines based on calorie target"""
@@ -100,9 +378,119 @@ def get_guidelines():
     macro_targets = get_macronutrient_targets(calorie_target)
     return jsonify(macro_targets)
 
+@app.route('/api/compliance/batch', methods=['POST'])
+def compliance_batch():
+    """API endpoint scoring many plans or days against USDA guidelines in one call"""
+    data = request.get_json(silent=True) or {}
+    plans = data.get('plans')
+    plan_ids = data.get('plan_ids')
+    
+    if plan_ids is not None:
+        # Stored plans are scored against the calorie target they were generated for
+        if not isinstance(plan_ids, list) or len(plan_ids) > COMPLIANCE_BATCH_LIMIT:
+            abort(400)
+        if not all(isinstance(plan_id, int) for plan_id in plan_ids):
+            abort(400)
+        # The database averages each plan's days, so they are scored straight from arrays
+        stored = load_plan_averages(plan_ids)
+        found = [plan_id for plan_id in dict.fromkeys(plan_ids) if plan_id in stored]
+        found_ids = set(found)
+        results = []
+        if found:
+            averages = [stored[plan_id][1] for plan_id in found]
+            calorie_targets = [(stored[plan_id][0] or DEFAULT_PREFERENCES)['calorie_target'] for plan_id in found]
+            results = compliance_results(compliance_scores(averages, calorie_targets))
+        return jsonify({
+            'results': [dict(result, plan_id=plan_id) for plan_id, result in zip(found, results)],
+            'missing': [plan_id for plan_id in plan_ids if plan_id not in found_ids]
+        })
+    
+    if not isinstance(plans, list) or len(plans) > COMPLIANCE_BATCH_LIMIT:
+        abort(400)
+    try:
+        # Days may be sent as {'nutrition': {...}} like generated plans, or as the nutrition dict itself
+        days = [[{'nutrition': day.get('nutrition', day)} for day in plan['days']] for plan in plans]
+        calorie_targets = [float(plan.get('calorie_target', 2000)) for plan in plans]
+        results = check_compliance_batch(days, calorie_targets)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logging.error(f"Invalid batch compliance request: {str(e)}")
+        abort(400)
+    return jsonify({'results': results})
+
+@app.route('/api/upstream/stats')
+def upstream_stats():
+    """API endpoint with Spoonacular call, circuit breaker, cache and coalescing counters for this worker"""
+    return jsonify({
+        'upstream': upstream.stats(),
+        'cache': cache.stats(),
+        'coalescing': {
+            'search': search_flights.stats(),
+            'recipe': recipe_flights.stats()
+        }
+    })
+
+@app.route('/api/quota')
+def quota_status():
+    """API endpoint with the Spoonacular quota left today and the shared rate limit"""
+    return jsonify(limiter.status())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus metrics for all workers"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def _require_profile_token():
+    """Refuse admin profiling requests without the profiling token; without a configured token they don't exist"""
+    if profiling.TOKEN is None:
+        abort(404)
+    if not profiling.authorized():
+        abort(403)
+
+@app.route('/admin/profiles')
+def admin_profiles():
+    """Admin endpoint with this worker's slowest recent requests by phase and the saved profiles of every worker"""
+    _require_profile_token()
+    limit = max(1, min(request.args.get('limit', 20, type=int), profiling.RECENT_REQUESTS))
+    return jsonify({
+        'slowest': profiling.slowest(limit),
+        'profiles': profiling.saved(limit)
+    })
+
+@app.route('/admin/profiles/<profile_id>')
+def admin_profile(profile_id):
+    """Admin endpoint returning a saved profile as collapsed stacks"""
+    _require_profile_token()
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='text/plain')
+
+def _plan_pools(meal_plan):
+    """
+    Return the preferences and candidate pools of a stored plan
+    Plans stored before pools were kept are searched for once and updated
+    The caller is responsible for committing
+    """
+    preferences = meal_plan.preferences
+    if preferences is None:
+        # Keep them with the plan from now on, so its views no longer depend on the session
+        preferences = session.get('preferences', DEFAULT_PREFERENCES)
+        meal_plan.preferences = preferences
+        meal_plan.macro_targets = plan_macro_targets(preferences)
+        # Plan views show the macro targets, so cached ones are out of date
+        bump_version(meal_plan.id)
+    
+    pools = load_candidate_pools(meal_plan)
+    if pools is None:
+        pools = plan_candidate_pools(preferences)
+        save_candidate_pools(meal_plan.id, pools)
+    
+    return preferences, pools
+
 @app.route('/regenerate_day', methods=['POST'])
 def regenerate_day():
-    """Regenerate a specific day in the meal plan"""
+    """Regenerate a specific day in the meal plan from its stored candidates"""
     try:
         plan_id = request.form.get('plan_id', type=int)
         day_index = request.form.get('day_index', type=int)
@@ -110,37 +498,106 @@ def regenerate_day():
         meal_plan = MealPlan.query.get_or_404(plan_id)
         day = MealPlanDay.query.filter_by(meal_plan_id=plan_id, day_of_week=day_index).first_or_404()
         
-        # Get preferences from session
-        preferences = session.get('preferences', {
-            'calorie_target': 2000,
-            'diet_type': 'balanced',
-            'vegetarian': False,
-            'vegan': False,
-            'gluten_free': False,
-            'dairy_free': False,
-            'allergens': ''
-        })
-        
-        # Generate a new day's meal plan
-        new_day = generate_meal_plan(preferences, days=1)[0]
+        # Choose new meals from the plan's candidates, no upstream calls needed
+        preferences, pools = _plan_pools(meal_plan)
+        current = {meal: getattr(day, f"{meal}_id") for meal in MEALS}
+        new_day = choose_day(pools, preferences, current=current)
         
-        # Update the day in the database
-        day.breakfast = new_day['breakfast']
-        day.lunch = new_day['lunch']
-        day.dinner = new_day['dinner']
-        day.snacks = new_day['snacks']
-        day.total_calories = new_day['nutrition']['calories']
-        day.total_protein = new_day['nutrition']['protein']
-        day.total_carbs = new_day['nutrition']['carbs']
-        day.total_fat = new_day['nutrition']['fat']
-        day.total_fiber = new_day['nutrition']['fiber']
+        # Only the meals that changed are swapped, and the totals adjusted by the difference
+        changed = False
+        for meal in MEALS:
+            if new_day[meal] and new_day[meal]['id'] != current[meal]:
+                replace_meal(day, meal, new_day[meal])
+                changed = True
+        # Cached views and ETags only go stale when a meal actually changes
+        if changed:
+            bump_version(plan_id)
         
         db.session.commit()
         
         flash(f"Day {day_index + 1} has been regenerated successfully!", "success")
-        return redirect(url_for('view_plan', plan_id=plan_id))
+        return redirect(url_for('view_plan', plan_id=plan_id, flashed=1))
     
     except Exception as e:
         logging.error(f"Error regenerating day: {str(e)}")
         flash(f"Error regenerating day: {str(e)}", "danger")
-        return redirect(url_for('view_plan', plan_id=plan_id))
+        return redirect(url_for('view_plan', plan_id=plan_id, flashed=1))
+
+def _similar_meal(day, meal, preferences):
+    """
+    Return the local recipe closest in nutrition to a meal of a day, that suits
+    the plan's preferences and isn't already on the day, or None if there is none
+    """
+    current = getattr(day, meal)
+    if current is None:
+        return None
+    exclude = {getattr(day, f"{other}_id") for other in MEALS} - {None}
+    neighbours = similar.similar(current['id'], 1, preferences, MEAL_SEARCH_TYPES[meal], exclude=exclude)
+    if not neighbours:
+        return None
+    return get_local_recipes([neighbours[0][0]]).get(neighbours[0][0])
+
+@app.route('/swap_meal', methods=['POST'])
+def swap_meal():
+    """Replace a single meal of a day with another of the plan's candidates, or the recipe most like it"""
+    data = request.get_json(silent=True) or request.form
+    try:
+        plan_id = int(data.get('plan_id'))
+        day_index = int(data.get('day_index'))
+    except (TypeError, ValueError):
+        abort(400)
+    meal = data.get('meal')
+    recipe_id = data.get('recipe_id') or None
+    by_similarity = str(data.get('similar', '')).lower() in ('1', 'true', 'on')
+    
+    if meal not in MEALS:
+        abort(400)
+    
+    meal_plan = MealPlan.query.get_or_404(plan_id)
+    day = MealPlanDay.query.filter_by(meal_plan_id=plan_id, day_of_week=day_index).first_or_404()
+    preferences, pools = _plan_pools(meal_plan)
+    pool = pools.get(meal) or []
+    
+    recipe = None
+    if recipe_id is not None:
+        # A specific candidate was picked
+        recipe = next((candidate for candidate in pool if str(candidate['id']) == str(recipe_id)), None)
+        if recipe is None:
+            abort(400)
+    elif by_similarity:
+        # The closest recipe held locally, whether or not it is one of the plan's candidates
+        recipe = _similar_meal(day, meal, preferences)
+    
+    if recipe is None:
+        day_nutrition = {
+            'calories': day.total_calories or 0,
+            'protein': day.total_protein or 0,
+            'carbs': day.total_carbs or 0,
+            'fat': day.total_fat or 0,
+            'fiber': day.total_fiber or 0
+        }
+        recipe = choose_meal(pool, day_nutrition, getattr(day, meal), preferences)
+    
+    if recipe is not None and recipe['id'] != getattr(day, f"{meal}_id"):
+        replace_meal(day, meal, recipe)
+        # Cached views and ETags only go stale when a meal actually changes
+        bump_version(plan_id)
+    db.session.commit()
+    
+    if request.is_json:
+        return jsonify({
+            'plan_id': plan_id,
+            'day_index': day_index,
+            'meal': meal,
+            'recipe': getattr(day, meal),
+            'nutrition': {
+                'calories': day.total_calories,
+                'protein': day.total_protein,
+                'carbs': day.total_carbs,
+                'fat': day.total_fat,
+                'fiber': day.total_fiber
+            }
+        })
+    
+    flash(f"{meal.capitalize()} on day {day_index + 1} has been swapped!", "success")
+    return redirect(url_for('view_plan', plan_id=plan_id, flashed=1))
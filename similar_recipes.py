@@ -0,0 +1,393 @@
+"""
+Similar Recipe Index
+
+Finds the recipes closest in nutrition to a given recipe, to offer
+substitutes for a meal without generating a whole new day:
+- Recipes come from the recipe snapshot, the local catalog and the recipe
+  cache, so lookups never call Spoonacular
+- Each recipe is a point of calories, protein, carbs, fat and fiber, scaled
+  by each nutrient's spread so no single nutrient dominates the distance
+- Points are split into a KD-tree; a query ranks the leaves by their
+  distance from the recipe and stops once no closer leaf can remain
+- Dietary masks and meal types are kept for every point, so a query only
+  returns recipes the same search_recipes preferences would allow
+- Every few minutes a background thread checks whether the snapshot,
+  catalog or cache has changed and if so builds a new index, which
+  replaces the old one once it is ready; lookups never wait for a rebuild
+- Workers forked from a preloaded master start with the master's copy and
+  keep sharing it until their recipes change
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+import numpy as np
+
+from nutrients import NAMES
+from recipe_cache import cache
+from recipe_catalog import catalog, MEAL_TYPES
+from recipe_snapshot import snapshots
+from dietary import compile_preferences, search_mask, recipe_mask, suits
+
+# Seconds between checks for changes to the recipes the index was built from
+REFRESH_INTERVAL = int(os.environ.get("SIMILAR_INDEX_REFRESH", 300))
+
+# Most points in a KD-tree leaf
+LEAF_SIZE = 128
+
+# Leaves a query reads first when bounding the distance of its k-th nearest recipe
+NEAREST_LEAVES = 8
+
+# Nutrients recipes are compared on
+FEATURES = NAMES[:5]
+
+# Meal types are stored above the bits of dietary masks
+MEAL_TYPE_BITS = {meal: 1 << (24 + i) for i, meal in enumerate(MEAL_TYPES)}
+
+# Spoonacular's diet booleans, which recipes cached before they carried a dietary mask still have
+DIET_FIELDS = ('vegetarian', 'vegan', 'glutenFree', 'dairyFree')
+
+
+def search_tags(params):
+    """
+    Return the dietary and meal type bits every result of a cached search has
+    """
+    return search_mask(params) | MEAL_TYPE_BITS.get(params.get('type'), 0)
+
+
+def query_tags(preferences, meal_type=None):
+    """
+    Return the bits a recipe must have to match the preferences and meal type,
+    or None if the preferences include allergens the index can't check
+    """
+    profile = compile_preferences(preferences)
+    if profile.other_allergens:
+        return None
+    return profile.mask | MEAL_TYPE_BITS.get(meal_type, 0)
+
+
+class NutritionTree:
+    """
+    KD-tree over scaled nutrition points, with the tag bits of every point
+    """
+
+    def __init__(self, ids, points, tags, leaf_size=LEAF_SIZE):
+        self.size = len(ids)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, len(FEATURES))
+
+        # Distances are measured in units of each nutrient's spread
+        scale = points.std(axis=0) if self.size else np.ones(len(FEATURES))
+        self.scale = np.where(scale > 0, scale, 1.0)
+        points = points / self.scale
+
+        order, bounds = self._partition(points, leaf_size)
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.points = points[order]
+        self.tags = np.asarray(tags, dtype=np.uint32)[order]
+        self.leaf_bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 2)
+
+        # Bounding box of every leaf, to rule leaves out without reading their points
+        count = len(self.leaf_bounds)
+        self.leaf_low = np.empty((count, len(FEATURES)))
+        self.leaf_high = np.empty((count, len(FEATURES)))
+        for leaf, (start, end) in enumerate(self.leaf_bounds):
+            self.leaf_low[leaf] = self.points[start:end].min(axis=0)
+            self.leaf_high[leaf] = self.points[start:end].max(axis=0)
+
+        # Leaves in row order, for counting the matching points of every leaf
+        self._leaf_row_order = np.argsort(self.leaf_bounds[:, 0], kind='stable')
+        self._leaf_row_starts = self.leaf_bounds[self._leaf_row_order, 0]
+
+        # Rows by recipe ID, for looking up the point of a recipe
+        self._id_order = np.argsort(self.ids, kind='stable')
+        self._sorted_ids = self.ids[self._id_order]
+
+        for values in (self.scale, self.ids, self.points, self.tags, self.leaf_bounds, self.leaf_low,
+                       self.leaf_high, self._leaf_row_order, self._leaf_row_starts, self._id_order, self._sorted_ids):
+            values.flags.writeable = False
+
+    @staticmethod
+    def _partition(points, leaf_size):
+        """
+        Split the points at the median of their widest nutrient until every part fits in a leaf
+        Returns the point order and the (start, end) of every leaf within it
+        """
+        order = np.arange(len(points))
+        bounds = []
+        stack = [(0, len(points))] if len(points) else []
+        while stack:
+            start, end = stack.pop()
+            if end - start <= leaf_size:
+                bounds.append((start, end))
+                continue
+            part = order[start:end]
+            values = points[part]
+            dim = int(np.argmax(values.max(axis=0) - values.min(axis=0)))
+            middle = (end - start) // 2
+            order[start:end] = part[np.argpartition(values[:, dim], middle)]
+            # The right half is pushed first so leaves come out left to right
+            stack.append((start + middle, end))
+            stack.append((start, start + middle))
+        return order, bounds
+
+    def point(self, recipe_id):
+        """
+        Return the scaled point and tags of a recipe, or None if it isn't indexed
+        """
+        i = np.searchsorted(self._sorted_ids, recipe_id)
+        if i >= self.size or self._sorted_ids[i] != recipe_id:
+            return None
+        row = self._id_order[i]
+        return self.points[row], int(self.tags[row])
+
+    def _leaf_matches(self, required):
+        """
+        Return how many points of every leaf have all the required tag bits
+        Counted for each query, as the tree is shared read-only between threads
+        """
+        if not required:
+            return self.leaf_bounds[:, 1] - self.leaf_bounds[:, 0]
+        # Leaves are runs of rows that cover them all, so in row order they can be summed in one pass
+        matches = np.empty(len(self.leaf_bounds), dtype=np.int64)
+        matches[self._leaf_row_order] = np.add.reduceat(
+            suits(self.tags, required), self._leaf_row_starts, dtype=np.int64
+        )
+        return matches
+
+    def _rows(self, leaves):
+        """
+        Return the rows of every point in the given leaves
+        """
+        starts = self.leaf_bounds[leaves, 0]
+        lengths = self.leaf_bounds[leaves, 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+
+    def _nearest(self, rows, point, required, count):
+        """
+        Return the rows and squared distances of the `count` nearest points
+        among the given rows that have every required tag bit, nearest first
+        """
+        rows = rows[suits(self.tags[rows], required)]
+        diff = self.points[rows] - point
+        distances = np.einsum('ij,ij->i', diff, diff)
+        if len(rows) > count:
+            nearest = np.argpartition(distances, count - 1)[:count]
+            rows, distances = rows[nearest], distances[nearest]
+        # Equal distances are ordered by row, so results don't depend on which leaves were read
+        order = np.lexsort((rows, distances))
+        return rows[order], distances[order]
+
+    def query(self, point, k=10, required=0, exclude=()):
+        """
+        Return up to k (recipe ID, distance) pairs nearest to a scaled point,
+        nearest first, among recipes with every required tag bit
+        Recipe IDs in exclude are left out
+        """
+        if not self.size or k <= 0:
+            return []
+        exclude = set(exclude)
+        wanted = k + len(exclude)
+
+        # Squared distance from the point to a leaf's bounding box is a lower bound for its points
+        matches = self._leaf_matches(required)
+        gaps = np.clip(point, self.leaf_low, self.leaf_high) - point
+        leaf_distances = np.einsum('ij,ij->i', gaps, gaps)
+        leaf_distances[matches == 0] = np.inf
+
+        # The nearest leaves holding enough matching points bound how far the k-th nearest can be;
+        # they are usually among the first few, so only those are sorted unless more are needed
+        radius = np.inf
+        for candidates in (NEAREST_LEAVES, len(leaf_distances)):
+            if candidates < len(leaf_distances):
+                nearest = np.argpartition(leaf_distances, candidates)[:candidates]
+            else:
+                nearest = np.arange(len(leaf_distances))
+            nearest = nearest[np.argsort(leaf_distances[nearest], kind='stable')]
+            count = np.searchsorted(np.cumsum(matches[nearest]), wanted) + 1
+            if count <= len(nearest):
+                _, distances = self._nearest(self._rows(nearest[:count]), point, required, wanted)
+                radius = distances[-1]
+                break
+
+        # Every leaf that could hold a nearer point is read in one pass
+        leaves = np.flatnonzero((leaf_distances <= radius) & (matches > 0))
+        rows, distances = self._nearest(self._rows(leaves), point, required, wanted)
+        results = [
+            (recipe_id, distance ** 0.5)
+            for recipe_id, distance in zip(self.ids[rows].tolist(), distances.tolist())
+            if recipe_id not in exclude
+        ]
+        return results[:k]
+
+
+class SimilarRecipes:
+    """
+    Nearest-neighbour lookups over the recipes held locally, rebuilt periodically
+    """
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+        # Trees are never modified once built, so workers forked after a build share it
+        self._state = {'tree': None, 'built_at': 0, 'signature': None}
+
+    def _sources(self):
+        """
+        Return the recipe IDs, nutrition points and tags of every local recipe
+        Snapshot recipes come first, then catalog recipes, each with their
+        own tags; cached recipes get the tags of the searches that returned them
+        """
+        ids, points, tags = [], [], []
+        seen = set()
+        for recipe_id, meal_types, flags, nutrition in catalog.nutrition_rows(FEATURES):
+            tag = flags
+            for meal in meal_types.split(','):
+                tag |= MEAL_TYPE_BITS.get(meal, 0)
+            ids.append(recipe_id)
+            points.append(nutrition)
+            tags.append(tag)
+            seen.add(recipe_id)
+
+        searched = {}
+        for key, results in cache.items('search'):
+            try:
+                tag = search_tags(json.loads(key))
+            except (ValueError, AttributeError):
+                continue
+            for result in results or ():
+                recipe_id = str(result.get('id'))
+                searched[recipe_id] = searched.get(recipe_id, 0) | tag
+
+        fields = ('diet_mask',) + DIET_FIELDS
+        paths = [f"$.nutrition.{name}" for name in FEATURES] + [f"$.{field}" for field in fields]
+        for key, *values in cache.extract('recipe', paths):
+            try:
+                recipe_id = int(key)
+            except ValueError:
+                continue
+            if recipe_id in seen:
+                continue
+            nutrition = [value or 0 for value in values[:len(FEATURES)]]
+            mask = recipe_mask(dict(zip(fields, values[len(FEATURES):])), dict(zip(FEATURES, nutrition)))
+            ids.append(recipe_id)
+            points.append(nutrition)
+            tags.append(mask | searched.get(key, 0))
+            seen.add(recipe_id)
+
+        snapshot = snapshots.current()
+        if snapshot is None or not len(snapshot):
+            return ids, points, tags
+
+        snapshot_tags = snapshot.diet_masks.astype(np.uint32)
+        for bit, meal in enumerate(snapshot.meal_type_names):
+            snapshot_tags[(snapshot.meal_types & (1 << bit)) != 0] |= MEAL_TYPE_BITS.get(meal, 0)
+
+        # Catalog and cached copies of snapshot recipes are left out
+        others = snapshot.rows(ids) < 0
+        return (
+            np.concatenate((snapshot.ids, np.asarray(ids, dtype=np.int64)[others])),
+            np.concatenate((
+                snapshot.points(FEATURES),
+                np.asarray(points, dtype=np.float64).reshape(-1, len(FEATURES))[others]
+            )),
+            np.concatenate((snapshot_tags, np.asarray(tags, dtype=np.uint32)[others]))
+        )
+
+    def _signature(self):
+        """
+        Return a fingerprint of the recipe sources that changes whenever their recipes do
+        """
+        snapshot = snapshots.current()
+        return (
+            snapshot.identity if snapshot is not None else None,
+            catalog.fingerprint(),
+            cache.fingerprint('recipe'),
+            cache.fingerprint('search')
+        )
+
+    def load(self):
+        """
+        Build the index from the snapshot, catalog and cache
+        """
+        started = time.perf_counter()
+        # Taken first, so changes made during the build are picked up by the next check
+        signature = self._signature()
+        tree = NutritionTree(*self._sources())
+        logging.info(f"Built similar recipe index of {tree.size} recipes in {time.perf_counter() - started:.2f}s")
+        with self._lock:
+            self._state.update(tree=tree, built_at=time.time(), signature=signature)
+        return tree
+
+    def tree(self):
+        """
+        Return this process's index
+        Only the first lookup waits for it to be built. Once it is out of date,
+        a background thread rebuilds it while lookups keep using this one
+        """
+        state = self._state
+        tree = state['tree']
+        if tree is None:
+            with self._building:
+                # Another thread may have built it while this one waited
+                tree = self._state['tree']
+                return tree if tree is not None else self.load()
+
+        if time.time() - state['built_at'] >= self.refresh_interval and self._building.acquire(blocking=False):
+            if time.time() - self._state['built_at'] >= self.refresh_interval:
+                threading.Thread(target=self._refresh, name='similar-index', daemon=True).start()
+            else:
+                self._building.release()
+        return tree
+
+    def _refresh(self):
+        """
+        Rebuild the index if its recipes have changed; runs in a background thread holding _building
+        """
+        try:
+            if self._signature() == self._state['signature']:
+                # Keeping the same tree keeps the pages it shares with the master
+                with self._lock:
+                    self._state.update(built_at=time.time())
+            else:
+                self.load()
+        except Exception as e:
+            logging.error(f"Error rebuilding the similar recipe index: {str(e)}")
+            # Try again after another interval rather than on every lookup
+            with self._lock:
+                self._state.update(built_at=time.time())
+        finally:
+            self._building.release()
+
+    def similar(self, recipe_id, k=10, preferences=None, meal_type=None, exclude=()):
+        """
+        Return up to k (recipe ID, distance) pairs closest in nutrition to a recipe
+        Only recipes matching the preferences and meal type are returned
+        Returns None if the recipe isn't indexed or the preferences can't be checked
+        """
+        try:
+            recipe_id = int(recipe_id)
+        except (TypeError, ValueError):
+            return None
+        required = query_tags(preferences or {}, meal_type)
+        tree = self.tree()
+        found = tree.point(recipe_id)
+        if found is None or required is None:
+            return None
+        return tree.query(found[0], k, required, exclude=set(exclude) | {recipe_id})
+
+    def stats(self):
+        state = self._state
+        tree = state['tree']
+        return {
+            'recipes': tree.size if tree is not None else 0,
+            'leaves': len(tree.leaf_bounds) if tree is not None else 0,
+            'age_seconds': round(time.time() - state['built_at'], 1) if tree is not None else None
+        }
+
+
+# Shared index used by the recipe and plan routes
+similar = SimilarRecipes()
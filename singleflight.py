@@ -0,0 +1,183 @@
+"""
+Single-Flight Request Coalescing
+
+Makes sure only one upstream call is in flight for each distinct key:
+- Within a process, concurrent callers asking for a key that is already being
+  fetched wait for that fetch and share its result (or its error)
+- Across worker processes, the fetching caller holds a file lock for the key;
+  callers in other workers wait for the lock and then find the result in the
+  shared recipe cache through a recheck instead of calling upstream again
+
+File locks are striped over a fixed number of lock files, so unrelated keys
+occasionally wait on each other but the lock directory never grows. Cross-worker
+coalescing needs fcntl and is skipped on platforms without it.
+"""
+import os
+import time
+import zlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import metrics
+
+# Directory holding the lock files shared by the worker processes
+LOCK_DIR = os.environ.get("SINGLEFLIGHT_LOCK_DIR", os.path.join(tempfile.gettempdir(), 'meal-planner-locks'))
+
+# Number of lock files keys are spread over
+LOCK_STRIPES = int(os.environ.get("SINGLEFLIGHT_LOCK_STRIPES", 256))
+
+# Maximum seconds to wait for another worker's fetch before fetching anyway
+LOCK_TIMEOUT = float(os.environ.get("SINGLEFLIGHT_LOCK_TIMEOUT", 10))
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent fetches of the same keys within one namespace
+    """
+
+    def __init__(self, namespace, lock_dir=LOCK_DIR, stripes=LOCK_STRIPES, lock_timeout=LOCK_TIMEOUT):
+        self.namespace = namespace
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.lock_timeout = lock_timeout
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {
+            'fetched': 0,
+            'shared': 0,
+            'rechecked': 0,
+            'lock_timeouts': 0
+        }
+
+    def _count(self, name, amount=1):
+        if amount:
+            with self._lock:
+                self._counters[name] += amount
+            metrics.SINGLEFLIGHT_KEYS.labels(self.namespace, name).inc(amount)
+
+    def _stripe(self, key):
+        return zlib.crc32(f"{self.namespace}:{key}".encode()) % self.stripes
+
+    @contextmanager
+    def _file_locks(self, keys, timeout):
+        """
+        Hold the lock files of the given keys, giving up on them after the timeout
+        """
+        if fcntl is None or self.stripes <= 0:
+            yield
+            return
+
+        wait = self.lock_timeout if timeout is None else max(0, min(self.lock_timeout, timeout))
+        deadline = time.monotonic() + wait
+        held = []
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            # Always lock in the same order so two callers can't each hold what the other needs
+            for stripe in sorted({self._stripe(key) for key in keys}):
+                fd = os.open(os.path.join(self.lock_dir, f"{stripe}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+                held.append(fd)
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            raise TimeoutError(f"Timed out waiting for the {self.namespace} lock")
+                        time.sleep(0.01)
+        except (OSError, TimeoutError) as e:
+            # Fetching twice is better than not fetching at all
+            if isinstance(e, TimeoutError):
+                self._count('lock_timeouts')
+            else:
+                logging.error(f"Single-flight lock error: {str(e)}")
+            for fd in held:
+                os.close(fd)
+            held = []
+
+        try:
+            yield
+        finally:
+            # Closing the file descriptors releases their locks
+            for fd in held:
+                os.close(fd)
+
+    def do(self, key, fetch, recheck=None, timeout=None):
+        """
+        Return fetch() for a key, sharing one call among concurrent callers
+        recheck() is called once any other worker's fetch of the key has finished
+        and should return the value it stored, or None if there is none
+        """
+        def fetch_many(keys):
+            return {key: fetch()}
+
+        def recheck_many(keys):
+            value = recheck()
+            return {} if value is None else {key: value}
+
+        return self.do_many([key], fetch_many, recheck_many if recheck else None, timeout)[key]
+
+    def do_many(self, keys, fetch, recheck=None, timeout=None):
+        """
+        Return a dict of values for several keys, sharing the keys already in flight
+        fetch(keys) and recheck(keys) return dicts for the given keys; recheck
+        leaves out the keys it has no value for. Keys fetch leaves out map to None
+        Waits at most timeout seconds for other callers' results (TimeoutError)
+        """
+        led, followed = [], {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                future = self._calls.get(key)
+                if future is None:
+                    self._calls[key] = future = Future()
+                    led.append(key)
+                else:
+                    followed[key] = future
+
+        results = {}
+        if led:
+            try:
+                with self._file_locks(led, timeout):
+                    # Another worker may have stored these while we waited for the lock
+                    found = recheck(led) if recheck else {}
+                    remaining = [key for key in led if key not in found]
+                    fetched = fetch(remaining) if remaining else {}
+            except BaseException as e:
+                self._finish(led, error=e)
+                raise
+
+            results = {key: found[key] if key in found else fetched.get(key) for key in led}
+            self._finish(led, results=results)
+            self._count('rechecked', len(found))
+            self._count('fetched', len(remaining))
+
+        self._count('shared', len(followed))
+        for key, future in followed.items():
+            results[key] = future.result(timeout=timeout)
+        return results
+
+    def _finish(self, keys, results=None, error=None):
+        with self._lock:
+            futures = [self._calls.pop(key) for key in keys]
+        for key, future in zip(keys, futures):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[key])
+
+    def stats(self):
+        """
+        Return how many keys this process fetched, shared or found after waiting
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._calls)
+        return stats
@@ -0,0 +1,409 @@
+"""
+Upstream HTTP Client
+
+Shared plumbing for calls to the Spoonacular API:
+- A pooled requests session that keeps connections to the API alive
+- Bounded thread pools for running recipe searches and detail lookups in parallel
+- Round-trip counters, per process and for any block of code via track_calls()
+- Connect/read timeouts on every call and deadline budgets for groups of calls
+- A circuit breaker that fails fast after repeated upstream failures
+- Optional hedged requests that retry slow calls before they time out
+- The shared Spoonacular rate limit and daily quota (see quota.py)
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import profiling
+import quota
+
+# Maximum number of concurrent upstream calls per process
+# Set to 1 to run every upstream call serially in the calling thread
+MAX_WORKERS = int(os.environ.get("UPSTREAM_MAX_WORKERS", 8))
+
+# Meal types searched in parallel when building a plan
+SEARCH_WORKERS = 4
+
+# Per-call timeouts in seconds
+CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10))
+
+# Consecutive failures that open the circuit breaker, and seconds it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("UPSTREAM_BREAKER_RESET", 30))
+
+# Seconds to wait for a response before sending a second, hedged request (0 disables hedging)
+HEDGE_AFTER = float(os.environ.get("UPSTREAM_HEDGE_AFTER", 0))
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of calling upstream while the circuit breaker is open
+    """
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Raised when the time budget of a deadline() block has run out
+    """
+
+
+_lock = threading.Lock()
+_state = {'pid': None, 'session': None, 'executors': {}}
+
+# Trackers collecting the round trips made inside track_calls() blocks
+_active_trackers = contextvars.ContextVar('upstream_call_trackers', default=())
+
+# Absolute time.monotonic() deadline of the innermost deadline() block
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+
+_counters = {
+    'failures': 0,
+    'timeouts': 0,
+    'deadline_exceeded': 0,
+    'breaker_rejections': 0,
+    'breaker_opened': 0,
+    'hedges_sent': 0,
+    'hedges_won': 0
+}
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+class CircuitBreaker:
+    """
+    Opens after a run of consecutive failures so that callers fail fast and
+    use local data, then lets a single trial call through after a cool-down
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+
+    def is_open(self):
+        return self.state == 'open'
+
+    def allow(self):
+        """
+        Return True if a call may be made now
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def release(self):
+        """
+        Give back a trial call allowed by allow() that was never made
+        """
+        with self._lock:
+            if self._opened_at is not None:
+                self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            reopen = self._trial_in_flight
+            self._trial_in_flight = False
+            if reopen or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                opened = True
+            else:
+                opened = False
+        if opened:
+            _count('breaker_opened')
+            logging.error("Spoonacular circuit breaker opened after repeated failures")
+
+
+breaker = CircuitBreaker()
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Limit the total time upstream calls inside the block may take
+    Calls shorten their timeouts to fit the remaining budget, and raise
+    DeadlineExceeded once it is used up. Nested deadlines keep the earliest one.
+    """
+    new_deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(new_deadline if current is None else min(current, new_deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget():
+    """
+    Return the seconds left in the current deadline() block, or None outside one
+    """
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+class CallTracker:
+    """
+    Counts upstream round trips by endpoint
+    """
+
+    def __init__(self):
+        self.by_endpoint = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint):
+        with self._lock:
+            self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(self.by_endpoint.values())
+
+
+# Round trips made by this process since it started
+process_calls = CallTracker()
+
+
+@contextmanager
+def track_calls():
+    """
+    Count the upstream round trips made inside the block, including the ones
+    made from parallel_map worker threads on its behalf
+
+        with upstream.track_calls() as calls:
+            generate_meal_plan(preferences)
+        print(calls.total, calls.by_endpoint)
+    """
+    tracker = CallTracker()
+    token = _active_trackers.set(_active_trackers.get() + (tracker,))
+    try:
+        yield tracker
+    finally:
+        _active_trackers.reset(token)
+
+
+def _reset_after_fork():
+    """
+    Sessions and thread pools can't be shared across a fork, so each
+    worker process creates its own the first time it needs them
+    """
+    if _state['pid'] != os.getpid():
+        _state['pid'] = os.getpid()
+        _state['session'] = None
+        _state['executors'] = {}
+
+
+def get_session():
+    """
+    Return the process-wide session used for all upstream requests
+    """
+    with _lock:
+        _reset_after_fork()
+        if _state['session'] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(MAX_WORKERS, SEARCH_WORKERS))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _state['session'] = session
+        return _state['session']
+
+
+def _record_call(endpoint, trackers):
+    process_calls.record(endpoint)
+    for tracker in trackers:
+        tracker.record(endpoint)
+
+
+def _fetch(url, params, timeout, endpoint, trackers):
+    _record_call(endpoint, trackers)
+    started = time.perf_counter()
+    outcome = 'error'
+    decode_seconds = 0
+    try:
+        response = get_session().get(url, params=params, timeout=timeout)
+        quota.limiter.record_response(response.headers)
+        if response.status_code == 402:
+            # Spoonacular answers 402 Payment Required once the daily quota is used up
+            quota.limiter.mark_exhausted()
+        response.raise_for_status()
+        decode_started = time.perf_counter()
+        result = response.json()
+        decode_seconds = time.perf_counter() - decode_started
+        outcome = 'ok'
+        return result
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.UPSTREAM_SECONDS.labels(endpoint, outcome).observe(elapsed)
+        profiling.record('upstream', elapsed - decode_seconds)
+        profiling.record('upstream_json', decode_seconds)
+
+
+def _hedged_fetch(url, params, timeout, endpoint, trackers):
+    """
+    Fetch a URL, sending a second request if the first hasn't answered
+    within HEDGE_AFTER seconds, and return whichever succeeds first
+    """
+    # Both requests run in a copy of the caller's context, like parallel_map
+    # tasks, so they keep its deadline and profile
+    executor = _get_executor('hedge', MAX_WORKERS * 2)
+    first = executor.submit(contextvars.copy_context().run, _fetch, url, params, timeout, endpoint, trackers)
+    try:
+        return first.result(timeout=HEDGE_AFTER)
+    except FuturesTimeoutError:
+        pass
+
+    try:
+        quota.limiter.acquire(endpoint, params, priority='refresh', max_wait=0)
+    except quota.QuotaExceeded:
+        # Not worth spending scarce quota on a duplicate request
+        return first.result()
+
+    _count('hedges_sent')
+    second = executor.submit(contextvars.copy_context().run, _fetch, url, params, timeout, endpoint, trackers)
+
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    _count('hedges_won')
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def _is_upstream_failure(error):
+    """
+    Whether an error means upstream is unhealthy (as opposed to a bad request)
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, ValueError))
+
+
+def get_json(url, params=None, endpoint='other', timeout=None, priority='fill'):
+    """
+    Make a GET request through the shared session and return the decoded JSON body
+    priority is 'fill' when there is no cached copy of the data, or 'refresh'
+    when the caller could serve an expired cache entry instead (see quota.py)
+    Raises requests.RequestException on network errors and non-200 responses,
+    CircuitOpenError while the circuit breaker is open, DeadlineExceeded
+    when the current deadline() budget has run out and quota.QuotaExceeded
+    when the shared rate limit or daily quota doesn't allow the call
+    """
+    read_timeout = timeout or READ_TIMEOUT
+    remaining = remaining_budget()
+    if remaining is not None:
+        if remaining <= 0:
+            _count('deadline_exceeded')
+            raise DeadlineExceeded(f"Upstream time budget exhausted before calling {endpoint}")
+        read_timeout = min(read_timeout, remaining)
+
+    if not breaker.allow():
+        _count('breaker_rejections')
+        raise CircuitOpenError(f"Spoonacular circuit breaker is open, skipping {endpoint}")
+
+    # Quota is only spent on calls the breaker lets through
+    max_wait = quota.limiter.max_wait if remaining is None else min(quota.limiter.max_wait, remaining)
+    try:
+        quota.limiter.acquire(endpoint, params, priority=priority, max_wait=max_wait)
+    except quota.QuotaExceeded:
+        # Leave the trial call of a half-open breaker to a call that can be made
+        breaker.release()
+        raise
+
+    timeouts = (min(CONNECT_TIMEOUT, read_timeout), read_timeout)
+    trackers = _active_trackers.get()
+    try:
+        if HEDGE_AFTER > 0 and HEDGE_AFTER < read_timeout:
+            result = _hedged_fetch(url, params, timeouts, endpoint, trackers)
+        else:
+            result = _fetch(url, params, timeouts, endpoint, trackers)
+    except Exception as e:
+        if _is_upstream_failure(e):
+            _count('failures')
+            if isinstance(e, requests.Timeout):
+                _count('timeouts')
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+
+    breaker.record_success()
+    return result
+
+
+def stats():
+    """
+    Return upstream call, failure, circuit breaker and hedging counters for this process
+    """
+    with _lock:
+        counters = dict(_counters)
+    counters['calls'] = dict(process_calls.by_endpoint)
+    counters['breaker_state'] = breaker.state
+    return counters
+
+
+def _get_executor(name, workers):
+    with _lock:
+        _reset_after_fork()
+        executor = _state['executors'].get(name)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"upstream-{name}")
+            _state['executors'][name] = executor
+        return executor
+
+
+def parallel_map(func, items, pool='detail'):
+    """
+    Apply func to every item using the named thread pool and return the results in order
+
+    Searches and detail lookups use separate pools so that a search waiting
+    on its detail lookups can never starve the pool it is waiting on.
+    """
+    items = list(items)
+    workers = SEARCH_WORKERS if pool == 'search' else MAX_WORKERS
+    if MAX_WORKERS <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    # Each task runs in a copy of the caller's context so that round trips
+    # made by worker threads are still counted by the caller's trackers
+    executor = _get_executor(pool, workers)
+    tasks = [(contextvars.copy_context(), item) for item in items]
+    return list(executor.map(lambda task: task[0].run(func, task[1]), tasks))
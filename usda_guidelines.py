@@ -5,7 +5,13 @@ This module contains functionality related to USDA dietary guidelines, including
 - Calorie target calculations
 - Macronutrient distribution recommendations
 - Daily nutrition targets
+- Target tables precomputed for every calorie level, used for single lookups
+  and to score the compliance of thousands of plans or days at once as arrays
 """
+from itertools import chain
+from operator import itemgetter
+
+import numpy as np
 
 # USDA calorie levels based on age, gender, and activity level
 CALORIE_LEVELS = {
@@ -79,6 +85,9 @@ MACRONUTRIENT_RANGES = {
     'fat': (20, 35)       # 20-35% of calories from fat
 }
 
+# Middle of each range, the share of calories targeted
+MACRONUTRIENT_PERCENTS = {nutrient: (low + high) / 2 for nutrient, (low, high) in MACRONUTRIENT_RANGES.items()}
+
 # Recommended fiber intake by calorie level
 FIBER_RECOMMENDATIONS = {
     1000: 19,
@@ -94,6 +103,48 @@ FIBER_RECOMMENDATIONS = {
     3000: 35
 }
 
+# Calorie levels (whole kcal) with precomputed targets; anything else is computed on demand
+TABLE_MIN_CALORIES = 500
+TABLE_MAX_CALORIES = 5000
+
+# Nutrients scored for compliance, in the column order of the batch arrays
+COMPLIANCE_NUTRIENTS = ('calories', 'protein', 'carbs', 'fat', 'fiber')
+
+# Compliance percentages outside this range get a recommendation
+COMPLIANCE_RANGE = (90, 110)
+
+# Recommendations for intake below and above the range (same order as COMPLIANCE_NUTRIENTS);
+# going over the fiber target is fine
+RECOMMENDATIONS = (
+    ("Increase overall calorie intake", "Reduce overall calorie intake"),
+    ("Increase protein intake", "Consider reducing protein slightly"),
+    ("Increase carbohydrate intake", "Reduce carbohydrate intake"),
+    ("Increase healthy fat intake", "Reduce fat intake"),
+    ("Increase fiber intake by adding more fruits, vegetables, and whole grains", None)
+)
+
+def _recommendation_sets():
+    """
+    List the recommendations for every combination of nutrients being low, in range or high
+    Indexed by the sum of state * 3 ** column, with state 0 in range, 1 low and 2 high
+    """
+    sets = []
+    for code in range(3 ** len(RECOMMENDATIONS)):
+        recommendations = []
+        for below, above in RECOMMENDATIONS:
+            code, state = divmod(code, 3)
+            if state == 1:
+                recommendations.append(below)
+            elif state == 2 and above:
+                recommendations.append(above)
+        sets.append(tuple(recommendations))
+    return sets
+
+RECOMMENDATION_SETS = _recommendation_sets()
+
+# Reads the compliance nutrients out of a day's nutrition dict
+_nutrition_values = itemgetter(*COMPLIANCE_NUTRIENTS)
+
 def get_calorie_target(age, gender, activity_level):
     """
     Calculate calorie target based on age, gender, and activity level
@@ -123,11 +174,90 @@ def get_calorie_target(age, gender, activity_level):
     
     return CALORIE_LEVELS[activity_key][gender][age_group]
 
+def _target_columns(calories):
+    """
+    Calculate the rounded macronutrient targets for an array of calorie targets
+    Returns an (n, 10) array: grams, range low and range high of protein,
+    carbs and fat, then the fiber grams
+    """
+    calories = np.asarray(calories, dtype=float)
+    columns = []
+    for nutrient, calories_per_gram in (('protein', 4), ('carbs', 4), ('fat', 9)):
+        low, high = MACRONUTRIENT_RANGES[nutrient]
+        # Same operations and order as get_macronutrient_targets, so the results match exactly
+        columns.append(calories * (((low + high) / 2) / 100) / calories_per_gram)
+        columns.append(calories * (low / 100) / calories_per_gram)
+        columns.append(calories * (high / 100) / calories_per_gram)
+    
+    # Nearest fiber recommendation; ties go to the lower calorie level, like min() over the sorted keys
+    levels = np.array(sorted(FIBER_RECOMMENDATIONS))
+    fiber = np.array([FIBER_RECOMMENDATIONS[level] for level in levels])
+    upper = np.clip(np.searchsorted(levels, calories), 1, len(levels) - 1)
+    nearer_lower = np.abs(calories - levels[upper - 1]) <= np.abs(levels[upper] - calories)
+    columns.append(np.where(nearer_lower, fiber[upper - 1], fiber[upper]))
+    
+    return np.round(np.column_stack(columns))
+
+class TargetTable:
+    """
+    Macronutrient targets precomputed for every whole calorie level in a range
+    """
+    
+    def __init__(self, min_calories=TABLE_MIN_CALORIES, max_calories=TABLE_MAX_CALORIES):
+        self.min_calories = min_calories
+        self.max_calories = max_calories
+        self.columns = _target_columns(np.arange(min_calories, max_calories + 1))
+        # Plain ints for building dicts, so single lookups never hand out numpy scalars
+        self.rows = self.columns.astype(int).tolist()
+    
+    def row(self, calorie_target):
+        """
+        Return the table row for a calorie target, or None if it isn't in the table
+        """
+        if isinstance(calorie_target, (int, np.integer)) and self.min_calories <= calorie_target <= self.max_calories:
+            return self.rows[calorie_target - self.min_calories]
+        return None
+    
+    def lookup(self, calorie_targets):
+        """
+        Return the (n, 10) target columns for an array of calorie targets
+        """
+        calorie_targets = np.asarray(calorie_targets, dtype=float)
+        in_table = (
+            (calorie_targets == np.floor(calorie_targets)) &
+            (calorie_targets >= self.min_calories) & (calorie_targets <= self.max_calories)
+        )
+        if in_table.all():
+            return self.columns[calorie_targets.astype(int) - self.min_calories]
+        
+        columns = np.empty((len(calorie_targets), self.columns.shape[1]))
+        columns[in_table] = self.columns[calorie_targets[in_table].astype(int) - self.min_calories]
+        columns[~in_table] = _target_columns(calorie_targets[~in_table])
+        return columns
+
 def get_macronutrient_targets(calorie_target):
     """
     Calculate macronutrient targets based on calorie target
     Returns targets in grams for protein, carbs, and fat
     """
+    row = target_table.row(calorie_target)
+    if row is not None:
+        return _targets_from_row(calorie_target, row)
+    return _calculate_macronutrient_targets(calorie_target)
+
+def _targets_from_row(calorie_target, row):
+    return {
+        'calories': calorie_target,
+        'protein': {'grams': row[0], 'range': [row[1], row[2]], 'percent': MACRONUTRIENT_PERCENTS['protein']},
+        'carbs': {'grams': row[3], 'range': [row[4], row[5]], 'percent': MACRONUTRIENT_PERCENTS['carbs']},
+        'fat': {'grams': row[6], 'range': [row[7], row[8]], 'percent': MACRONUTRIENT_PERCENTS['fat']},
+        'fiber': {'grams': row[9]}
+    }
+
+def _calculate_macronutrient_targets(calorie_target):
+    """
+    Calculate macronutrient targets for a calorie target outside the precomputed table
+    """
     # Calculate average percentages within the AMDR (Acceptable Macronutrient Distribution Range)
     protein_percent = (MACRONUTRIENT_RANGES['protein'][0] + MACRONUTRIENT_RANGES['protein'][1]) / 2
     carbs_percent = (MACRONUTRIENT_RANGES['carbs'][0] + MACRONUTRIENT_RANGES['carbs'][1]) / 2
@@ -253,3 +383,62 @@ def check_nutrient_compliance(meal_plan, calorie_target):
         },
         'recommendations': recommendations
     }
+
+def compliance_scores(average_nutrition, calorie_targets):
+    """
+    Score the average daily nutrition of many plans (or days) at once
+    average_nutrition is an (n, 5) array ordered like COMPLIANCE_NUTRIENTS
+    Returns an (n, 5) array of compliance percentages, unrounded
+    """
+    calorie_targets = np.asarray(calorie_targets, dtype=float)
+    columns = target_table.lookup(calorie_targets)
+    targets = np.column_stack([calorie_targets, columns[:, 0], columns[:, 3], columns[:, 6], columns[:, 9]])
+    return (np.asarray(average_nutrition, dtype=float) / targets) * 100
+
+def average_nutrition(meal_plans):
+    """
+    Average the daily nutrition of each plan into an (n, 5) array
+    Each plan is a list of days with a 'nutrition' dict, as generated by meal_planner;
+    every plan needs at least one day
+    """
+    counts = np.array([len(meal_plan) for meal_plan in meal_plans])
+    if not counts.all():
+        raise ValueError("Every meal plan needs at least one day")
+    
+    # fromiter over a flat stream of values skips building a list of tuples first
+    values = chain.from_iterable(_nutrition_values(day['nutrition']) for meal_plan in meal_plans for day in meal_plan)
+    totals = np.fromiter(values, dtype=float, count=int(counts.sum()) * len(COMPLIANCE_NUTRIENTS))
+    totals = totals.reshape(-1, len(COMPLIANCE_NUTRIENTS))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.add.reduceat(totals, starts, axis=0) / counts[:, None]
+
+def check_compliance_batch(meal_plans, calorie_targets):
+    """
+    Check many meal plans against USDA guidelines at once
+    Returns one result per plan, each the same as check_nutrient_compliance would return
+    """
+    if not len(meal_plans):
+        return []
+    
+    return compliance_results(compliance_scores(average_nutrition(meal_plans), calorie_targets))
+
+def compliance_results(scores):
+    """
+    Turn an (n, 5) array of compliance percentages into the results check_nutrient_compliance returns
+    """
+    # Encode each plan's low/in range/high states as one index into RECOMMENDATION_SETS
+    low, high = COMPLIANCE_RANGE
+    states = (scores < low) + 2 * (scores > high)
+    codes = (states @ 3 ** np.arange(len(COMPLIANCE_NUTRIENTS))).tolist()
+    rounded = np.round(scores).astype(int).tolist()
+    
+    return [
+        {
+            'compliance': dict(zip(COMPLIANCE_NUTRIENTS, plan_scores)),
+            'recommendations': list(RECOMMENDATION_SETS[code])
+        }
+        for plan_scores, code in zip(rounded, codes)
+    ]
+
+# Targets for every whole calorie level in the table range, built once at import
+target_table = TargetTable()